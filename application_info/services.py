@@ -1,5 +1,13 @@
+import atexit
 import datetime
+import logging
+import os
+import queue
+import threading
+import time
 
+from django.db import DatabaseError
+from django.db import close_old_connections
 from django.db.models import Q
 from django.db.models import Count
 from django.db.models import Case
@@ -21,6 +29,8 @@ from searching.models import OurEquipment
 from searching.models import KeyWord
 from searching.models import CompetitorsEquipment
 
+logger = logging.getLogger(__name__)
+
 
 def date_range_list(start: datetime.date, end: datetime.date):
     """
@@ -81,50 +91,144 @@ class ReviewService:
             review.reviewimg_set.create(img=img)
 
 
-class LogService:
-    @staticmethod
-    def log(action: str = 'info', log: str = 'log', section: str = 'system', user=None, error: bool = False):
+class LogWriter:
+    """
+    Фоновая запись логов. Логи складываются в очередь и записываются в базу данных
+    пачками через bulk_create из отдельного потока, поэтому запись лога не задерживает
+    вызывающий код. При переполнении очереди поведение зависит от политики LOG_OVERLOAD_POLICY:
+    'block' - ждать освобождения места в очереди, 'drop' - отбросить лог. Отброшенные и
+    незаписанные из-за ошибки логи считаются в dropped, ошибка записи не останавливает поток.
+    """
+
+    def __init__(self):
+        self.queue = None
+        self.thread = None
+        self.pid = None
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid() and self.thread.is_alive():
+                return
+            # после fork поток родительского процесса в дочернем не работает, поэтому очередь создается заново.
+            # в том же процессе очередь сохраняется, чтобы новый поток записал уже накопленные логи
+            if self.pid != os.getpid():
+                self.queue = queue.Queue(maxsize=settings.LOG_QUEUE_SIZE)
+            self.thread = threading.Thread(target=self.run, name='log-writer', daemon=True)
+            self.thread.start()
+            if self.pid is None:
+                atexit.register(self.flush)
+            self.pid = os.getpid()
+
+    def put(self, log: Log):
+        self.start()
+        if settings.LOG_OVERLOAD_POLICY == 'drop':
+            try:
+                self.queue.put_nowait(log)
+            except queue.Full:
+                self.dropped += 1
+        else:
+            self.queue.put(log)
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + settings.LOG_FLUSH_INTERVAL
+            while len(batch) < settings.LOG_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self.write(batch)
+            except Exception:
+                close_old_connections()
+                self.dropped += len(batch)
+                logger.exception('Не удалось записать пачку логов: %s (всего отброшено: %s)',
+                                 len(batch), self.dropped)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def write(self, batch: list):
+        """
+        Записывает пачку логов. Если пачка не записалась целиком, логи записываются по одному,
+        чтобы одна ошибочная запись не отбрасывала всю пачку. Незаписанные логи учитываются в dropped.
+        """
         try:
-            config = SystemConfig.objects.get(is_actual=True)
-            log = Log(
-                action=action,
-                log=log,
-                section=section,
-                user=user,
-                static_user_id=str(user.id) if user else '',
-                user_email=user.email if user else '',
-                user_name=user.name if user else '',
-                system_version=config.version,
-                is_error=error
-            )
-            log.save()
-        except SystemConfig.DoesNotExist:
-            log = Log(
-                action='write-log',
-                log='Попытка записать лог активности. Актуальная версия конфигурации не определена!',
-                section=section,
-                user=user,
-                static_user_id=str(user.id) if user else '',
-                user_email=user.email if user else '',
-                user_name=user.name if user else '',
-                system_version='none',
-                is_error=True
-            )
-            log.save()
-        finally:
-            log = Log(
-                action='write-log',
-                log='Попытка записать лог активности. Неизвестная ошибка!',
-                section=section,
-                user=user,
-                static_user_id=str(user.id) if user else '',
-                user_email=user.email if user else '',
-                user_name=user.name if user else '',
-                system_version='none',
-                is_error=True
-            )
+            Log.objects.bulk_create(batch)
+            return
+        except DatabaseError:
+            close_old_connections()
+        failed = 0
+        for log in batch:
+            try:
+                log.save()
+            except DatabaseError as e:
+                close_old_connections()
+                failed += 1
+                error = e
+        if failed:
+            self.dropped += failed
+            logger.error('Не удалось записать логов: %s из %s (всего отброшено: %s). %s',
+                         failed, len(batch), self.dropped, error)
+
+    def flush(self):
+        """
+        Ожидает записи всех логов из очереди текущего процесса
+        """
+        if self.pid == os.getpid() and self.thread.is_alive():
+            self.queue.join()
+
+
+class LogService:
+    writer = LogWriter()
+    version = None
+    version_expires = 0
+
+    @classmethod
+    def get_version(cls):
+        """
+        Возвращает версию актуальной конфигурации системы. Версия кешируется
+        на LOG_VERSION_CACHE_TTL секунд, чтобы не запрашивать ее при каждой записи лога.
+        """
+        if time.monotonic() >= cls.version_expires:
+            cls.version = SystemConfig.objects.filter(is_actual=True).values_list('version', flat=True).first()
+            cls.version_expires = time.monotonic() + settings.LOG_VERSION_CACHE_TTL
+        return cls.version
+
+    @classmethod
+    def log(cls, action: str = 'info', log: str = 'log', section: str = 'system', user=None, error: bool = False):
+        version = cls.get_version()
+        if version is None:
+            action = 'write-log'
+            log = 'Попытка записать лог активности. Актуальная версия конфигурации не определена!'
+            version = 'none'
+            error = True
+        log = Log(
+            action=action,
+            log=log,
+            section=section,
+            user=user,
+            static_user_id=str(user.id) if user else '',
+            user_email=user.email if user else '',
+            user_name=user.name if user else '',
+            system_version=version,
+            is_error=error
+        )
+        if settings.LOG_ASYNC:
+            cls.writer.put(log)
+        else:
             log.save()
 
+    @classmethod
+    def flush(cls):
+        cls.writer.flush()
+
 
 class ApplicationStatisticService:
 
@@ -1,3 +1,53 @@
+from unittest import mock
+
+from django.db import DatabaseError
 from django.test import TestCase
+from django.test import override_settings
+
+from .models import Log
+from .services import LogWriter
+
+
+def create_log(log: str):
+    return Log(action='info', log=log, system_version='1.0')
+
+
+class LogWriterTest(TestCase):
+
+    def test_fallback_to_single_rows(self):
+        writer = LogWriter()
+        logs = [create_log(f'Лог {i}') for i in range(3)]
+        # ошибочная запись не отбрасывает остальные логи пачки
+        logs[1].save = mock.Mock(side_effect=DatabaseError('Ошибка записи'))
+        with mock.patch.object(Log.objects, 'bulk_create', side_effect=DatabaseError('Ошибка пачки')), \
+                self.assertLogs('application_info.services', 'ERROR'):
+            writer.write(logs)
+        self.assertEqual(list(Log.objects.order_by('id').values_list('log', flat=True)), ['Лог 0', 'Лог 2'])
+        self.assertEqual(writer.dropped, 1)
+
+    @override_settings(LOG_BATCH_SIZE=1, LOG_FLUSH_INTERVAL=0)
+    def test_survives_write_errors(self):
+        writer = LogWriter()
+        with mock.patch.object(writer, 'write', side_effect=[RuntimeError('Сбой'), None]) as write, \
+                self.assertLogs('application_info.services', 'ERROR'):
+            writer.put(create_log('Лог 0'))
+            writer.flush()
+            # поток продолжает записывать логи после ошибки
+            self.assertTrue(writer.thread.is_alive())
+            writer.put(create_log('Лог 1'))
+            writer.flush()
+        self.assertEqual([args[0][0].log for args, kwargs in write.call_args_list], ['Лог 0', 'Лог 1'])
+        self.assertEqual(writer.dropped, 1)
 
-# Create your tests here.
+    @override_settings(LOG_OVERLOAD_POLICY='drop')
+    def test_restart_keeps_queue(self):
+        writer = LogWriter()
+        with mock.patch.object(writer, 'run'):
+            writer.start()
+            writer.thread.join()
+            writer.put(create_log('Лог 0'))
+            queue = writer.queue
+            # поток в том же процессе перезапускается с уже накопленными логами
+            writer.start()
+            self.assertIs(writer.queue, queue)
+            self.assertEqual(queue.qsize(), 1)
@@ -35,6 +35,8 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
+    'django_celery_beat',
     'accounts',
     'application_info',
     'searching'
@@ -141,3 +143,92 @@ ROOT_APP_ADDR = os.environ.get('ASIST_ROOT_APP_ADDR')
 AUTH_USER_MODEL = 'accounts.User'
 
 MAX_REVIEW_IMG_SIZE_MB = int(os.environ.get('ASIST_MAX_REVIEW_IMG_SIZE_MB'))
+
+# Подбор аналогов
+# Пакетный режим: точные ступени поиска выполняются одним запросом на ступень для всей сметы
+SEARCH_BATCH_MODE = os.environ.get('ASIST_SEARCH_BATCH_MODE', 'True').lower() in ('true', 't', '1',)
+
+# Redis используется брокером Celery и слоем каналов для передачи прогресса пересчета в сокет
+REDIS_URL = os.environ.get('ASIST_REDIS_URL', 'redis://localhost:6379/0')
+
+CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'CONFIG': {'hosts': [REDIS_URL]},
+    }
+}
+
+# Celery
+# Для локального запуска без брокера можно выставить ASIST_CELERY_ALWAYS_EAGER=True,
+# тогда задачи выполняются в том же процессе
+CELERY_BROKER_URL = os.environ.get('ASIST_CELERY_BROKER_URL', REDIS_URL)
+CELERY_TASK_ALWAYS_EAGER = os.environ.get('ASIST_CELERY_ALWAYS_EAGER', 'False').lower() in ('true', 't', '1',)
+CELERY_TASK_IGNORE_RESULT = True
+CELERY_TIMEZONE = TIME_ZONE
+CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
+CELERY_BEAT_SCHEDULE = {
+    'sweep-artifacts': {
+        'task': 'searching.tasks.sweep_artifacts',
+        'schedule': int(os.environ.get('ASIST_ARTIFACT_SWEEP_INTERVAL', 3600)),
+    },
+}
+
+# Временные файлы (выгрузки данных, загруженные сметы) удаляются после отправки ответа, а неотправленные -
+# задачей searching.tasks.sweep_artifacts или командой sweep_artifacts через ARTIFACT_TTL секунд после создания
+ARTIFACT_TTL = int(os.environ.get('ASIST_ARTIFACT_TTL', 24 * 3600))
+
+# Результаты пересчета (MEDIA_ROOT/recalculates) удаляются вместе с процессом пересчета, а также той же
+# задачей очистки через SEARCH_RESULTS_TTL секунд после записи
+SEARCH_RESULTS_TTL = int(os.environ.get('ASIST_SEARCH_RESULTS_TTL', 30 * 24 * 3600))
+
+# Пул процессов для пересчета больших смет. Строки сметы делятся на части по SEARCH_POOL_CHUNK_SIZE
+# и подбираются параллельно, если в смете не меньше SEARCH_POOL_MIN_ROWS строк.
+# Пул запускается и из воркеров Celery в режиме prefork: каждый пересчет занимает до SEARCH_POOL_WORKERS
+# процессов, поэтому concurrency воркера стоит уменьшать пропорционально
+SEARCH_POOL_WORKERS = int(os.environ.get('ASIST_SEARCH_POOL_WORKERS', os.cpu_count() or 1))
+SEARCH_POOL_MIN_ROWS = int(os.environ.get('ASIST_SEARCH_POOL_MIN_ROWS', 1000))
+SEARCH_POOL_CHUNK_SIZE = int(os.environ.get('ASIST_SEARCH_POOL_CHUNK_SIZE', 500))
+
+# Кол-во строк SearchProcessResult, сохраняемых одним запросом
+SEARCH_RESULTS_BATCH_SIZE = int(os.environ.get('ASIST_SEARCH_RESULTS_BATCH_SIZE', 500))
+
+# Как часто (в секундах) пересчет проверяет, не был ли он остановлен пользователем
+SEARCH_INTERRUPT_POLL_INTERVAL = float(os.environ.get('ASIST_SEARCH_INTERRUPT_POLL_INTERVAL', 0.3))
+
+# Прогресс пересчета отправляется в сокет не чаще, чем раз в SEARCH_PROGRESS_INTERVAL секунд,
+# или при накоплении SEARCH_PROGRESS_BATCH_SIZE строк лога
+SEARCH_PROGRESS_INTERVAL = float(os.environ.get('ASIST_SEARCH_PROGRESS_INTERVAL', 0.15))
+SEARCH_PROGRESS_BATCH_SIZE = int(os.environ.get('ASIST_SEARCH_PROGRESS_BATCH_SIZE', 100))
+
+# Журнал действий (application_info.Log)
+# При LOG_ASYNC логи пишутся фоновым потоком пачками до LOG_BATCH_SIZE записей не реже, чем раз в LOG_FLUSH_INTERVAL
+# секунд. LOG_OVERLOAD_POLICY определяет поведение при заполненной очереди: 'block' - ждать, 'drop' - отбросить лог
+LOG_ASYNC = os.environ.get('ASIST_LOG_ASYNC', 'True').lower() in ('true', 't', '1',)
+LOG_QUEUE_SIZE = int(os.environ.get('ASIST_LOG_QUEUE_SIZE', 10000))
+LOG_BATCH_SIZE = int(os.environ.get('ASIST_LOG_BATCH_SIZE', 200))
+LOG_FLUSH_INTERVAL = float(os.environ.get('ASIST_LOG_FLUSH_INTERVAL', 1))
+LOG_OVERLOAD_POLICY = os.environ.get('ASIST_LOG_OVERLOAD_POLICY', 'block')
+LOG_VERSION_CACHE_TTL = int(os.environ.get('ASIST_LOG_VERSION_CACHE_TTL', 60))
+
+# Счетчики процесса пересчета сохраняются каждые SEARCH_COUNTERS_SAVE_ROWS строк
+# или SEARCH_COUNTERS_SAVE_INTERVAL секунд
+SEARCH_COUNTERS_SAVE_ROWS = int(os.environ.get('ASIST_SEARCH_COUNTERS_SAVE_ROWS', 100))
+SEARCH_COUNTERS_SAVE_INTERVAL = float(os.environ.get('ASIST_SEARCH_COUNTERS_SAVE_INTERVAL', 1))
+
+# Общий кеш результатов подбора аналогов. Ключ включает версию каталога, поэтому после изменения каталога
+# старые записи не используются и вытесняются по TTL. В Redis рекомендуется maxmemory-policy allkeys-lru
+SEARCH_CACHE_ENABLED = os.environ.get('ASIST_SEARCH_CACHE_ENABLED', 'True').lower() in ('true', 't', '1',)
+SEARCH_CACHE_URL = os.environ.get('ASIST_SEARCH_CACHE_URL', REDIS_URL)
+SEARCH_CACHE_TTL = int(os.environ.get('ASIST_SEARCH_CACHE_TTL', 7 * 24 * 3600))
+
+# Рассылка изменений каталога между процессами через LISTEN/NOTIFY PostgreSQL
+# и кол-во индексов аналогов, которые процесс держит в памяти между пересчетами
+SEARCH_CATALOG_LISTEN = os.environ.get('ASIST_SEARCH_CATALOG_LISTEN', 'True').lower() in ('true', 't', '1',)
+SEARCH_INDEX_CACHE_SIZE = int(os.environ.get('ASIST_SEARCH_INDEX_CACHE_SIZE', 2))
+
+# Нечеткий поиск наименований по триграммам (pg_trgm): минимальное сходство от 0 до 1
+SEARCH_TRIGRAM_ENABLED = os.environ.get('ASIST_SEARCH_TRIGRAM_ENABLED', 'True').lower() in ('true', 't', '1',)
+SEARCH_TRIGRAM_THRESHOLD = float(os.environ.get('ASIST_SEARCH_TRIGRAM_THRESHOLD', 0.5))
+
+# Максимальное кол-во вторичных аналогов (K), возвращаемых для строки сметы
+SEARCH_SIMILAR_LIMIT = int(os.environ.get('ASIST_SEARCH_SIMILAR_LIMIT', 10))
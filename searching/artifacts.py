@@ -0,0 +1,106 @@
+import os
+import time
+import uuid
+
+from django.conf import settings
+from django.http.response import FileResponse
+from django.utils import timezone
+from django.utils.encoding import escape_uri_path
+
+from .models import TemporaryArtifact
+
+
+class ArtifactService:
+    """
+    Хранилище временных файлов в MEDIA_ROOT. Файл регистрируется в TemporaryArtifact со сроком жизни,
+    удаляется после того, как ответ с ним отправлен, а файлы, которые не были отправлены (ошибка запроса,
+    перезапуск процесса), удаляет sweep() - периодическая задача sweep_artifacts или одноименная команда.
+    """
+    # каталоги временных файлов, в т.ч. оставшиеся от прежних версий
+    folders = ('download', 'downloads', 'tmp_recalculates', 'uploads')
+
+    @staticmethod
+    def create(folder: str, name: str, ttl: int = None):
+        """
+        Регистрирует временный файл и возвращает путь, по которому его нужно записать
+
+        folder  <-  Каталог в MEDIA_ROOT
+        name    <-  Имя файла для пользователя. На диске к нему добавляется префикс, чтобы одновременные
+                    выгрузки с одинаковым именем не перезаписывали друг друга
+        ttl     <-  Время жизни файла в секундах. По умолчанию - ARTIFACT_TTL
+        """
+        fld = os.path.join(settings.MEDIA_ROOT, folder)
+        os.makedirs(fld, exist_ok=True)
+        path = os.path.join(fld, f'{uuid.uuid4().hex[:12]}_{name}')
+        expires = timezone.now() + timezone.timedelta(seconds=ttl or settings.ARTIFACT_TTL)
+        TemporaryArtifact.objects.create(path=path, name=name, expires=expires)
+        return path
+
+    @staticmethod
+    def remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        TemporaryArtifact.objects.filter(path=path).delete()
+
+    @staticmethod
+    def get_response(path: str, filename: str = None):
+        """
+        Возвращает ответ, который отдает файл частями и удаляет его после завершения отправки
+
+        path        <-  Путь до файла, созданного через create
+        filename    <-  Имя файла для пользователя. По умолчанию - имя, переданное в create
+        """
+        if filename is None:
+            filename = TemporaryArtifact.objects.filter(path=path).values_list('name', flat=True).first() or \
+                       os.path.basename(path)
+        response = ArtifactFileResponse(path, as_attachment=True, filename=filename)
+        response['Access-Control-Expose-Headers'] = 'Content-Disposition'
+        response['Content-Disposition'] = "attachment; filename=*=UTF-8''" + escape_uri_path(filename)
+        return response
+
+    @classmethod
+    def sweep(cls):
+        """
+        Удаляет просроченные временные файлы и файлы без записи в TemporaryArtifact старше ARTIFACT_TTL.
+        Возвращает кол-во удаленных файлов.
+        """
+        removed = 0
+        expired = TemporaryArtifact.objects.filter(expires__lte=timezone.now())
+        for path in expired.values_list('path', flat=True):
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        expired.delete()
+
+        known = set(TemporaryArtifact.objects.values_list('path', flat=True))
+        deadline = time.time() - settings.ARTIFACT_TTL
+        for folder in cls.folders:
+            for root, dirs, files in os.walk(os.path.join(settings.MEDIA_ROOT, folder)):
+                for file in files:
+                    path = os.path.join(root, file)
+                    try:
+                        if path not in known and os.path.getmtime(path) < deadline:
+                            os.remove(path)
+                            removed += 1
+                    except FileNotFoundError:
+                        pass
+        return removed
+
+
+class ArtifactFileResponse(FileResponse):
+    """
+    Ответ с временным файлом. Django закрывает ответ, когда отправка завершена или соединение оборвано,
+    поэтому файл удаляется не раньше, чем клиент его получит.
+    """
+
+    def __init__(self, path: str, *args, **kwargs):
+        self.artifact_path = path
+        super().__init__(open(path, 'rb'), *args, **kwargs)
+
+    def close(self):
+        super().close()
+        ArtifactService.remove(self.artifact_path)
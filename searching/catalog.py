@@ -0,0 +1,228 @@
+import os
+import select
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+from django.conf import settings
+from django.db import connection, connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import CatalogVersion
+from .models import CompetitorAnalog
+from .models import KeyWord
+
+
+class CatalogVersionService:
+    """
+    Версия (поколение) каталога номенклатуры. Повышается после фиксации транзакции, в которой
+    изменились данные, влияющие на подбор аналогов, и рассылается остальным процессам
+    через LISTEN/NOTIFY PostgreSQL, чтобы индексы и кеши в памяти сразу перестали использоваться.
+    """
+    channel = 'asist_catalog'
+    state = threading.local()
+    version = None      # версия, известная процессу; достоверна, пока работает слушатель уведомлений
+    generation = 0      # кол-во сбросов версии в процессе
+    listener = None
+    pinned = None       # версия, переданная процессу пула родителем; слушатель в таком процессе не нужен
+    callbacks = list()
+
+    @classmethod
+    def subscribe(cls, callback):
+        """
+        Регистрирует функцию, которая вызывается при изменении каталога
+        """
+        cls.callbacks.append(callback)
+
+    @classmethod
+    def invalidate(cls):
+        cls.generation += 1
+        cls.version = None
+        for callback in cls.callbacks:
+            callback()
+
+    @classmethod
+    def pin(cls, version: int):
+        """
+        Фиксирует версию каталога в процессе пула: процесс живет один пересчет и подбирает аналоги
+        по версии родителя, поэтому не запускает своего слушателя и не открывает лишних подключений
+        """
+        cls.pinned = version
+        cls.version = version
+
+    @classmethod
+    def get(cls):
+        if cls.pinned is not None:
+            return cls.pinned
+        if cls.listen() and cls.version is not None:
+            return cls.version
+        generation = cls.generation
+        version = CatalogVersion.objects.filter(id=1).values_list('version', flat=True).first() or 0
+        # версия запоминается, только если за время запроса не пришло уведомление об изменении
+        if cls.listen() and generation == cls.generation:
+            cls.version = version
+        return version
+
+    @classmethod
+    def bump(cls):
+        """
+        Отмечает изменение каталога. Внутри batch() версия повышается один раз при выходе из блока,
+        иначе - после фиксации текущей транзакции. При откате транзакции версия не меняется.
+        """
+        if getattr(cls.state, 'depth', 0):
+            cls.state.dirty = True
+        else:
+            cls.schedule()
+
+    @classmethod
+    def schedule(cls):
+        """
+        Регистрирует повышение версии после фиксации текущей транзакции, один раз на внешнюю транзакцию:
+        каскадное удаление или сохранение многих записей каталога повышает версию один раз.
+        Признаком ожидания служит сам callback в очереди on_commit подключения, поэтому при откате
+        транзакции или точки сохранения признак сбрасывается вместе с ним.
+        """
+        conn = transaction.get_connection()
+        if conn.in_atomic_block and any(func == cls.commit for sids, func, *_ in conn.run_on_commit):
+            return
+        transaction.on_commit(cls.commit)
+
+    @classmethod
+    def commit(cls):
+        # соответствия аналогов перестраиваются до повышения версии, чтобы индексы новой версии их уже видели
+        CompetitorAnalogService.flush()
+        if not CatalogVersion.objects.filter(id=1).update(version=F('version') + 1, updated=timezone.now()):
+            CatalogVersion.objects.get_or_create(id=1, defaults={'version': 1})
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_notify(%s, %s)', [cls.channel, ''])
+        cls.invalidate()
+
+    @classmethod
+    @contextmanager
+    def batch(cls):
+        """
+        Объединяет изменения каталога внутри блока (например, загрузку файла данных) в одно повышение версии
+        """
+        cls.state.depth = getattr(cls.state, 'depth', 0) + 1
+        try:
+            yield
+        finally:
+            cls.state.depth -= 1
+            if not cls.state.depth and getattr(cls.state, 'dirty', False):
+                cls.state.dirty = False
+                cls.schedule()
+
+    @classmethod
+    def listen(cls):
+        """
+        Запускает слушателя уведомлений в текущем процессе и возвращает True, если он подключен
+        """
+        if not settings.SEARCH_CATALOG_LISTEN or cls.pinned is not None or connection.vendor != 'postgresql':
+            return False
+        if cls.listener is None or cls.listener.pid != os.getpid():
+            cls.version = None
+            cls.listener = CatalogListener()
+            cls.listener.start()
+        return cls.listener.listening
+
+
+class CompetitorAnalogService:
+    """
+    Поддержка таблицы CompetitorAnalog. Изменения ключей и номенклатуры ИЕК отмечаются в течение
+    транзакции, затронутые соответствия перестраиваются при фиксации изменений каталога.
+    """
+    state = threading.local()
+
+    @classmethod
+    def touch(cls, comp_ids=(), our_ids=()):
+        """
+        Отмечает номенклатуру конкурентов, соответствия которой требуется перестроить
+
+        comp_ids    <-  Список id номенклатуры конкурентов
+        our_ids     <-  Список id номенклатуры ИЕК, для конкурентов которой порядок аналогов мог измениться
+        """
+        if not hasattr(cls.state, 'comp_ids'):
+            cls.state.comp_ids, cls.state.our_ids = set(), set()
+        cls.state.comp_ids.update(comp_id for comp_id in comp_ids if comp_id)
+        cls.state.our_ids.update(our_id for our_id in our_ids if our_id)
+
+    @classmethod
+    def flush(cls):
+        comp_ids = getattr(cls.state, 'comp_ids', set())
+        our_ids = getattr(cls.state, 'our_ids', set())
+        if not comp_ids and not our_ids:
+            return
+        cls.state.comp_ids, cls.state.our_ids = set(), set()
+        if our_ids:
+            comp_ids |= set(KeyWord.objects.filter(our_equipment_id__in=our_ids, comp_equipment__isnull=False)
+                            .values_list('comp_equipment_id', flat=True))
+        cls.rebuild(comp_ids)
+
+    @staticmethod
+    def rebuild(comp_ids: set = None, chunk_size: int = 1000):
+        """
+        Перестраивает соответствия для переданной номенклатуры конкурентов
+
+        comp_ids    <-  Множество id номенклатуры конкурентов. Если не передано, таблица перестраивается полностью
+        chunk_size  <-  Кол-во номенклатуры конкурентов, перестраиваемой в одной транзакции
+        """
+        if comp_ids is None:
+            CompetitorAnalog.objects.all().delete()
+            comp_ids = set(KeyWord.objects.filter(our_equipment__isnull=False, comp_equipment__isnull=False)
+                           .values_list('comp_equipment_id', flat=True))
+        comp_ids = sorted(comp_ids)
+        for start in range(0, len(comp_ids), chunk_size):
+            chunk = comp_ids[start:start + chunk_size]
+            analogs = dict()
+            kwds = KeyWord.objects.filter(comp_equipment_id__in=chunk, our_equipment__isnull=False)
+            for comp_id, our_id in kwds.order_by('our_equipment__name', 'our_equipment_id').values_list(
+                    'comp_equipment_id', 'our_equipment_id'):
+                lst = analogs.setdefault(comp_id, list())
+                if our_id not in lst:
+                    lst.append(our_id)
+            with transaction.atomic():
+                CompetitorAnalog.objects.filter(comp_equipment_id__in=chunk).delete()
+                CompetitorAnalog.objects.bulk_create(
+                    CompetitorAnalog(comp_equipment_id=comp_id, analogs=lst) for comp_id, lst in analogs.items())
+
+
+class CatalogListener(threading.Thread):
+    """
+    Поток, который держит отдельное подключение к PostgreSQL, слушает канал
+    CatalogVersionService.channel и сбрасывает известную процессу версию каталога при уведомлении.
+    """
+
+    def __init__(self):
+        super().__init__(name='catalog-listener', daemon=True)
+        self.pid = os.getpid()
+        self.listening = False
+
+    def run(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(**connections['default'].get_connection_params())
+                conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cursor:
+                    cursor.execute(f'LISTEN {CatalogVersionService.channel}')
+                # пока слушатель был отключен, уведомления могли быть пропущены
+                CatalogVersionService.invalidate()
+                self.listening = True
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    if conn.notifies:
+                        conn.notifies.clear()
+                        CatalogVersionService.invalidate()
+            except (psycopg2.Error, OSError):
+                self.listening = False
+                CatalogVersionService.version = None
+                if conn is not None:
+                    conn.close()
+                time.sleep(5)
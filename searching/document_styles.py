@@ -1,6 +1,7 @@
 from openpyxl.styles import (
     PatternFill, Border, Side,
-    Alignment, Font, GradientFill
+    Alignment, Font, GradientFill,
+    NamedStyle
 )
 
 # СТИЛЬ ШРИФТА
@@ -90,3 +91,40 @@ alignment_left = Alignment(
     shrink_to_fit=True,
     indent=0
 )
+
+# ИМЕНОВАННЫЕ СТИЛИ
+# Роль ячейки в файле пересчета -> шрифт, заливка, граница и выравнивание. Стили регистрируются в книге
+# один раз и применяются к ячейкам по имени, без поиска одинаковых объектов стиля для каждой ячейки
+named_styles = {
+    'asist_contact': (standard_font, None, None, None),
+    'asist_title': (title_font, white_fill, bold_border, None),
+    'asist_iek_title': (title_font, iek_title_fill, bold_border, None),
+    'asist_comment_title': (title_font, comment_title_fill, bold_border, None),
+    'asist_discount_title': (title_font, discount_title_fill, bold_border, None),
+    'asist_cell_center': (standard_font, white_fill, standard_border, alignment_center),
+    'asist_cell_left': (standard_font, white_fill, standard_border, alignment_left),
+    'asist_iek_code_cell': (standard_font, iek_cell_fill, separate_left_bold_border, alignment_left),
+    'asist_iek_cell_left': (standard_font, iek_cell_fill, standard_border, alignment_left),
+    'asist_iek_cell_center': (standard_font, iek_cell_fill, standard_border, alignment_center),
+    'asist_comment_cell': (standard_font, comment_cell_fill, separate_left_bold_border, alignment_left),
+    'asist_status_cell': (standard_font, comment_cell_fill, standard_border, alignment_left),
+    'asist_discount_cell': (standard_font, discount_cell_fill, separate_left_bold_border, alignment_left),
+}
+
+
+def add_named_styles(wb):
+    """
+    Регистрирует именованные стили в книге. Объект NamedStyle привязывается к книге,
+    поэтому для каждой книги создается заново.
+
+    wb  <-  Книга openpyxl
+    """
+    for name, (font, fill, border, alignment) in named_styles.items():
+        style = NamedStyle(name=name, font=font)
+        if fill:
+            style.fill = fill
+        if border:
+            style.border = border
+        if alignment:
+            style.alignment = alignment
+        wb.add_named_style(style)
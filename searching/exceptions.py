@@ -21,3 +21,19 @@ class InvalidUploadingData(exceptions.APIException):
 class MultiEquipCategoryDownload(exceptions.APIException):
     status_code = 400
     default_detail = 'Можно выгружать только файлы данных номенклатур, относящихся к одной категории.'
+
+
+class SearchNotFinished(exceptions.APIException):
+    status_code = 400
+    default_detail = 'Пересчет еще не завершен'
+
+
+class SearchResultNotFound(exceptions.APIException):
+    status_code = 404
+    default_detail = 'Результат пересчета не найден'
+
+
+class RowsLimitExceeded(exceptions.APIException):
+    status_code = 400
+    default_detail = 'Количество доступных для пересчета строк меньше чем имеется в загруженном файле. ' \
+                     'Поиск остановлен. Обратитесь к администратору'
@@ -0,0 +1,520 @@
+import collections
+import copy
+import itertools
+import threading
+import weakref
+
+import numpy as np
+
+from django.conf import settings
+from django.db import connection
+
+from .catalog import CatalogVersionService
+from .models import OurEquipment
+from .models import OurEquipmentProperty
+from .models import CompetitorAnalog
+from .models import CompetitorsEquipment
+from .models import KeyWord
+from .models import EquipmentCategoryProperty
+from .models import EquipmentCategoryPropertyValue
+from .utils import normalize_key
+
+
+class CategoryMatrix:
+    """
+    Разреженная матрица "номенклатура x значение характеристики" одной категории.
+    Строка матрицы - номенклатура ИЕК (в порядке наименований), столбец - значение характеристики категории.
+    Для каждого столбца хранятся только номера строк, в которых он заполнен (indices[indptr[j]:indptr[j + 1]]),
+    поэтому память и время подсчета совпадений зависят от кол-ва характеристик номенклатуры,
+    а не от произведения кол-ва номенклатуры на кол-во значений.
+    """
+
+    def __init__(self, category_id: int, equipment: OurEquipment.objects):
+        self.category_id = category_id
+        self.ids = np.array(equipment.filter(category_id=category_id).order_by('name', 'id').values_list(
+            'id', flat=True), dtype=np.int64)
+        rows = {eq_id: i for i, eq_id in enumerate(self.ids.tolist())}
+        value_ids = EquipmentCategoryPropertyValue.objects.filter(property__category_id=category_id).values_list(
+            'id', flat=True)
+        self.columns = {value_id: j for j, value_id in enumerate(value_ids)}
+        self.property_count = EquipmentCategoryProperty.objects.filter(category_id=category_id).count()
+        props = OurEquipmentProperty.objects.filter(equipment__category_id=category_id,
+                                                    value__property__category_id=category_id)
+        cells = {(self.columns[value_id], rows[eq_id])
+                 for eq_id, value_id in props.values_list('equipment_id', 'value_id') if eq_id in rows}
+        # ячейки упорядочены по столбцу, затем по строке
+        c, r = np.array(sorted(cells), dtype=np.int64).reshape(-1, 2).T
+        self.indices = r
+        self.indptr = np.searchsorted(c, np.arange(len(self.columns) + 1))
+
+    def scores(self, value_ids: list):
+        """
+        Возвращает кол-во совпавших характеристик для каждой номенклатуры категории
+        """
+        columns = {self.columns[v] for v in value_ids if v in self.columns}
+        rows = [self.indices[self.indptr[j]:self.indptr[j + 1]] for j in columns]
+        return np.bincount(np.concatenate(rows) if rows else self.indices[:0], minlength=len(self.ids))
+
+    @staticmethod
+    def top(scores: np.ndarray, candidates: np.ndarray, k: int = None):
+        """
+        Возвращает индексы кандидатов, упорядоченные по убыванию кол-ва совпадений.
+        При переданном k отбирает только k лучших: порог k-го результата находится через partition,
+        кандидаты с равным порогу кол-вом совпадений остаются, чтобы при равенстве сохранялся порядок строк.
+        """
+        if k is not None and k < len(candidates):
+            candidate_scores = scores[candidates]
+            kth = -np.partition(-candidate_scores, k - 1)[k - 1]
+            candidates = candidates[candidate_scores >= kth]
+        return candidates[np.argsort(-scores[candidates], kind='stable')][:k]
+
+    def search(self, value_ids: list, psp: int, k: int = None, excluded: np.ndarray = None):
+        """
+        Возвращает список пар [id номенклатуры, процент совпадения] для номенклатуры, у которой
+        процент совпадения характеристик не меньше psp, в порядке убывания кол-ва совпадений.
+
+        value_ids   <-  Список id значений характеристик, найденных в строке сметы
+        psp         <-  Минимальный процент совпадения характеристик
+        k           <-  Максимальное кол-во возвращаемых позиций
+        excluded    <-  Маска исключенных строк матрицы
+        """
+        if not self.property_count or not len(self.ids):
+            return list()
+        scores = self.scores(value_ids)
+        # psp   <-  Property Similarity Percentage
+        percentage = scores * 100 / self.property_count
+        matched = (scores > 0) & (percentage >= psp)
+        if excluded is not None:
+            matched &= ~excluded
+        candidates = np.flatnonzero(matched)
+        top = self.top(scores, candidates, k)
+        return [[eq_id, round(pct)] for eq_id, pct in zip(self.ids[top].tolist(), percentage[top].tolist())]
+
+
+class PropertyIndex:
+    """
+    Индекс для ступени поиска по совпадению характеристик.
+    Хранит соответствие строковых значений характеристик их категориям и лениво
+    строит матрицы CategoryMatrix для категорий, которые потребовались при пересчете.
+    """
+
+    def __init__(self, equipment: OurEquipment.objects):
+        self.equipment = equipment
+        self.values = dict()    # значение характеристики -> список пар (id значения, id категории)
+        self.matrices = dict()  # id категории -> CategoryMatrix
+
+    @classmethod
+    def build(cls, equipment: OurEquipment.objects, words: set = None):
+        """
+        equipment   <-  Список номенклатуры, из которой необходимо подобрать аналог
+        words       <-  Множество слов из наименований строк сметы. Если не передано, загружаются все значения
+        """
+        index = cls(equipment)
+        values = EquipmentCategoryPropertyValue.objects.all()
+        if words is not None:
+            values = values.filter(value__in=words)
+        for value_id, value, category_id in values.values_list('id', 'value', 'property__category_id'):
+            index.values.setdefault(value, list()).append((value_id, category_id))
+        return index
+
+    def matrix(self, category_id: int):
+        if category_id not in self.matrices:
+            self.matrices[category_id] = CategoryMatrix(category_id, self.equipment)
+        return self.matrices[category_id]
+
+    def search(self, comp_name: str, psp: int, k: int = None, excluded: 'ExcludedEquipment' = None):
+        """
+        Возвращает список пар [id номенклатуры, процент совпадения], подобранной по совпадению
+        характеристик с наименованием конкурента. Категория выбирается по наибольшему кол-ву
+        совпавших значений характеристик.
+        """
+        if not isinstance(comp_name, str):
+            return list()
+        found = [v for word in set(comp_name.split(' ')) for v in self.values.get(word, list())]
+        c = collections.Counter(category_id for _, category_id in found)
+        if not c:
+            return list()
+        category_id, _ = max(c.items(), key=lambda p: p[::-1])
+        value_ids = [value_id for value_id, cat_id in found if cat_id == category_id]
+        matrix = self.matrix(category_id)
+        return matrix.search(value_ids, psp, k, excluded.mask(matrix) if excluded else None)
+
+
+class ExcludedEquipment:
+    """
+    Номенклатура ИЕК исключенных из подбора линеек, вычисленная один раз на версию каталога:
+    множество id для проверки списков аналогов и битовые маски строк матриц категорий
+    для векторного поиска по характеристикам.
+    """
+    shared_sets = collections.OrderedDict()  # (версия каталога, исключенные линейки) -> ExcludedEquipment
+    shared_lock = threading.Lock()
+
+    def __init__(self, ids=()):
+        self.ids = frozenset(ids)
+        self.array = np.array(sorted(self.ids), dtype=np.int64)
+        self.masks = weakref.WeakKeyDictionary()  # CategoryMatrix -> маска исключенных строк
+
+    def __contains__(self, our_id):
+        return our_id in self.ids
+
+    def __bool__(self):
+        return bool(self.ids)
+
+    def mask(self, matrix: CategoryMatrix):
+        if not self.ids:
+            return None
+        mask = self.masks.get(matrix)
+        if mask is None:
+            mask = self.masks[matrix] = np.isin(matrix.ids, self.array)
+        return mask
+
+    @classmethod
+    def shared(cls, exc_mdls: list = None):
+        """
+        Возвращает исключенную номенклатуру для списка линеек. Результат хранится в памяти
+        процесса до изменения каталога.
+
+        exc_mdls    <-  Список id линеек, которые требуется исключить из подбора
+        """
+        exc_mdls = tuple(sorted(set(exc_mdls or list())))
+        if not exc_mdls:
+            return cls()
+        key = (CatalogVersionService.get(), exc_mdls)
+        with cls.shared_lock:
+            excluded = cls.shared_sets.get(key)
+            if excluded is None:
+                excluded = cls(OurEquipment.objects.filter(model__in=exc_mdls).values_list('id', flat=True))
+                cls.shared_sets[key] = excluded
+            cls.shared_sets.move_to_end(key)
+            while len(cls.shared_sets) > max(settings.SEARCH_INDEX_CACHE_SIZE, 1) * 4:
+                cls.shared_sets.popitem(last=False)
+        return excluded
+
+    @classmethod
+    def clear_shared(cls):
+        with cls.shared_lock:
+            cls.shared_sets.clear()
+
+
+class AnalogIndex:
+    """
+    Индекс номенклатуры для точных ступеней подбора аналогов.
+    Строится один раз на пересчет и заменяет запросы к базе данных по каждой
+    строке сметы поиском по словарям. Артикулы, наименования и поисковые ключи
+    сравниваются по нормализованным ключам (см. normalize_key).
+    Индекс не зависит от исключенных линеек: исключенная номенклатура (ExcludedEquipment)
+    отбрасывается при выдаче аналогов, поэтому запросы к базе данных ее не фильтруют.
+    """
+    shared_indexes = collections.OrderedDict()  # версия каталога -> индекс
+    shared_lock = threading.Lock()
+
+    def __init__(self, excluded: ExcludedEquipment = None):
+        self.excluded = excluded or ExcludedEquipment()
+        self.limit = settings.SEARCH_SIMILAR_LIMIT + 1  # первичный аналог и не более K вторичных
+        self.equipment = dict()     # id номенклатуры ИЕК -> объект OurEquipment
+        self.own_codes = dict()     # ключ артикула ИЕК -> id номенклатуры ИЕК
+        self.own_names = dict()     # ключ наименования ИЕК -> id номенклатуры ИЕК в порядке наименований
+        self.comp_codes = dict()    # ключ артикула конкурента -> id номенклатуры конкурента
+        self.comp_names = dict()    # ключ наименования конкурента -> id номенклатуры конкурента
+        self.comp_analogs = dict()  # id номенклатуры конкурента -> список id аналогов ИЕК
+        self.keywords = dict()      # ключ поискового ключа -> id аналогов ИЕК в порядке выдачи
+        self.trigrams = dict()      # наименование из сметы -> список пар [id аналога ИЕК, сходство в %]
+        self.properties = None      # индекс для поиска по совпадению характеристик
+
+    def excluding(self, excluded: ExcludedEquipment):
+        """
+        Возвращает индекс с теми же данными, выдающий аналоги без переданной номенклатуры
+        """
+        index = copy.copy(self)
+        index.excluded = excluded
+        # результаты нечеткого поиска зависят от исключенных линеек и не должны накапливаться в общем индексе
+        index.trigrams = dict()
+        return index
+
+    @staticmethod
+    def add_analog(analogs: dict, key, our_id: int):
+        # словарь вместо списка: порядок добавления сохраняется, повтор проверяется за O(1)
+        analogs.setdefault(key, dict()).setdefault(our_id)
+
+    def add_equipment(self, equipment):
+        for eq in equipment.select_related('unit').order_by('name', 'id'):
+            self.equipment[eq.id] = eq
+            self.own_codes.setdefault(eq.code_key, eq.id)
+            self.add_analog(self.own_names, eq.name_key, eq.id)
+
+    def add_keywords(self, kwds):
+        kwds = kwds.filter(our_equipment__isnull=False).order_by('our_equipment__name', 'our_equipment_id')
+        for keyword, our_id in kwds.values_list('keyword_key', 'our_equipment_id'):
+            self.add_analog(self.keywords, keyword, our_id)
+
+    def add_comp_analogs(self, comp_analogs):
+        """
+        Заполняет аналоги номенклатуры конкурентов из таблицы CompetitorAnalog
+        """
+        comp_analogs = dict(comp_analogs.values_list('comp_equipment_id', 'analogs'))
+        self.load_analogs(comp_analogs)
+        self.comp_analogs.update(comp_analogs)
+
+    @classmethod
+    def build(cls):
+        """
+        Загружает всю номенклатуру ИЕК, номенклатуру конкурентов и поисковые ключи
+        и возвращает заполненный индекс.
+        """
+        index = cls()
+
+        # порядок совпадает с порядком выдачи .first() в исходных запросах
+        index.add_equipment(OurEquipment.objects.all())
+        for comp_id, code, name in CompetitorsEquipment.objects.order_by('name', 'id').values_list(
+                'id', 'code_key', 'name_key'):
+            index.comp_codes.setdefault(code, comp_id)
+            index.comp_names.setdefault(name, comp_id)
+        index.add_comp_analogs(CompetitorAnalog.objects.all())
+        index.add_keywords(KeyWord.objects.all())
+        index.properties = PropertyIndex.build(OurEquipment.objects.all())
+        return index
+
+    @classmethod
+    def shared(cls, exc_mdls: list = None):
+        """
+        Возвращает полный индекс, общий для пересчетов в текущем процессе. Индекс строится
+        один раз на версию каталога; последние использованные индексы (не более
+        SEARCH_INDEX_CACHE_SIZE) хранятся в памяти до изменения каталога.
+
+        exc_mdls    <-  Список id линеек, которые требуется исключить из подбора
+        """
+        excluded = ExcludedEquipment.shared(exc_mdls)
+        key = CatalogVersionService.get()
+        with cls.shared_lock:
+            index = cls.shared_indexes.get(key)
+            if index is None:
+                index = cls.build()
+                cls.shared_indexes[key] = index
+            cls.shared_indexes.move_to_end(key)
+            while len(cls.shared_indexes) > max(settings.SEARCH_INDEX_CACHE_SIZE, 1):
+                cls.shared_indexes.popitem(last=False)
+        return index.excluding(excluded)
+
+    @classmethod
+    def clear_shared(cls):
+        with cls.shared_lock:
+            cls.shared_indexes.clear()
+
+    @classmethod
+    def for_rows(cls, rows: list, exc_mdls: list = None):
+        """
+        Пакетный режим: заполняет индекс только теми записями, которые нужны для строк сметы.
+        Каждая ступень поиска выполняется одним запросом IN (...) по всем еще не подобранным строкам,
+        поэтому кол-во запросов зависит от кол-ва ступеней, а не от кол-ва строк.
+
+        rows        <-  Массив строк сметы в виде списка словарей
+        exc_mdls    <-  Список id линеек, которые требуется исключить из подбора
+        """
+        index = cls(ExcludedEquipment.shared(exc_mdls))
+        pending = {(row.get('comp_code'), row.get('comp_name')) for row in rows}
+
+        def keys(pos: int):
+            return {normalize_key(key[pos]) for key in pending} - {None}
+
+        def cascade():
+            # на следующую ступень переходят только неподобранные строки
+            return {key for key in pending if index.lookup(*key)[0] is None}
+
+        # артикулы и наименования номенклатуры ИЕК
+        index.add_equipment(OurEquipment.objects.filter(code_key__in=keys(0)))
+        # наименования заполняются заново по полному списку совпадений: неполные списки по артикулам
+        # не должны участвовать в отборе строк для следующей ступени
+        index.own_names.clear()
+        pending = cascade()
+        index.add_equipment(OurEquipment.objects.filter(name_key__in=keys(1)))
+        pending = cascade()
+
+        # артикулы и наименования номенклатуры конкурентов
+        for pos, field, comp_keys in ((0, 'code_key', index.comp_codes), (1, 'name_key', index.comp_names)):
+            comp_equipment = CompetitorsEquipment.objects.filter(**{f'{field}__in': keys(pos)}).order_by('name', 'id')
+            for comp_id, key in comp_equipment.values_list('id', field):
+                comp_keys.setdefault(key, comp_id)
+            comp_ids = set(comp_keys.values()) - set(index.comp_analogs)
+            index.add_comp_analogs(CompetitorAnalog.objects.filter(comp_equipment_id__in=comp_ids))
+            pending = cascade()
+
+        # поисковые ключи по артикулу и наименованию
+        for pos in (0, 1):
+            index.add_keywords(KeyWord.objects.filter(keyword_key__in=keys(pos)))
+            index.load_analogs(index.keywords)
+            pending = cascade()
+
+        # нечеткий поиск одним запросом по всем неподобранным наименованиям
+        index.trigram_prefetch(name for _, name in pending)
+        pending = {key for key in pending if index.trigram_lookup(key[1])[0] is None}
+
+        words = {word for _, name in pending if isinstance(name, str) for word in name.split(' ')}
+        index.properties = PropertyIndex.build(OurEquipment.objects.all(), words)
+        return index
+
+    def load_analogs(self, analogs: dict):
+        """
+        Догружает объекты номенклатуры ИЕК, на которые ссылаются списки аналогов.
+        Из каждого списка берутся только первые self.limit неисключенных id - остальные не попадут в результат top
+        """
+        ids = {our_id for lst in analogs.values()
+               for our_id in itertools.islice((i for i in lst if i not in self.excluded), self.limit)}
+        ids -= set(self.equipment)
+        if ids:
+            for eq in OurEquipment.objects.filter(id__in=ids).select_related('unit'):
+                self.equipment[eq.id] = eq
+
+    def get_equipment(self, our_id: int):
+        """
+        Возвращает объект номенклатуры ИЕК по id, при необходимости догружая его из базы данных
+        """
+        if our_id not in self.equipment:
+            self.equipment[our_id] = OurEquipment.objects.select_related('unit').get(id=our_id)
+        return self.equipment[our_id]
+
+    def top(self, pairs):
+        """
+        Отбирает из упорядоченной последовательности пар [id, оценка] первые self.limit
+        неисключенных аналогов и возвращает первичный аналог и список вторичных
+        """
+        found = list(itertools.islice((pair for pair in pairs if pair[0] not in self.excluded), self.limit))
+        if not found:
+            return None, list()
+        return self.get_equipment(found[0][0]), found[1:]
+
+    def analogs(self, ids, score: int = 100):
+        """
+        Возвращает первичный аналог и не более K вторичных аналогов в виде пар [id, оценка]
+        """
+        return self.top([our_id, score] for our_id in ids or ())
+
+    def lookup(self, comp_code, comp_name):
+        """
+        Проходит точные ступени поиска в порядке их приоритета и возвращает три значения:
+        первичный аналог, список пар [id, оценка] вторичных аналогов и название флага ступени
+        в SearchProcessResult. В случае неудачного поиска возвращает None, пустой список и None.
+
+        comp_code   <-  Артикул конкурента из строки сметы
+        comp_name   <-  Наименование конкурента из строки сметы
+        """
+        comp_code = normalize_key(comp_code)
+        comp_name = normalize_key(comp_name)
+
+        # поиск среди артикулов и наименований номенклатуры ИЕК
+        if comp_code is not None and comp_code in self.own_codes:
+            anlg, _ = self.analogs([self.own_codes[comp_code]])
+            if anlg:
+                return anlg, list(), 'match_in_own_codes'
+        if comp_name is not None:
+            anlg, _ = self.analogs(self.own_names.get(comp_name))
+            if anlg:
+                return anlg, list(), 'match_in_own_names'
+
+        # поиск среди артикулов и наименований номенклатуры конкурентов
+        for key, keys, flag in ((comp_code, self.comp_codes, 'match_in_comp_codes'),
+                                (comp_name, self.comp_names, 'match_in_comp_names')):
+            if key is not None and key in keys:
+                anlg, similar = self.analogs(self.comp_analogs.get(keys[key]))
+                if anlg:
+                    return anlg, similar, flag
+
+        # поиск среди ключей по артикулу и по наименованию
+        for key in (comp_code, comp_name):
+            if key is not None:
+                anlg, similar = self.analogs(self.keywords.get(key))
+                if anlg:
+                    return anlg, similar, 'match_in_keys'
+
+        return None, list(), None
+
+    def property_search(self, comp_name, psp: int):
+        """
+        Поиск по совпадению характеристик без исключенной номенклатуры. Возвращает первичный
+        аналог и не более K вторичных аналогов в виде пар [id, процент совпадения].
+        """
+        found = self.properties.search(comp_name, psp, self.limit, self.excluded)
+        if not found:
+            return None, list()
+        return self.get_equipment(found[0][0]), found[1:]
+
+    @staticmethod
+    def trigram_query(names: list, limit: int, excluded: ExcludedEquipment = None):
+        """
+        Возвращает SQL и параметры запроса нечеткого поиска сразу для списка наименований из сметы:
+        для каждого наименования - не более limit строк (наименование, id аналога ИЕК, сходство)
+        по наименованиям ИЕК, наименованиям конкурентов и поисковым ключам в порядке убывания сходства.
+        Оператор % отбирает строки по GIN индексу с порогом pg_trgm.similarity_threshold, который задается
+        при подключении к базе данных. Исключенная номенклатура передается одним массивом и отбрасывается до LIMIT.
+        """
+        qn = connection.ops.quote_name
+        equipment = qn(OurEquipment._meta.db_table)
+        comp_equipment = qn(CompetitorsEquipment._meta.db_table)
+        keywords = qn(KeyWord._meta.db_table)
+        sql = f"""
+            SELECT n.comp_name, found.our_id, found.similarity
+            FROM unnest(%s::text[]) AS n(comp_name)
+            CROSS JOIN LATERAL (
+                SELECT our_id, similarity FROM (
+                    SELECT eq.id AS our_id, similarity(eq.name, n.comp_name) AS similarity
+                    FROM {equipment} eq
+                    WHERE eq.name %% n.comp_name
+                    UNION ALL
+                    SELECT kw.our_equipment_id, similarity(ce.name, n.comp_name)
+                    FROM {keywords} kw JOIN {comp_equipment} ce ON ce.id = kw.comp_equipment_id
+                    WHERE kw.our_equipment_id IS NOT NULL AND ce.name %% n.comp_name
+                    UNION ALL
+                    SELECT kw.our_equipment_id, similarity(kw.keyword, n.comp_name)
+                    FROM {keywords} kw
+                    WHERE kw.our_equipment_id IS NOT NULL AND kw.keyword %% n.comp_name
+                ) candidates
+                WHERE similarity >= %s AND our_id <> ALL(%s::integer[])
+                ORDER BY similarity DESC, our_id
+                LIMIT %s
+            ) found
+            ORDER BY n.comp_name, found.similarity DESC, found.our_id
+        """
+        ids = sorted(excluded.ids) if excluded else list()
+        return sql, [list(names), settings.SEARCH_TRIGRAM_THRESHOLD, ids, limit]
+
+    def trigram_prefetch(self, names):
+        """
+        Выполняет нечеткий поиск одним запросом для всех переданных наименований, которых еще нет
+        в индексе пересчета. Для наименований без совпадений запоминается пустой список.
+
+        names   <-  Наименования конкурентов из строк сметы
+        """
+        if not settings.SEARCH_TRIGRAM_ENABLED:
+            return
+        found = {name: dict() for name in names
+                 if isinstance(name, str) and name.strip() and name not in self.trigrams}
+        if not found:
+            return
+        # запас на аналоги, найденные в нескольких источниках
+        sql, params = self.trigram_query(sorted(found), self.limit * 4, self.excluded)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            for comp_name, our_id, similarity in cursor.fetchall():
+                found[comp_name].setdefault(our_id, round(similarity * 100))
+        self.load_analogs(found)
+        for comp_name, analogs in found.items():
+            self.trigrams[comp_name] = [[our_id, score] for our_id, score in analogs.items()]
+
+    def trigram_lookup(self, comp_name):
+        """
+        Нечеткий поиск наименования по триграммам (pg_trgm) среди наименований номенклатуры ИЕК,
+        наименований номенклатуры конкурентов и поисковых ключей. Выполняется после точных ступеней;
+        найденные аналоги упорядочены по убыванию сходства и запоминаются в индексе текущего пересчета
+        (в пакетном режиме - заранее, одним запросом для всех неподобранных строк).
+        Возвращает первичный аналог и не более K вторичных аналогов в виде пар [id, сходство в %].
+
+        comp_name   <-  Наименование конкурента из строки сметы
+        """
+        if not settings.SEARCH_TRIGRAM_ENABLED or not isinstance(comp_name, str) or not comp_name.strip():
+            return None, list()
+        if comp_name not in self.trigrams:
+            self.trigram_prefetch([comp_name])
+        return self.top(self.trigrams[comp_name])
+
+
+CatalogVersionService.subscribe(AnalogIndex.clear_shared)
+CatalogVersionService.subscribe(ExcludedEquipment.clear_shared)
@@ -0,0 +1,77 @@
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from openpyxl import Workbook
+
+from searching import document_styles
+from searching.services import SearchService
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает скорость заполнения файла пересчета (строк в секунду): назначение объектов стиля ' \
+           'каждой ячейке, именованные стили в обычной книге и SearchService.get_file (write-only)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000, help='Кол-во строк пересчета')
+        parser.add_argument('--repeat', type=int, default=3, help='Кол-во повторов, берется лучшее время')
+
+    def handle(self, *args, **options):
+        rows = [{
+            'comp_code': f'2CDS{i:08d}',
+            'comp_name': f'Автоматический выключатель {i} 1P C16',
+            'code': f'MVA20-1-{i % 64:03d}-C',
+            'name': f'ВА47-29 1P {i % 64}А',
+        } for i in range(options['rows'])]
+        for title, func in (('Объекты стиля в каждой ячейке', self.cell_styles),
+                            ('Именованные стили', self.named_styles),
+                            ('SearchService.get_file (write-only)', self.write_only)):
+            best = None
+            for _ in range(options['repeat']):
+                start = time.perf_counter()
+                func(rows)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            self.stdout.write(f'{title}: {len(rows) / best:.0f} строк/с ({best:.2f} с)')
+
+    @staticmethod
+    def fill_rows(ws, rows: list, apply_style):
+        for row_num, data_row in enumerate(rows, 8):
+            for col, (width, title, title_style, cell_style, key) in enumerate(SearchService.file_columns, 1):
+                cell = ws.cell(row_num, col)
+                apply_style(cell, cell_style)
+                cell.value = data_row[key] if key else str(row_num - 7)
+
+    @staticmethod
+    def save(wb):
+        with tempfile.TemporaryFile() as f:
+            wb.save(f)
+
+    def cell_styles(self, rows: list):
+        """
+        Прежний способ: шрифт, заливка, граница и выравнивание назначаются каждой ячейке отдельно
+        """
+        def apply_style(cell, name):
+            font, fill, border, alignment = document_styles.named_styles[name]
+            cell.font = font
+            cell.fill = fill
+            cell.border = border
+            cell.alignment = alignment
+
+        wb = Workbook()
+        self.fill_rows(wb.active, rows, apply_style)
+        self.save(wb)
+
+    def named_styles(self, rows: list):
+        def apply_style(cell, name):
+            cell.style = name
+
+        wb = Workbook()
+        document_styles.add_named_styles(wb)
+        self.fill_rows(wb.active, rows, apply_style)
+        self.save(wb)
+
+    @staticmethod
+    def write_only(rows: list):
+        SearchService.get_file(rows).close()
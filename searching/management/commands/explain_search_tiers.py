@@ -0,0 +1,155 @@
+import random
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from searching.catalog import CompetitorAnalogService
+from searching.indexes import AnalogIndex
+from searching.models import Competitor
+from searching.models import CompetitorAnalog
+from searching.models import CompetitorsEquipment
+from searching.models import EquipmentCategory
+from searching.models import EquipmentCategoryProperty
+from searching.models import EquipmentCategoryPropertyValue
+from searching.models import KeyWord
+from searching.models import OurEquipment
+from searching.models import OurEquipmentProperty
+from searching.utils import normalize_key
+
+
+class Command(BaseCommand):
+    help = 'Выводит планы выполнения (EXPLAIN) запросов каждой ступени подбора аналогов на синтетическом каталоге. ' \
+           'Каталог создается в транзакции, которая откатывается после вывода планов.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--equipment', type=int, default=20000, help='Кол-во номенклатуры ИЕК')
+        parser.add_argument('--competitors', type=int, default=20000, help='Кол-во номенклатуры конкурентов')
+        parser.add_argument('--keywords', type=int, default=40000, help='Кол-во поисковых ключей')
+        parser.add_argument('--categories', type=int, default=20, help='Кол-во категорий')
+        parser.add_argument('--properties', type=int, default=5, help='Кол-во характеристик в категории')
+        parser.add_argument('--values', type=int, default=10, help='Кол-во значений у характеристики')
+        parser.add_argument('--rows', type=int, default=500, help='Кол-во строк сметы в одном запросе ступени')
+        parser.add_argument('--analyze', action='store_true', help='Выполнить запросы (EXPLAIN ANALYZE)')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Планы запросов строятся только для PostgreSQL')
+        rnd = random.Random(0)
+        with transaction.atomic():
+            sample = self.create_catalog(rnd, options)
+            with connection.cursor() as cursor:
+                for model in (EquipmentCategoryPropertyValue, OurEquipment, OurEquipmentProperty,
+                              CompetitorsEquipment, CompetitorAnalog, KeyWord):
+                    cursor.execute(f'ANALYZE {model._meta.db_table}')
+            for title, query in self.tier_queries(sample):
+                self.stdout.write(self.style.MIGRATE_HEADING(title))
+                self.stdout.write(self.explain(query, options['analyze']))
+                self.stdout.write('')
+            transaction.set_rollback(True)
+
+    @staticmethod
+    def explain(query, analyze: bool):
+        """
+        Возвращает план запроса ступени: QuerySet или пары (SQL, параметры) для запросов без ORM
+        """
+        if not isinstance(query, tuple):
+            return query.explain(analyze=analyze)
+        sql, params = query
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN {"ANALYZE " if analyze else ""}{sql}', params)
+            return '\n'.join(row[0] for row in cursor.fetchall())
+
+    @staticmethod
+    def create_catalog(rnd: random.Random, options: dict):
+        """
+        Создает синтетический каталог и возвращает выборку ключей, которые могли бы прийти в смете
+        """
+        prefix = f'explain-{uuid.uuid4().hex[:8]}'
+        categories = EquipmentCategory.objects.bulk_create(
+            EquipmentCategory(name=f'{prefix} категория {i}') for i in range(options['categories']))
+        properties = EquipmentCategoryProperty.objects.bulk_create(
+            EquipmentCategoryProperty(category=category, name=f'Характеристика {j}')
+            for category in categories for j in range(options['properties']))
+        values = EquipmentCategoryPropertyValue.objects.bulk_create(
+            EquipmentCategoryPropertyValue(property=prop, value=f'{prop.category_id}-{prop.id}-{k}')
+            for prop in properties for k in range(options['values']))
+        by_property = dict()  # id характеристики -> список значений
+        for value in values:
+            by_property.setdefault(value.property_id, list()).append(value)
+        props = dict()  # id категории -> списки значений по характеристикам
+        for prop in properties:
+            props.setdefault(prop.category_id, list()).append(by_property[prop.id])
+
+        equipment = list()
+        for i in range(options['equipment']):
+            category = categories[i % len(categories)]
+            name = f'Синтетический автомат {i} ' + ' '.join(
+                rnd.choice(lst).value for lst in props[category.id])
+            code = f'{prefix}-{i:07d}'
+            equipment.append(OurEquipment(category=category, code=code, name=name[:250],
+                                          code_key=normalize_key(code), name_key=normalize_key(name[:250])))
+        equipment = OurEquipment.objects.bulk_create(equipment, batch_size=5000)
+        OurEquipmentProperty.objects.bulk_create(
+            (OurEquipmentProperty(equipment=eq, property_id=lst[0].property_id, value=rnd.choice(lst))
+             for eq in equipment for lst in props[eq.category_id]), batch_size=5000)
+
+        competitor = Competitor.objects.create(name=f'{prefix} конкурент')
+        comp_equipment = list()
+        for i in range(options['competitors']):
+            code = f'{prefix}-c{i:07d}'
+            name = f'Аналог конкурента {i}'
+            comp_equipment.append(CompetitorsEquipment(competitor=competitor, code=code, name=name,
+                                                       code_key=normalize_key(code), name_key=normalize_key(name)))
+        comp_equipment = CompetitorsEquipment.objects.bulk_create(comp_equipment, batch_size=5000)
+        keywords = list()
+        for i in range(options['keywords']):
+            keyword = f'{prefix}-k{i:07d}'
+            keywords.append(KeyWord(keyword=keyword, keyword_key=normalize_key(keyword),
+                                    our_equipment=rnd.choice(equipment), comp_equipment=rnd.choice(comp_equipment)))
+        keywords = KeyWord.objects.bulk_create(keywords, batch_size=5000)
+        CompetitorAnalogService.rebuild({eq.id for eq in comp_equipment})
+
+        rows = options['rows']
+        picked_equipment = rnd.sample(equipment, min(rows, len(equipment)))
+        picked_comp = rnd.sample(comp_equipment, min(rows, len(comp_equipment)))
+        return {
+            'codes': [eq.code_key for eq in picked_equipment] + [eq.code_key for eq in picked_comp],
+            'names': [eq.name_key for eq in picked_equipment] + [eq.name_key for eq in picked_comp],
+            'comp_ids': [eq.id for eq in picked_comp],
+            'keywords': [kw.keyword_key for kw in rnd.sample(keywords, min(rows, len(keywords)))],
+            'words': {word for eq in picked_equipment for word in eq.name.split(' ')},
+            # наименования с опечаткой, которые не находятся точными ступенями
+            'fuzzy_names': [f'{eq.name}ы' for eq in picked_comp],
+            'category_id': categories[0].id,
+        }
+
+    @staticmethod
+    def tier_queries(sample: dict):
+        """
+        Возвращает запросы ступеней подбора в том виде, в котором их выполняет AnalogIndex
+        """
+        linked = KeyWord.objects.filter(our_equipment__isnull=False)
+        category_id = sample['category_id']
+        return (
+            ('Артикулы ИЕК', OurEquipment.objects.filter(code_key__in=sample['codes'])),
+            ('Наименования ИЕК', OurEquipment.objects.filter(name_key__in=sample['names'])),
+            ('Артикулы конкурентов', CompetitorsEquipment.objects.filter(code_key__in=sample['codes']).order_by(
+                'name', 'id').values_list('id', 'code_key')),
+            ('Наименования конкурентов', CompetitorsEquipment.objects.filter(name_key__in=sample['names']).order_by(
+                'name', 'id').values_list('id', 'name_key')),
+            ('Аналоги номенклатуры конкурентов', CompetitorAnalog.objects.filter(
+                comp_equipment_id__in=sample['comp_ids']).values_list('comp_equipment_id', 'analogs')),
+            ('Поисковые ключи', linked.filter(keyword_key__in=sample['keywords']).order_by(
+                'our_equipment__name', 'our_equipment_id').values_list('keyword_key', 'our_equipment_id')),
+            ('Нечеткий поиск по наименованиям', AnalogIndex.trigram_query(
+                sample['fuzzy_names'], (settings.SEARCH_SIMILAR_LIMIT + 1) * 4)),
+            ('Значения характеристик', EquipmentCategoryPropertyValue.objects.filter(
+                value__in=sample['words']).values_list('id', 'value', 'property__category_id')),
+            ('Номенклатура категории', OurEquipment.objects.filter(category_id=category_id).order_by(
+                'name', 'id').values_list('id', flat=True)),
+            ('Характеристики номенклатуры категории', OurEquipmentProperty.objects.filter(
+                equipment__category_id=category_id, value__property__category_id=category_id).values_list(
+                'equipment_id', 'value_id')),
+        )
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from searching.catalog import CatalogVersionService
+from searching.catalog import CompetitorAnalogService
+from searching.models import CompetitorAnalog
+
+
+class Command(BaseCommand):
+    help = 'Полностью перестраивает таблицу соответствий номенклатуры конкурентов аналогам ИЕК'
+
+    def handle(self, *args, **options):
+        CompetitorAnalogService.rebuild()
+        CatalogVersionService.bump()
+        self.stdout.write(f'Соответствий: {CompetitorAnalog.objects.count()}')
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from searching.artifacts import ArtifactService
+from searching.services import SearchResultService
+
+
+class Command(BaseCommand):
+    help = 'Удаляет просроченные временные файлы (выгрузки данных, загруженные сметы) и устаревшие ' \
+           'результаты пересчета. Выполняется периодически задачей searching.tasks.sweep_artifacts'
+
+    def handle(self, *args, **options):
+        removed = ArtifactService.sweep() + SearchResultService.sweep()
+        self.stdout.write(f'Удалено временных файлов: {removed}')
@@ -0,0 +1,33 @@
+# Generated by Django 3.2 on 2026-10-18 08:54
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('searching', '0002_catalogversion'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='searchprocessresult',
+            name='match_by_trigram',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='competitorsequipment',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['name'], name='compequipment_name_trgm', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='keyword',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['keyword'], name='keyword_keyword_trgm', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='ourequipment',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['name'], name='ourequipment_name_trgm', opclasses=['gin_trgm_ops']),
+        ),
+    ]
@@ -0,0 +1,99 @@
+# Generated by Django 3.2 on 2026-10-18 08:56
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+# копия правил searching.utils.normalize_key на момент миграции: ключи, заполненные миграцией,
+# не должны зависеть от последующих изменений правил нормализации
+LOOKALIKES = str.maketrans({
+    'а': 'a', 'в': 'b', 'е': 'e', 'ё': 'e', 'к': 'k', 'м': 'm', 'н': 'h', 'о': 'o', 'р': 'p', 'с': 'c',
+    'т': 't', 'у': 'y', 'х': 'x', '‐': '-', '‑': '-', '–': '-', '—': '-',
+})
+
+
+def normalize_key(value):
+    if value is None:
+        return None
+    key = ''.join(str(value).casefold().translate(LOOKALIKES).split())
+    return key or None
+
+
+def fill_normalized_keys(apps, schema_editor):
+    for model_name, keys in (('OurEquipment', {'code_key': 'code', 'name_key': 'name'}),
+                             ('CompetitorsEquipment', {'code_key': 'code', 'name_key': 'name'}),
+                             ('KeyWord', {'keyword_key': 'keyword'})):
+        model = apps.get_model('searching', model_name)
+        objs = list()
+        for obj in model.objects.only('id', *keys.values()).iterator():
+            for key_field, field in keys.items():
+                setattr(obj, key_field, normalize_key(getattr(obj, field)) or '')
+            objs.append(obj)
+        model.objects.bulk_update(objs, list(keys), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('searching', '0003_trigram'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='competitorsequipment',
+            name='code_key',
+            field=models.CharField(blank=True, default='', editable=False, max_length=250),
+        ),
+        migrations.AddField(
+            model_name='competitorsequipment',
+            name='name_key',
+            field=models.CharField(blank=True, default='', editable=False, max_length=250),
+        ),
+        migrations.AddField(
+            model_name='keyword',
+            name='keyword_key',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.AddField(
+            model_name='ourequipment',
+            name='code_key',
+            field=models.CharField(blank=True, default='', editable=False, max_length=250),
+        ),
+        migrations.AddField(
+            model_name='ourequipment',
+            name='name_key',
+            field=models.CharField(blank=True, default='', editable=False, max_length=250),
+        ),
+        migrations.RunPython(fill_normalized_keys, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='competitorsequipment',
+            index=models.Index(fields=['code_key'], name='compequipment_code_key'),
+        ),
+        migrations.AddIndex(
+            model_name='competitorsequipment',
+            index=models.Index(fields=['name_key'], name='compequipment_name_key'),
+        ),
+        migrations.AddIndex(
+            model_name='equipmentcategorypropertyvalue',
+            index=models.Index(fields=['value'], name='categorypropertyvalue_value'),
+        ),
+        migrations.AddIndex(
+            model_name='keyword',
+            index=django.contrib.postgres.indexes.HashIndex(condition=models.Q(our_equipment__isnull=False), fields=['keyword_key'], name='keyword_key_linked'),
+        ),
+        migrations.AddIndex(
+            model_name='keyword',
+            index=models.Index(condition=models.Q(our_equipment__isnull=False), fields=['comp_equipment', 'our_equipment'], name='keyword_comp_analogs'),
+        ),
+        migrations.AddIndex(
+            model_name='ourequipment',
+            index=models.Index(fields=['code_key'], name='ourequipment_code_key'),
+        ),
+        migrations.AddIndex(
+            model_name='ourequipment',
+            index=models.Index(fields=['name_key'], name='ourequipment_name_key'),
+        ),
+        migrations.AddIndex(
+            model_name='ourequipment',
+            index=models.Index(fields=['category', 'name', 'id'], name='ourequipment_category_name'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.2 on 2026-10-18 09:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_competitor_analogs(apps, schema_editor):
+    KeyWord = apps.get_model('searching', 'KeyWord')
+    CompetitorAnalog = apps.get_model('searching', 'CompetitorAnalog')
+    analogs = dict()
+    kwds = KeyWord.objects.filter(comp_equipment__isnull=False, our_equipment__isnull=False)
+    for comp_id, our_id in kwds.order_by('our_equipment__name', 'our_equipment_id').values_list(
+            'comp_equipment_id', 'our_equipment_id'):
+        lst = analogs.setdefault(comp_id, list())
+        if our_id not in lst:
+            lst.append(our_id)
+    CompetitorAnalog.objects.bulk_create(
+        (CompetitorAnalog(comp_equipment_id=comp_id, analogs=lst) for comp_id, lst in analogs.items()),
+        batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('searching', '0004_normalized_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompetitorAnalog',
+            fields=[
+                ('comp_equipment', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='analog_map', serialize=False, to='searching.competitorsequipment')),
+                ('analogs', models.JSONField(default=list)),
+            ],
+        ),
+        migrations.RunPython(fill_competitor_analogs, migrations.RunPython.noop),
+    ]
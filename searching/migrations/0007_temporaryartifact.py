@@ -0,0 +1,23 @@
+# Generated by Django 3.2 on 2026-10-18 09:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('searching', '0006_competitoranalog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TemporaryArtifact',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=500, unique=True)),
+                ('name', models.CharField(blank=True, max_length=250)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('expires', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
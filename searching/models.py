@@ -1,9 +1,28 @@
 import os
 
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.indexes import HashIndex
 from django.db import models
 from django.utils import timezone
 from django.contrib.auth import get_user_model
 
+from .utils import normalize_key
+
+
+class NormalizedKeysMixin:
+    """
+    Заполняет при сохранении столбцы нормализованных ключей, по которым выполняются
+    точные ступени подбора аналогов.
+    """
+    normalized_keys = dict()  # столбец ключа -> исходный столбец
+
+    def save(self, *args, **kwargs):
+        for key_field, field in self.normalized_keys.items():
+            setattr(self, key_field, normalize_key(getattr(self, field)) or '')
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], *self.normalized_keys}
+        super().save(*args, **kwargs)
+
 
 class EquipmentCategory(models.Model):
     """
@@ -31,6 +50,9 @@ class EquipmentCategoryPropertyValue(models.Model):
 
     class Meta:
         ordering = ['property']
+        indexes = [
+            models.Index(fields=['value'], name='categorypropertyvalue_value'),
+        ]
 
 
 class OurEquipmentProperty(models.Model):
@@ -74,7 +96,7 @@ class EquipmentUnit(models.Model):
     name = models.CharField(max_length=30)
 
 
-class OurEquipment(models.Model):
+class OurEquipment(NormalizedKeysMixin, models.Model):
     """
     Оборудование ITK/IEK.
     """
@@ -85,6 +107,8 @@ class OurEquipment(models.Model):
     unit = models.ForeignKey('searching.EquipmentUnit', on_delete=models.SET_NULL, null=True, default=None)
     name = models.CharField(max_length=250)
     code = models.CharField(max_length=250, unique=True, db_index=True)
+    code_key = models.CharField(max_length=250, blank=True, default='', editable=False)
+    name_key = models.CharField(max_length=250, blank=True, default='', editable=False)
     cost = models.DecimalField(decimal_places=2, max_digits=9, blank=True, default=0)
     count = models.IntegerField(default=0, blank=True)
     comment = models.TextField(default='', null=True)
@@ -92,8 +116,16 @@ class OurEquipment(models.Model):
     is_not_actual = models.BooleanField(default=False)
     promotion_description = models.TextField(default='', null=True, blank=True)
 
+    normalized_keys = {'code_key': 'code', 'name_key': 'name'}
+
     class Meta:
         ordering = ['name']
+        indexes = [
+            GinIndex(fields=['name'], name='ourequipment_name_trgm', opclasses=['gin_trgm_ops']),
+            models.Index(fields=['code_key'], name='ourequipment_code_key'),
+            models.Index(fields=['name_key'], name='ourequipment_name_key'),
+            models.Index(fields=['category', 'name', 'id'], name='ourequipment_category_name'),
+        ]
 
 
 class OurEquipmentImage(models.Model):
@@ -118,7 +150,7 @@ class Competitor(models.Model):
         ordering = ['name']
 
 
-class CompetitorsEquipment(models.Model):
+class CompetitorsEquipment(NormalizedKeysMixin, models.Model):
     """
     Оборудование конкурента
     """
@@ -129,13 +161,22 @@ class CompetitorsEquipment(models.Model):
     unit = models.ForeignKey('searching.EquipmentUnit', on_delete=models.SET_NULL, null=True, default=None, blank=True)
     name = models.CharField(max_length=250, blank=True)
     code = models.CharField(max_length=250, blank=True)
+    code_key = models.CharField(max_length=250, blank=True, default='', editable=False)
+    name_key = models.CharField(max_length=250, blank=True, default='', editable=False)
+
+    normalized_keys = {'code_key': 'code', 'name_key': 'name'}
 
     class Meta:
         ordering = ['name']
         unique_together = ['competitor', 'code']
+        indexes = [
+            GinIndex(fields=['name'], name='compequipment_name_trgm', opclasses=['gin_trgm_ops']),
+            models.Index(fields=['code_key'], name='compequipment_code_key'),
+            models.Index(fields=['name_key'], name='compequipment_name_key'),
+        ]
 
 
-class KeyWord(models.Model):
+class KeyWord(NormalizedKeysMixin, models.Model):
     """
     Поисковой ключ
     """
@@ -145,9 +186,40 @@ class KeyWord(models.Model):
     comp_equipment = models.ForeignKey('searching.CompetitorsEquipment', related_name="keywords",
                                        on_delete=models.SET_NULL, null=True, default=None)
     is_approved = models.BooleanField(default=False)
+    keyword_key = models.TextField(blank=True, default='', editable=False)
+
+    normalized_keys = {'keyword_key': 'keyword'}
 
     class Meta:
         ordering = ['keyword']
+        indexes = [
+            GinIndex(fields=['keyword'], name='keyword_keyword_trgm', opclasses=['gin_trgm_ops']),
+            # ступени поиска используют только ключи, привязанные к номенклатуре ИЕК
+            HashIndex(fields=['keyword_key'], name='keyword_key_linked',
+                      condition=models.Q(our_equipment__isnull=False)),
+            models.Index(fields=['comp_equipment', 'our_equipment'], name='keyword_comp_analogs',
+                         condition=models.Q(our_equipment__isnull=False)),
+        ]
+
+
+class CompetitorAnalog(models.Model):
+    """
+    Материализованное соответствие номенклатуры конкурента аналогам ИЕК из поисковых ключей.
+    Хранит id аналогов в порядке выдачи (по наименованию аналога), перестраивается
+    CompetitorAnalogService при изменении ключей и номенклатуры.
+    """
+    comp_equipment = models.OneToOneField('searching.CompetitorsEquipment', on_delete=models.CASCADE,
+                                          primary_key=True, related_name='analog_map')
+    analogs = models.JSONField(default=list)
+
+
+class CatalogVersion(models.Model):
+    """
+    Версия каталога номенклатуры. Повышается при изменении данных, влияющих на подбор аналогов,
+    и входит в ключ кеша результатов подбора.
+    """
+    version = models.BigIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
 
 
 class SearchProcess(models.Model):
@@ -169,20 +241,20 @@ class SearchProcess(models.Model):
         self.end = timezone.localtime(timezone.now())
         self.is_active = False
         self.is_success = True
-        self.save()
+        self.save(update_fields=('end', 'is_active', 'is_success',))
 
     def error(self, detail: str = ''):
         self.end = timezone.localtime(timezone.now())
         self.is_active = False
         self.is_error = True
         self.error_detail = detail
-        self.save()
+        self.save(update_fields=('end', 'is_active', 'is_error', 'error_detail',))
 
     def interrupt(self):
         self.end = timezone.localtime(timezone.now())
         self.is_active = False
         self.is_interrupted = True
-        self.save()
+        self.save(update_fields=('end', 'is_active', 'is_interrupted',))
 
     def remtime(self):
         """
@@ -208,7 +280,19 @@ class SearchProcessResult(models.Model):
     match_in_comp_codes = models.BooleanField(default=False)
     match_in_comp_names = models.BooleanField(default=False)
     match_in_keys = models.BooleanField(default=False)
+    match_by_trigram = models.BooleanField(default=False)
     match_by_properties = models.BooleanField(default=False)
 
     class Meta:
         ordering = ['id']
+
+
+class TemporaryArtifact(models.Model):
+    """
+    Временный файл на сервере (выгрузка данных, загруженная смета). Запись создается до записи файла на диск,
+    поэтому файл, который не был отправлен и удален, удаляет периодическая очистка после expires.
+    """
+    path = models.CharField(max_length=500, unique=True)
+    name = models.CharField(max_length=250, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    expires = models.DateTimeField(db_index=True)
@@ -1,12 +1,30 @@
 from rest_framework import serializers
 
+from searching.models import SearchProcess
+from searching.services import SearchService
+
 
 
 
 class SearchRequestSerializer(serializers.Serializer):
     psp = serializers.IntegerField(default=80, required=False, write_only=True)
-    ex_mdls = serializers.ListSerializer(default=list(), required=False, write_only=True)
-    rows = serializers.ListSerializer(required=True, write_only=True)
+    ex_mdls = serializers.ListField(child=serializers.IntegerField(), default=list, required=False, write_only=True)
+    rows = serializers.ListField(child=serializers.DictField(), required=True, write_only=True)
+
+
+class SearchFileRequestSerializer(serializers.Serializer):
+    psp = serializers.IntegerField(default=80, required=False, write_only=True)
+    ex_mdls = serializers.ListField(child=serializers.IntegerField(), default=list, required=False, write_only=True)
+    file = serializers.FileField(required=True, write_only=True, error_messages={'required': 'Выберите файл сметы'})
+
 
+class SearchProcessStatusSerializer(serializers.ModelSerializer):
+    status = serializers.SerializerMethodField()
 
+    class Meta:
+        model = SearchProcess
+        fields = ('id', 'status', 'start', 'end', 'psp', 'is_active', 'is_success', 'is_error', 'is_interrupted',
+                  'rows_count', 'match_rows_count', 'unmatch_rows_count', 'skip_rows_count', 'error_detail',)
 
+    def get_status(self, obj):
+        return SearchService.get_status(obj)
@@ -1,7 +1,15 @@
 import pandas as pd
-import collections
+import billiard
+import django
+import gzip
+import hashlib
 import os
-import threading
+import tempfile
+import time
+
+from billiard.exceptions import TimeoutError as PoolTimeoutError
+
+import redis
 
 from asgiref.sync import async_to_sync
 from application_info.services import LogService
@@ -9,19 +17,26 @@ from channels.layers import get_channel_layer
 
 from rest_framework.utils import json, encoders
 
+from django.apps import apps
 from django.core.files import File
-from django.db import transaction, IntegrityError
-from django.db.models import Count, Q, F, Value, IntegerField
+from django.db import connections, transaction, IntegrityError
 from django.conf import settings
 from django.http.response import FileResponse
 from django.utils import timezone
 from django.utils.encoding import escape_uri_path
 
 from . import document_styles
+from .artifacts import ArtifactService
+from .catalog import CatalogVersionService
 from .exceptions import Interrupt
 from .exceptions import InvalidUploadingData
 from .exceptions import MultiEquipCategoryDownload
+from .exceptions import RowsLimitExceeded
+from .exceptions import SearchNotFinished
+from .exceptions import SearchResultNotFound
+from .indexes import AnalogIndex
 from .models import SearchProcess
+from .models import SearchProcessResult
 from .models import EquipmentCategory
 from .models import OurEquipment
 from .models import OurEquipmentProperty
@@ -32,22 +47,22 @@ from .models import KeyWord
 from .models import EquipmentCategoryPropertyValue
 from .models import EquipmentCategoryProperty
 from .models import OurEquipmentImage
+from .utils import normalize_key
 
 from urllib.request import urlretrieve, urlcleanup
 from urllib.error import URLError
+from zipfile import BadZipFile
 
 from openpyxl import Workbook
+from openpyxl import load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import get_column_letter
+from openpyxl.utils.exceptions import InvalidFileException
 from openpyxl.drawing.image import Image
 
 
 class SearchService:
 
-    @staticmethod
-    def check_interrupt(prc):
-        prc.refresh_from_db()
-        if prc.is_interrupted:
-            raise Interrupt
-
     @staticmethod
     def remtime_str(sec: int):
         """
@@ -64,47 +79,182 @@ class SearchService:
         return "%02dч. %02dм. %02dс." % (h, m, s)
 
     @staticmethod
-    def process_log(proc: SearchProcess, log: str, rt: str):
+    def process_log(proc: SearchProcess, logs: list, rt: str):
         """
-        Отправляет переданную строку состояния процесса в сокет соответствующего процесса.
+        Отправляет накопленные строки состояния процесса и текущие счетчики
+        одним сообщением в сокет соответствующего процесса.
 
         proc        <-  Объект процесса пересчета
-        log         <-  Строка лога
-        rem_count   <-  Строка лога
+        logs        <-  Список строк лога
+        rt          <-  Строка оставшегося времени
         """
         cl = get_channel_layer()
-        message = json.dumps({'log': log, 'rt': rt}, cls=encoders.JSONEncoder, ensure_ascii=False)
+        message = json.dumps({
+            'id': proc.id,
+            'log': '\n'.join(logs),
+            'logs': logs,
+            'rt': rt,
+            'rows_count': proc.rows_count,
+            'match_rows_count': proc.match_rows_count,
+            'unmatch_rows_count': proc.unmatch_rows_count,
+            'skip_rows_count': proc.skip_rows_count,
+        }, cls=encoders.JSONEncoder, ensure_ascii=False)
         async_to_sync(cl.group_send)(f"search-progress-{proc.user_id}", {"type": "search_progress", "message": message})
 
+    # лист сметы, номер строки заголовка и соответствие полей строки столбцам листа
+    estimate_sheet = 'Спецификация'
+    estimate_header_row = 7
+    estimate_columns = {
+        'comp_code': 'Артикул',
+        'comp_name': 'Наименование/описание',
+        'comp_unit': 'Ед. изм.',
+        'comp_count': 'Кол-во',
+        'our_code': 'Артикул ITK/IEK',
+        'our_name': 'Наименование ITK/IEK',
+        'our_unit': 'Ед. изм.. 1',
+        'our_count': 'Кол-во. 1',
+        'our_cost': 'Цена с НДС, руб.',
+        'our_cost_amount': 'Сумма с НДС, руб.',
+        'comment': 'Комментарии',
+        'availability_status': 'Статус наличия',
+        'promotion': 'Акция',
+    }
+
     @staticmethod
-    def get_prepare_data(f):
+    def check_rows_available(user, rows_count: int):
         """
-        Читает файл .xlsx и выдает информацию о нем в виде списка объектов словаря.
+        Проверяет, что пользователю доступно кол-во строк для пересчета
 
-        f   <-  Файл таблицы в формате .xls/.xlsx
+        user        <-  Пользователь, запустивший пересчет
+        rows_count  <-  Кол-во строк сметы
         """
-        df = pd.read_excel(f, 'Спецификация', skiprows=6)
-        for row_index, row in df.iterrows():
-            try:
-                yield {
-                    'index': row_index,
-                    'comp_code': row.get('Артикул'),
-                    'comp_name': row.get('Наименование/описание'),
-                    'comp_unit': row.get('Ед. изм.'),
-                    'comp_count': row.get('Кол-во'),
-                    'our_code': row.get('Артикул ITK/IEK'),
-                    'our_name': row.get('Наименование ITK/IEK'),
-                    'our_unit': row.get('Ед. изм.. 1'),
-                    'our_count': row.get('Кол-во. 1'),
-                    'our_cost': row.get('Цена с НДС, руб.'),
-                    'our_cost_amount': row.get('Сумма с НДС, руб.'),
-                    'comment': row.get('Комментарии'),
-                    'availability_status': row.get('Статус наличия'),
-                    'promotion': row.get('Акция'),
-                    'analogues': list()
-                }
-            except ValueError:
-                raise ValueError('Невалидное значение: ')
+        if rows_count > user.rows_to_recalculate_available:
+            raise RowsLimitExceeded
+
+    @staticmethod
+    def get_status(prc: SearchProcess):
+        if prc.is_error:
+            return 'error'
+        if prc.is_interrupted:
+            return 'interrupted'
+        if prc.is_success:
+            return 'success'
+        return 'active'
+
+    @classmethod
+    def process_status(cls, prc: SearchProcess):
+        """
+        Отправляет в сокет пользователя итоговое состояние процесса пересчета: успех, ошибку
+        (с описанием) или остановку, чтобы клиент узнал о завершении фонового пересчета.
+
+        prc <-  Объект процесса пересчета
+        """
+        cl = get_channel_layer()
+        message = json.dumps({
+            'id': prc.id,
+            'status': cls.get_status(prc),
+            'error_detail': prc.error_detail,
+            'rows_count': prc.rows_count,
+            'match_rows_count': prc.match_rows_count,
+            'unmatch_rows_count': prc.unmatch_rows_count,
+            'skip_rows_count': prc.skip_rows_count,
+        }, cls=encoders.JSONEncoder, ensure_ascii=False)
+        async_to_sync(cl.group_send)(f"search-progress-{prc.user_id}", {"type": "search_progress", "message": message})
+
+    @staticmethod
+    def clean_value(value):
+        """
+        Приводит значение ячейки сметы к типам, которые ожидает пересчет: пустые значения - к None,
+        целые числа, сохраненные в файле как float, - к int.
+        """
+        if pd.isna(value):
+            return None
+        if isinstance(value, float) and value.is_integer():
+            return int(value)
+        return value
+
+    @staticmethod
+    def get_header_names(header: tuple):
+        """
+        Возвращает имена столбцов сметы так же, как их формировал pandas.read_excel:
+        пустые заголовки - "Unnamed: N", повторяющиеся - с суффиксом ".N".
+
+        header  <-  Значения ячеек строки заголовка
+        """
+        names, counts = list(), dict()
+        for i, name in enumerate(header):
+            name = f'Unnamed: {i}' if name is None else str(name)
+            count = counts.get(name, 0)
+            while count:
+                counts[name] = count + 1
+                name = f'{name}.{count}'
+                count = counts.get(name, 0)
+            counts[name] = count + 1
+            names.append(name)
+        return names
+
+    @classmethod
+    def estimate_row(cls, index: int, row: dict):
+        """
+        Возвращает строку сметы в виде объекта словаря
+
+        index   <-  Порядковый номер строки под заголовком
+        row     <-  Значения ячеек строки по именам столбцов
+        """
+        data = {'index': index}
+        data.update((key, cls.clean_value(row.get(column))) for key, column in cls.estimate_columns.items())
+        data['analogues'] = list()
+        return data
+
+    @classmethod
+    def get_prepare_data(cls, f):
+        """
+        Читает лист сметы файла .xlsx построчно и выдает строки в виде объектов словаря по мере чтения,
+        не загружая лист в память целиком. Пустые строки в конце листа отбрасываются.
+
+        f   <-  Путь или файл таблицы в формате .xlsx
+        """
+        try:
+            wb = load_workbook(f, read_only=True, data_only=True)
+        except (InvalidFileException, BadZipFile, KeyError):
+            raise ValueError('Файл не является файлом .xlsx')
+        try:
+            if cls.estimate_sheet not in wb.sheetnames:
+                raise ValueError(f'В файле нет листа "{cls.estimate_sheet}"')
+            ws = wb[cls.estimate_sheet]
+            # размеры листа, записанные в файле, могут быть неверными
+            ws.reset_dimensions()
+            rows = ws.iter_rows(min_row=cls.estimate_header_row, values_only=True)
+            names = cls.get_header_names(next(rows, ()))
+            row_index = 0
+            blank = 0  # пустые строки выдаются, только если за ними есть заполненные
+            for values in rows:
+                if all(value is None for value in values):
+                    blank += 1
+                    continue
+                for _ in range(blank):
+                    yield cls.estimate_row(row_index, dict())
+                    row_index += 1
+                blank = 0
+                yield cls.estimate_row(row_index, dict(zip(names, values)))
+                row_index += 1
+        finally:
+            wb.close()
+
+    @staticmethod
+    def save_upload(prc: SearchProcess, f):
+        """
+        Сохраняет загруженный файл сметы до разбора в фоновом пересчете и возвращает путь до него.
+        Если пересчет не запустится, файл удалит очистка временных файлов.
+
+        prc <-  Объект процесса пересчета
+        f   <-  Загруженный файл сметы
+        """
+        path = ArtifactService.create('uploads', f'recalculate_{prc.id}.xlsx')
+        with open(path, 'wb') as dst:
+            for chunk in f.chunks():
+                dst.write(chunk)
+        return path
 
     @staticmethod
     def analog_to_row(analog, row, similar: list = None, ex_m: bool = True):
@@ -131,139 +281,207 @@ class SearchService:
         return row
 
     @classmethod
-    def search_analog(cls, row: dict, equipment: OurEquipment.objects, prc: SearchProcess):
+    def row_matched(cls, prc: SearchProcess, results: 'SearchProcessResultWriter',
+                    progress: 'SearchProgressPublisher', row: dict, anlg: OurEquipment, flag: str):
+        """
+        Фиксирует успешный подбор аналога для строки сметы.
+
+        prc     <-  Запущенный процесс пересчета
+        results <-  Буфер записи результатов процесса
+        progress <- Публикатор прогресса процесса
+        row     <-  Объект словаря с данными из строки сметы
+        anlg    <-  Подобранный аналог
+        flag    <-  Название флага ступени поиска в SearchProcessResult
         """
-        Получает строку с данными об оборудовании конкурента и возвращает два значения:
-        первично подобранный аналог и список (QuerySet) вторично подобранных аналогов в
-        случае успешного поиска.
-        В случае неудачного поиска возвращает None и пустой QuerySet.
+        comp_code = row.get('comp_code')
+        comp_name = row.get('comp_name')
+        results.add(row, anlg.code, anlg.name, is_match=True, **{flag: True})
+        prc.match_rows_count += 1
+        progress.add(f'Найдено: {comp_code} {comp_name} --> {anlg.code} {anlg.name}')
+        LogService.log('success-recalculate-row', f'Артикул: {comp_code} -> {anlg.code}', 'recalculates', prc.user)
 
-        row         <-  Объект словаря с данными из строки сметы
-        equipment   <-  Список номенклатуры, из которой необходимо подобрать аналог
-        prc         <-  Запущенный процесс пересчета
+    @staticmethod
+    def is_searchable(row: dict):
+        """
+        Строки без единиц измерения и количества считаются заголовками разделов и пропускаются
+        """
+        return bool(row.get('comp_unit') or row.get('comp_count'))
+
+    @staticmethod
+    def get_index(rows: list, exc_mdls: list, batch: bool):
+        if batch:
+            return AnalogIndex.for_rows(rows, exc_mdls)
+        return AnalogIndex.shared(exc_mdls)
+
+    @staticmethod
+    def match_key(row: dict):
+        """
+        Ключ строки сметы, определяющий результат подбора: нормализованный артикул и наименование.
+        Строковое наименование не нормализуется: нечеткий поиск и поиск по характеристикам используют
+        его как есть. Нестроковое наименование (число) участвует только в точных ступенях, поэтому
+        берется его нормализованный ключ; ключ такой строки длиннее, чтобы не совпасть со строковым.
+        """
+        comp_code = normalize_key(row.get('comp_code'))
+        comp_name = row.get('comp_name')
+        if isinstance(comp_name, str):
+            return comp_code, comp_name
+        return comp_code, None, normalize_key(comp_name)
+
+    @staticmethod
+    def match_row(row: dict, index: AnalogIndex, psp: int):
+        """
+        Подбирает аналог для строки сметы без записи результатов и возвращает три значения:
+        первично подобранный аналог, список пар [id, оценка] вторично подобранных аналогов и название
+        флага ступени поиска в SearchProcessResult.
+        В случае неудачного поиска возвращает None, пустой список и None.
+
+        row     <-  Объект словаря с данными из строки сметы
+        index   <-  Индекс номенклатуры, из которой необходимо подобрать аналог
+        psp     <-  Минимальный процент совпадения характеристик
         """
         comp_code = row.get('comp_code')
         comp_name = row.get('comp_name')
-        exactly_match = True
-
-        # поиск среди артикулов номенклатуры ИЕК
-        if equipment.filter(code=comp_code).exists():
-            anlg = equipment.get(code=comp_code)
-            prc.results.create(comp_code, comp_name, anlg.code, anlg.name, True, match_in_own_codes=True)
-            prc.match_rows_count += 1
-            log = f'Найдено: {comp_code} {comp_name} --> {anlg.code} {anlg.name}'
-            cls.process_log(prc, log, cls.remtime_str(prc.remtime()))
-            LogService.log('success-recalculate-row', f'Артикул: {comp_code} -> {anlg.code}', 'recalculates', prc.user)
-            return anlg, equipment.none(), exactly_match
-
-        # поиск среди наименований номенклатуры ИЕК
-        if equipment.filter(name=comp_name).exists():
-            anlg = equipment.filter(name=comp_name).first()
-            prc.results.create(comp_code, comp_name, anlg.code, anlg.name, True, match_in_own_names=True)
-            prc.match_rows_count += 1
-            log = f'Найдено: {comp_code} {comp_name} --> {anlg.code} {anlg.name}'
-            cls.process_log(prc, log, cls.remtime_str(prc.remtime()))
-            LogService.log('success-recalculate-row', f'Артикул: {comp_code} -> {anlg.code}', 'recalculates', prc.user)
-            return anlg, equipment.none(), exactly_match
-
-        # поиск среди артикулов номенклатуры конкурентов
-        if CompetitorsEquipment.objects.filter(code=comp_code).exists():
-            comp_analog = CompetitorsEquipment.objects.filter(code=comp_code).first()
-            similar = equipment.filter(keywords__comp_equipment=comp_analog)
-            if similar.exists():
-                anlg = similar.first()
-                similar = similar.exclude(id=anlg.id)
-                prc.results.create(comp_code, comp_name, anlg.code, anlg.name, True, match_in_comp_codes=True)
-                prc.match_rows_count += 1
-                log = f'Найдено: {comp_code} {comp_name} --> {anlg.code} {anlg.name}'
-                cls.process_log(prc, log, cls.remtime_str(prc.remtime()))
-                LogService.log('success-recalculate-row', f'Артикул: {comp_code} -> {anlg.code}', 'recalculates',
-                               prc.user)
-                return anlg, similar, exactly_match
-
-        # поиск среди наименований номенклатуры конкурентов
-        if CompetitorsEquipment.objects.filter(name=comp_name).exists():
-            comp_analog = CompetitorsEquipment.objects.filter(name=comp_name).first()
-            similar = equipment.filter(keywords__comp_equipment=comp_analog)
-            if similar.exists():
-                anlg = similar.first()
-                similar = similar.exclude(id=anlg.id)
-                prc.results.create(comp_code, comp_name, anlg.code, anlg.name, True, match_in_comp_names=True)
-                prc.match_rows_count += 1
-                log = f'Найдено: {comp_code} {comp_name} --> {anlg.code} {anlg.name}'
-                cls.process_log(prc, log, cls.remtime_str(prc.remtime()))
-                LogService.log('success-recalculate-row', f'Артикул: {comp_code} -> {anlg.code}', 'recalculates',
-                               prc.user)
-                return anlg, similar, exactly_match
-
-        # поиск среди ключей по артикулу
-        if KeyWord.objects.filter(keyword=comp_code).exists():
-            similar = equipment.filter(
-                id__in=KeyWord.objects.filter(keyword=comp_code).values_list('our_equipment_id', flat=True)
-            )
-            if similar.exists():
-                anlg = similar.first()
-                similar = similar.exclude(id=anlg.id)
-                prc.results.create(comp_code, comp_name, anlg.code, anlg.name, True, match_in_keys=True)
-                prc.match_rows_count += 1
-                log = f'Найдено: {comp_code} {comp_name} --> {anlg.code} {anlg.name}'
-                cls.process_log(prc, log, cls.remtime_str(prc.remtime()))
-                LogService.log('success-recalculate-row', f'Артикул: {comp_code} -> {anlg.code}', 'recalculates',
-                               prc.user)
-                return anlg, similar, exactly_match
-
-        # поиск среди ключей по наименованию
-        if KeyWord.objects.filter(keyword=comp_name).exists():
-            similar = equipment.filter(
-                id__in=KeyWord.objects.filter(keyword=comp_name).values_list('our_equipment_id', flat=True)
-            )
-            if similar.exists():
-                anlg = similar.first()
-                similar = similar.exclude(id=anlg.id)
-                prc.results.create(comp_code, comp_name, anlg.code, anlg.name, True, match_in_keys=True)
-                prc.match_rows_count += 1
-                log = f'Найдено: {comp_code} {comp_name} --> {anlg.code} {anlg.name}'
-                cls.process_log(prc, log, cls.remtime_str(prc.remtime()))
-                LogService.log('success-recalculate-row', f'Артикул: {comp_code} -> {anlg.code}', 'recalculates',
-                               prc.user)
-                return anlg, similar, exactly_match
+
+        # поиск по артикулам, наименованиям и ключам
+        anlg, similar, flag = index.lookup(comp_code, comp_name)
+        if anlg:
+            return anlg, similar, flag
+
+        # нечеткий поиск по наименованию
+        anlg, similar = index.trigram_lookup(comp_name)
+        if anlg:
+            return anlg, similar, 'match_by_trigram'
 
         # поиск по совпадению характеристик
-        else:
-            exactly_match = False
-            words = comp_name.split(' ')
-            all_values = EquipmentCategoryPropertyValue.objects.filter(value__in=words)
-            c = collections.Counter(all_values.values_list('property__category_id', flat=True))
-            category_id, _ = max(c.items(), key=lambda p: p[::-1])
-            equipment = equipment.filter(category_id=category_id)
-            values = all_values.filter(property__category_id=category_id)
-            property_count = EquipmentCategoryProperty.objects.filter(category_id=category_id).count()
-            annotate_equipment = equipment.annotate(
-                property_coincidence_count=Count('properties__value', Q(properties__value__in=values)),
-                # psp   <-  Property Similarity Percentage
-                psp=F('property_coincidence_count') / Value(property_count, IntegerField()) * Value(100, IntegerField())
-            )
-            similar = annotate_equipment.filter(property_considence_count__gt=0, psp__gte=prc.psp).order_by(
-                '-property_coincidence_count')
-            if similar.exists():
-                anlg = similar.first()
-                similar = similar.exclude(id=anlg.id)
-                prc.results.create(comp_code, comp_name, anlg.code, anlg.name, True, match_by_properties=True)
-                prc.match_rows_count += 1
-                log = f'Найдено: {comp_code} {comp_name} --> {anlg.code} {anlg.name}'
-                cls.process_log(prc, log, cls.remtime_str(prc.remtime()))
-                LogService.log('success-recalculate-row', f'Артикул: {comp_code} -> {anlg.code}', 'recalculates',
-                               prc.user)
-                return anlg, similar, exactly_match
-        prc.results.create(comp_code, comp_name, row.get('code'), row.get('name'), is_unmatch=True)
+        anlg, similar = index.property_search(comp_name, psp)
+        if anlg:
+            return anlg, similar, 'match_by_properties'
+        return None, list(), None
+
+    @classmethod
+    def match_chunk(cls, rows: list, exc_mdls: list, psp: int, batch: bool):
+        """
+        Подбирает аналоги для части строк сметы в процессе пула. Индекс строится
+        в процессе пула, результаты возвращаются в порядке строк.
+        """
+        index = cls.get_index(rows, exc_mdls, batch)
+        return [cls.match_row(row, index, psp) for row in rows]
+
+    @staticmethod
+    def init_pool_worker(version: int):
+        """
+        Инициализация процесса пула: у каждого процесса свое подключение к базе данных,
+        версия каталога берется у родителя без запуска слушателя уведомлений
+
+        version <-  Версия каталога в родительском процессе на момент запуска пула
+        """
+        if not apps.ready:
+            django.setup()
+        connections.close_all()
+        CatalogVersionService.pin(version)
+
+    @classmethod
+    def match_parallel(cls, rows: list, exc_mdls: list, psp: int, batch: bool, check_interrupt=None):
+        """
+        Разбивает строки сметы на части и подбирает аналоги на пуле процессов.
+        Возвращает генератор результатов match_row в исходном порядке строк.
+        Пока часть строк обрабатывается, периодически вызывает check_interrupt.
+        """
+        size = settings.SEARCH_POOL_CHUNK_SIZE
+        chunks = [rows[i:i + size] for i in range(0, len(rows), size)]
+        version = CatalogVersionService.get()
+        # дочерние процессы не должны наследовать открытое подключение родителя
+        connections.close_all()
+        # пул billiard, в отличие от multiprocessing, можно запускать из процессов-демонов (воркеров Celery)
+        pool = billiard.Pool(processes=min(settings.SEARCH_POOL_WORKERS, len(chunks)),
+                             initializer=cls.init_pool_worker, initargs=(version,))
+        results = [pool.apply_async(cls.match_chunk, (chunk, exc_mdls, psp, batch)) for chunk in chunks]
+        try:
+            for result in results:
+                while True:
+                    try:
+                        chunk = result.get(timeout=settings.SEARCH_INTERRUPT_POLL_INTERVAL)
+                        break
+                    except PoolTimeoutError:
+                        if check_interrupt:
+                            check_interrupt()
+                yield from chunk
+        finally:
+            pool.terminate()
+
+    @classmethod
+    def match_rows(cls, rows: list, exc_mdls: list, psp: int, batch: bool, check_interrupt=None):
+        """
+        Возвращает итератор результатов match_row для переданных строк сметы.
+        Большие сметы обрабатываются на пуле процессов, если это разрешено настройками.
+        """
+        if settings.SEARCH_POOL_WORKERS > 1 and len(rows) >= settings.SEARCH_POOL_MIN_ROWS:
+            return cls.match_parallel(rows, exc_mdls, psp, batch, check_interrupt)
+        index = cls.get_index(rows, exc_mdls, batch)
+        return (cls.match_row(row, index, psp) for row in rows)
+
+    @classmethod
+    def match_rows_cached(cls, rows: list, exc_mdls: list, psp: int, batch: bool, check_interrupt=None):
+        """
+        Возвращает генератор результатов match_row для строк сметы в исходном порядке.
+        Строки, результат подбора которых уже есть в кеше, в подборе не участвуют,
+        новые результаты складываются в кеш.
+        """
+        cache = SearchMatchCache(psp, exc_mdls)
+        hits = cache.get_many(rows)
+        equipment = OurEquipment.objects.select_related('unit').in_bulk(
+            {hit[0] for hit in hits if hit and hit[0]})
+        matches = cls.match_rows([row for row, hit in zip(rows, hits) if hit is None], exc_mdls, psp, batch,
+                                 check_interrupt)
+        new = dict()
+        try:
+            for row, hit in zip(rows, hits):
+                if hit is None:
+                    match = next(matches)
+                    new[cache.key(row)] = cache.pack(match)
+                    if len(new) >= settings.SEARCH_RESULTS_BATCH_SIZE:
+                        cache.set_many(new)
+                        new = dict()
+                    yield match
+                else:
+                    anlg_id, similar, flag = hit
+                    yield equipment.get(anlg_id), similar, flag
+        finally:
+            if hasattr(matches, 'close'):
+                matches.close()
+            cache.set_many(new)
+
+    @classmethod
+    def search_analog(cls, row: dict, match: tuple, prc: SearchProcess, results: 'SearchProcessResultWriter',
+                      progress: 'SearchProgressPublisher'):
+        """
+        Записывает результат подбора аналога для строки сметы и возвращает три значения:
+        первично подобранный аналог, список пар [id, оценка] вторично подобранных аналогов и признак
+        точного совпадения (не нечеткий поиск и не поиск по характеристикам) в случае успешного поиска.
+        В случае неудачного поиска возвращает None и пустой список.
+
+        row     <-  Объект словаря с данными из строки сметы
+        match   <-  Результат match_row для строки
+        prc     <-  Запущенный процесс пересчета
+        results <-  Буфер записи результатов процесса
+        progress <- Публикатор прогресса процесса
+        """
+        comp_code = row.get('comp_code')
+        comp_name = row.get('comp_name')
+        anlg, similar, flag = match
+        if anlg:
+            cls.row_matched(prc, results, progress, row, anlg, flag)
+            return anlg, similar, flag not in ('match_by_trigram', 'match_by_properties')
+
+        results.add(row, row.get('our_code'), row.get('our_name'), is_unmatch=True)
         prc.unmatch_rows_count += 1
-        cls.process_log(prc, f'Не найдено: {comp_code} {comp_name}', cls.remtime_str(prc.remtime()))
+        progress.add(f'Не найдено: {comp_code} {comp_name}')
         LogService.log('failed-recalculate-row', f'Артикул: {comp_code}; Наименование: {comp_name}', 'recalculates',
                        prc.user)
-        return None, equipment.none(), exactly_match
+        return None, list(), False
 
     @classmethod
-    def do_recalculate(cls, data: list, prc: SearchProcess, exc_mdls: list):
+    def do_recalculate(cls, data: list, prc: SearchProcess, exc_mdls: list, batch: bool = None):
         """
         Осуществляет поиск по массиву переданных данных, который должен иметь структуру,
         как у выходного списка функции get_prepare_data.
@@ -271,7 +489,10 @@ class SearchService:
         data    <-  Массив данных в виде списка словарей
         prc     <-  Объект процесса поиска/пересчета
         ex_mdls <-  Список id линеек, которые требуется исключить из подбора
+        batch   <-  Пакетный режим подбора. По умолчанию берется из настройки SEARCH_BATCH_MODE
         """
+        if batch is None:
+            batch = settings.SEARCH_BATCH_MODE
 
         LogService.log('request-to-recalculate',
                        f'Запрос на пересчет. Пользователь: {prc.user.__str__()}; Email: {prc.user.email};',
@@ -279,65 +500,85 @@ class SearchService:
 
         recalculated_data = list()
         prc.rows_count = len(data)
-        prc.save()
-        if prc.rows_count < prc.user.rows_to_recalculate_available:
+        prc.save(update_fields=('rows_count',))
+        try:
+            cls.check_rows_available(prc.user, prc.rows_count)
+        except RowsLimitExceeded as e:
             prc.error(f'Недостаточно строк. Кол-во строк у пользователя: {prc.user.rows_to_recalculate_available}')
-            raise Interrupt('Количество доступных для пересчета строк меньше чем имеется в загруженном файле. '
-                            'Поиск остановлен. Обратитесь к администратору')
-        our_equipment = OurEquipment.objects.exclude(model__in=exc_mdls)
-
+            raise Interrupt(e.detail)
+        check_interrupt = InterruptChecker(prc)
+        # одинаковые строки сметы (например, повторяющиеся по разделам) подбираются один раз
+        unique = dict()
         for row in data:
-            # проверка внешнего прерывания пересчета
-            cls.check_interrupt(prc)
-            recalculated_row = row
-            if row.get('comp_unit') or row.get('comp_count'):
-                analog, similar, ex_m = cls.search_analog(row, our_equipment, prc)
-                if analog():
-                    recalculated_row = cls.analog_to_row(analog, row, ex_m)
-            else:
-                prc.results.create(row.get('comp_code'), row.get('comp_name'), row.get('our_code'), row.get('our_name'),
-                                   is_skip=True)
-                prc.skip_rows_count += 1
-            recalculated_data.append(recalculated_row)
-            prc.save()
+            if cls.is_searchable(row):
+                unique.setdefault(cls.match_key(row), row)
+        matches = cls.match_rows_cached(list(unique.values()), exc_mdls, prc.psp, batch, check_interrupt)
+        found = dict()  # ключ строки -> результат подбора
+
+        try:
+            # при прерывании или ошибке буферы сохраняют и отправляют уже обработанные строки
+            with SearchProcessCounters(prc) as counters, SearchProcessResultWriter(prc) as results, \
+                    SearchProgressPublisher(prc) as progress:
+                for row in data:
+                    # проверка внешнего прерывания пересчета
+                    check_interrupt()
+                    recalculated_row = row
+                    if cls.is_searchable(row):
+                        key = cls.match_key(row)
+                        if key not in found:
+                            # уникальные строки подбираются в порядке их первого появления в смете
+                            found[key] = next(matches)
+                        analog, similar, ex_m = cls.search_analog(row, found[key], prc, results, progress)
+                        if analog:
+                            recalculated_row = cls.analog_to_row(analog, row, similar, ex_m)
+                    else:
+                        results.add(row, row.get('our_code'), row.get('our_name'), is_skip=True)
+                        prc.skip_rows_count += 1
+                    recalculated_data.append(recalculated_row)
+                    counters.tick()
+        finally:
+            # при прерывании останавливает пул процессов
+            if hasattr(matches, 'close'):
+                matches.close()
+        SearchResultService.save(prc, recalculated_data)
         prc.success()  # Завершение процесса пересчета
         return recalculated_data
 
-    @staticmethod
-    def get_file(data: list):
-        """
-        Генерирует стилизованный файл со списком аналогов и возвращает путь до него.
+    # столбцы файла пересчета: ширина, заголовок, именованные стили заголовка и ячеек строк (document_styles),
+    # ключ строки, значение которого заносится в ячейку
+    file_columns = (
+        (6, '№ п.п.', 'asist_title', 'asist_cell_center', None),
+        (15, 'Артикул', 'asist_title', 'asist_cell_left', 'comp_code'),
+        (20, 'Наименование/Описание', 'asist_title', 'asist_cell_left', 'comp_name'),
+        (6, 'Ед. изм.', 'asist_title', 'asist_cell_center', None),
+        (6, 'Кол-во', 'asist_title', 'asist_cell_center', None),
+        (15, 'Артикул ITK/IEK', 'asist_iek_title', 'asist_iek_code_cell', 'code'),
+        (20, 'Наименование ITK/IEK', 'asist_iek_title', 'asist_iek_cell_left', 'name'),
+        (6, 'Ед. изм.', 'asist_iek_title', 'asist_iek_cell_center', None),
+        (6, 'Кол-во', 'asist_iek_title', 'asist_iek_cell_center', None),
+        (15, 'Цена с НДС, руб.', 'asist_iek_title', 'asist_iek_cell_center', None),
+        (15, 'Сумма с НДС, руб.', 'asist_iek_title', 'asist_iek_cell_center', None),
+        (20, 'Комментарии', 'asist_comment_title', 'asist_comment_cell', None),
+        (15, 'Статус наличия', 'asist_comment_title', 'asist_status_cell', None),
+        (15, 'Акция', 'asist_discount_title', 'asist_discount_cell', None),
+    )
 
-        data    <-  Список строк, которые необходимо занести в итоговый файл пересчета
+    @classmethod
+    def get_file(cls, data):
         """
-        wb = Workbook()
-        ws = wb.active
+        Генерирует стилизованный файл со списком аналогов в режиме write-only: строки записываются
+        на диск по мере добавления, поэтому память не зависит от размера пересчета.
+        Возвращает открытый безымянный временный файл, который удаляется при закрытии.
 
-        ws.title = 'Спецификация'
+        data    <-  Список или генератор строк, которые необходимо занести в итоговый файл пересчета
+        """
+        wb = Workbook(write_only=True)
+        document_styles.add_named_styles(wb)
+        ws = wb.create_sheet('Спецификация')
 
         # выставляем ширину столбцов
-        ws.column_dimensions['A'].width = 6
-        ws.column_dimensions['B'].width = 15
-        ws.column_dimensions['C'].width = 20
-        ws.column_dimensions['D'].width = 6
-        ws.column_dimensions['E'].width = 6
-        ws.column_dimensions['F'].width = 15
-        ws.column_dimensions['G'].width = 20
-        ws.column_dimensions['H'].width = 6
-        ws.column_dimensions['I'].width = 6
-        ws.column_dimensions['J'].width = 15
-        ws.column_dimensions['K'].width = 15
-        ws.column_dimensions['L'].width = 20
-        ws.column_dimensions['M'].width = 15
-        ws.column_dimensions['N'].width = 15
-
-        # добавляем контактные данные
-        ws['G1'] = 'Контактный телефон:'
-        ws['G2'] = '7 (495) 542-22-22'
-        ws['G3'] = 'www.iek.ru'
-        ws['G1'].font = document_styles.standard_font
-        ws['G2'].font = document_styles.standard_font
-        ws['G3'].font = document_styles.standard_font
+        for i, column in enumerate(cls.file_columns, 1):
+            ws.column_dimensions[get_column_letter(i)].width = column[0]
 
         # вставка логотипа ИЕК
         logo = Image(os.path.join(settings.BASE_DIR, "iek-logo.png"))
@@ -345,209 +586,361 @@ class SearchService:
         logo.width = 100
         ws.add_image(logo, 'D1')
 
-        # заголовок столбца номера строки
-        num_title = ws['A7']
-        num_title.value = '№ п.п.'
-        num_title.font = document_styles.title_font
-        num_title.fill = document_styles.white_fill
-        num_title.border = document_styles.bold_border
-
-        # заголовок столбца артикула конкурента
-        comp_code_title = ws['B7']
-        comp_code_title.value = 'Артикул'
-        comp_code_title.font = document_styles.title_font
-        comp_code_title.fill = document_styles.white_fill
-        comp_code_title.border = document_styles.bold_border
-
-        # заголовок столбца названия конкурента
-        comp_name_title = ws['C7']
-        comp_name_title.value = 'Наименование/Описание'
-        comp_name_title.font = document_styles.title_font
-        comp_name_title.fill = document_styles.white_fill
-        comp_name_title.border = document_styles.bold_border
-
-        # заголовок столбца единицы измерения товара у конкурента
-        comp_units_title = ws['D7']
-        comp_units_title.value = 'Ед. изм.'
-        comp_units_title.font = document_styles.title_font
-        comp_units_title.fill = document_styles.white_fill
-        comp_units_title.border = document_styles.bold_border
-
-        # заголовок столбца количества товара у конкурента
-        comp_count_title = ws['E7']
-        comp_count_title.value = 'Кол-во'
-        comp_count_title.font = document_styles.title_font
-        comp_count_title.fill = document_styles.white_fill
-        comp_count_title.border = document_styles.bold_border
-
-        # заголовок столбца артикула ИЕК
-        code_title = ws['F7']
-        code_title.value = 'Артикул ITK/IEK'
-        code_title.font = document_styles.title_font
-        code_title.fill = document_styles.iek_title_fill
-        code_title.border = document_styles.bold_border
-
-        # заголовок столбца названия ИЕК
-        name_title = ws['G7']
-        name_title.value = 'Наименование ITK/IEK'
-        name_title.font = document_styles.title_font
-        name_title.fill = document_styles.iek_title_fill
-        name_title.border = document_styles.bold_border
-
-        # заголовок столбца единицы измерения товара ИЕК
-        units_title = ws['H7']
-        units_title.value = 'Ед. изм.'
-        units_title.font = document_styles.title_font
-        units_title.fill = document_styles.iek_title_fill
-        units_title.border = document_styles.bold_border
-
-        # заголовок столбца количества товара ИЕК
-        count_title = ws['I7']
-        count_title.value = 'Кол-во'
-        count_title.font = document_styles.title_font
-        count_title.fill = document_styles.iek_title_fill
-        count_title.border = document_styles.bold_border
-
-        # заголовок столбца цены с НДС ИЕК
-        cost_with_nds_title = ws['J7']
-        cost_with_nds_title.value = 'Цена с НДС, руб.'
-        cost_with_nds_title.font = document_styles.title_font
-        cost_with_nds_title.fill = document_styles.iek_title_fill
-        cost_with_nds_title.border = document_styles.bold_border
-
-        # заголовок столбца суммы с НДС ИЕК
-        amount_with_nds_title = ws['K7']
-        amount_with_nds_title.value = 'Сумма с НДС, руб.'
-        amount_with_nds_title.font = document_styles.title_font
-        amount_with_nds_title.fill = document_styles.iek_title_fill
-        amount_with_nds_title.border = document_styles.bold_border
-
-        # заголовок столбца комментариев
-        comments_title = ws['L7']
-        comments_title.value = 'Комментарии'
-        comments_title.font = document_styles.title_font
-        comments_title.fill = document_styles.comment_title_fill
-        comments_title.border = document_styles.bold_border
-
-        # заголовок столбца статуса наличия
-        availability_status_title = ws['M7']
-        availability_status_title.value = 'Статус наличия'
-        availability_status_title.font = document_styles.title_font
-        availability_status_title.fill = document_styles.comment_title_fill
-        availability_status_title.border = document_styles.bold_border
-
-        # заголовок столбца акции
-        discount_title = ws['N7']
-        discount_title.value = 'Акция'
-        discount_title.font = document_styles.title_font
-        discount_title.fill = document_styles.discount_title_fill
-        discount_title.border = document_styles.bold_border
-
-        row_num = 1
-        row_start = 7
-
-        for data_row in data:
-            cell_num_str = str(row_num + row_start)
-            num = ws['A' + cell_num_str]
-            comp_code = ws['B' + cell_num_str]
-            comp_name = ws['C' + cell_num_str]
-            comp_units = ws['D' + cell_num_str]
-            comp_count = ws['E' + cell_num_str]
-            code = ws['F' + cell_num_str]
-            name = ws['G' + cell_num_str]
-            units = ws['H' + cell_num_str]
-            count = ws['I' + cell_num_str]
-            cost_with_nds = ws['J' + cell_num_str]
-            amount_with_nds = ws['K' + cell_num_str]
-            comments = ws['L' + cell_num_str]
-            availability_status = ws['M' + cell_num_str]
-            discount = ws['N' + cell_num_str]
-
-            num.font = document_styles.standard_font
-            comp_code.font = document_styles.standard_font
-            comp_name.font = document_styles.standard_font
-            comp_units.font = document_styles.standard_font
-            comp_count.font = document_styles.standard_font
-            code.font = document_styles.standard_font
-            name.font = document_styles.standard_font
-            units.font = document_styles.standard_font
-            count.font = document_styles.standard_font
-            cost_with_nds.font = document_styles.standard_font
-            amount_with_nds.font = document_styles.standard_font
-            comments.font = document_styles.standard_font
-            availability_status.font = document_styles.standard_font
-            discount.font = document_styles.standard_font
-
-            num.fill = document_styles.white_fill
-            comp_code.fill = document_styles.white_fill
-            comp_name.fill = document_styles.white_fill
-            comp_units.fill = document_styles.white_fill
-            comp_count.fill = document_styles.white_fill
-            code.fill = document_styles.iek_cell_fill
-            name.fill = document_styles.iek_cell_fill
-            units.fill = document_styles.iek_cell_fill
-            count.fill = document_styles.iek_cell_fill
-            cost_with_nds.fill = document_styles.iek_cell_fill
-            amount_with_nds.fill = document_styles.iek_cell_fill
-            comments.fill = document_styles.comment_cell_fill
-            availability_status.fill = document_styles.comment_cell_fill
-            discount.fill = document_styles.discount_cell_fill
-
-            num.border = document_styles.standard_border
-            comp_code.border = document_styles.standard_border
-            comp_name.border = document_styles.standard_border
-            comp_units.border = document_styles.standard_border
-            comp_count.border = document_styles.standard_border
-            code.border = document_styles.separate_left_bold_border
-            name.border = document_styles.standard_border
-            units.border = document_styles.standard_border
-            count.border = document_styles.standard_border
-            cost_with_nds.border = document_styles.standard_border
-            amount_with_nds.border = document_styles.standard_border
-            comments.border = document_styles.separate_left_bold_border
-            availability_status.border = document_styles.standard_border
-            discount.border = document_styles.separate_left_bold_border
-
-            num.alignment = document_styles.alignment_center
-            comp_code.alignment = document_styles.alignment_left
-            comp_name.alignment = document_styles.alignment_left
-            comp_units.alignment = document_styles.alignment_center
-            comp_count.alignment = document_styles.alignment_center
-            code.alignment = document_styles.alignment_left
-            name.alignment = document_styles.alignment_left
-            units.alignment = document_styles.alignment_center
-            count.alignment = document_styles.alignment_center
-            cost_with_nds.alignment = document_styles.alignment_center
-            amount_with_nds.alignment = document_styles.alignment_center
-            comments.alignment = document_styles.alignment_left
-            availability_status.alignment = document_styles.alignment_left
-            discount.alignment = document_styles.alignment_left
-
-            num.value = str(row_num)
-            comp_code.value = data_row['comp_code']
-            comp_name.value = data_row['comp_name']
-            code.value = data_row['code']
-            name.value = data_row['name']
-
-            row_num += 1
-        now_str = timezone.localtime(timezone.now()).strftime('%Y-%m-%d_%H-%M-%S')
-        filepath = os.path.join(settings.MEDIA_ROOT, 'tmp_recalculates', f'recalculate_{now_str}.xlsx')
-        wb.save(filename=filepath)
-        return filepath
+        # добавляем контактные данные в столбец G
+        for contact in ('Контактный телефон:', '7 (495) 542-22-22', 'www.iek.ru'):
+            cell = WriteOnlyCell(ws, contact)
+            cell.style = 'asist_contact'
+            ws.append([None] * 6 + [cell])
+        for _ in range(3):
+            ws.append([])
+
+        # заголовки столбцов
+        titles = list()
+        for width, title, title_style, cell_style, key in cls.file_columns:
+            cell = WriteOnlyCell(ws, title)
+            cell.style = title_style
+            titles.append(cell)
+        ws.append(titles)
+
+        # ячейки строки стилизуются один раз и переиспользуются: в режиме write-only
+        # строка сериализуется сразу при добавлении, поэтому меняются только значения
+        cells = list()
+        for width, title, title_style, cell_style, key in cls.file_columns:
+            cell = WriteOnlyCell(ws)
+            cell.style = cell_style
+            cells.append((cell, key))
+
+        for row_num, data_row in enumerate(data, 1):
+            for cell, key in cells:
+                cell.value = data_row[key] if key else None
+            cells[0][0].value = str(row_num)
+            ws.append([cell for cell, key in cells])
+
+        f = tempfile.TemporaryFile()
+        wb.save(f)
+        f.seek(0)
+        return f
 
     @staticmethod
-    def get_file_response(path: str, email: str, rm: int = None):
+    def get_file_response(f, email: str):
+        """
+        Возвращает ответ, который отдает файл пересчета частями и закрывает (удаляет) его после отправки
+
+        f       <-  Открытый файл пересчета, возвращенный get_file
+        email   <-  Email пользователя для имени файла
+        """
         now = timezone.localtime(timezone.now() + timezone.timedelta(hours=3))
         output_filename = 'Пересчет ASIST ' + email + ' ' + now.strftime("%d.%m.%Y %Hч %Mм") + '.xlsx'
-        response = FileResponse(open(path, 'rb'), as_attachment=True, filename=output_filename)
+        response = FileResponse(f, as_attachment=True, filename=output_filename)
         response['Access-Control-Expose-Headers'] = 'Content-Disposition'
         response['Content-Disposition'] = "attachment; filename=*=UTF-8''" + escape_uri_path(output_filename)
-        if rm:
-            # удаление временного файла через 'rm' секунд
-            threading.Timer(rm, lambda p: os.remove(p), args=[path]).start()
         return response
 
 
+class SearchMatchCache:
+    """
+    Общий для всех процессов кеш результатов подбора аналогов в Redis.
+    Ключ строится из артикула и наименования строки сметы, процента совпадения характеристик,
+    настроек подбора (кол-во вторичных аналогов, нечеткий поиск), исключенных линеек и версии каталога,
+    поэтому любое изменение каталога делает старые записи недоступными, а вытеснение выполняет
+    сам Redis по TTL и политике maxmemory (allkeys-lru).
+    В кеше хранится только id аналога, список пар [id, оценка] вторичных аналогов и флаг ступени поиска.
+    При недоступности Redis подбор выполняется без кеша.
+    """
+    client = None
+
+    def __init__(self, psp: int, exc_mdls: list):
+        self.enabled = settings.SEARCH_CACHE_ENABLED
+        self.prefix = ''
+        if self.enabled:
+            if SearchMatchCache.client is None:
+                SearchMatchCache.client = redis.Redis.from_url(settings.SEARCH_CACHE_URL)
+            version = CatalogVersionService.get()
+            # настройки, от которых зависит результат подбора
+            trigram = settings.SEARCH_TRIGRAM_THRESHOLD if settings.SEARCH_TRIGRAM_ENABLED else 'off'
+            self.prefix = f'asist:match:{version}:{psp}:{settings.SEARCH_SIMILAR_LIMIT}:{trigram}:' \
+                          f'{",".join(str(m) for m in sorted(exc_mdls or list()))}:'
+
+    def key(self, row: dict):
+        data = json.dumps(SearchService.match_key(row), ensure_ascii=False)
+        return self.prefix + hashlib.sha1(data.encode()).hexdigest()
+
+    @staticmethod
+    def pack(match: tuple):
+        anlg, similar, flag = match
+        return json.dumps([anlg.id if anlg else None, similar, flag], cls=encoders.JSONEncoder)
+
+    def get_many(self, rows: list):
+        """
+        Возвращает список результатов из кеша в порядке строк. Для строк, которых нет в кеше, возвращает None.
+        """
+        if not self.enabled or not rows:
+            return [None] * len(rows)
+        try:
+            values = self.client.mget([self.key(row) for row in rows])
+        except redis.RedisError:
+            return [None] * len(rows)
+        return [json.loads(value) if value is not None else None for value in values]
+
+    def set_many(self, values: dict):
+        if not self.enabled or not values:
+            return
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for key, value in values.items():
+                pipe.set(key, value, ex=settings.SEARCH_CACHE_TTL)
+            pipe.execute()
+        except redis.RedisError:
+            pass
+
+
+class InterruptChecker:
+    """
+    Проверка внешнего прерывания пересчета. Вместо обновления всего процесса из базы данных
+    перед каждой строкой читает только флаг is_interrupted и не чаще, чем раз
+    в SEARCH_INTERRUPT_POLL_INTERVAL секунд.
+    """
+
+    def __init__(self, prc: SearchProcess, interval: float = None):
+        self.prc = prc
+        self.interval = settings.SEARCH_INTERRUPT_POLL_INTERVAL if interval is None else interval
+        self.checked = None
+
+    def __call__(self):
+        now = time.monotonic()
+        if self.checked is not None and now - self.checked < self.interval:
+            return
+        self.checked = now
+        if SearchProcess.objects.filter(id=self.prc.id, is_interrupted=True).exists():
+            self.prc.is_interrupted = True
+            raise Interrupt
+
+
+class SearchProcessCounters:
+    """
+    Периодическое сохранение счетчиков процесса пересчета. Счетчики ведутся в объекте процесса
+    в памяти и сохраняются только они (без перезаписи остальных полей, в том числе флага прерывания)
+    каждые SEARCH_COUNTERS_SAVE_ROWS строк или SEARCH_COUNTERS_SAVE_INTERVAL секунд
+    и при выходе из контекста.
+    """
+    fields = ('match_rows_count', 'unmatch_rows_count', 'skip_rows_count',)
+
+    def __init__(self, prc: SearchProcess, rows: int = None, interval: float = None):
+        self.prc = prc
+        self.rows = rows or settings.SEARCH_COUNTERS_SAVE_ROWS
+        self.interval = settings.SEARCH_COUNTERS_SAVE_INTERVAL if interval is None else interval
+        self.unsaved = 0
+        self.saved = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.save()
+
+    def tick(self):
+        self.unsaved += 1
+        if self.unsaved >= self.rows or time.monotonic() - self.saved >= self.interval:
+            self.save()
+
+    def save(self):
+        if self.unsaved:
+            self.prc.save(update_fields=self.fields)
+        self.unsaved = 0
+        self.saved = time.monotonic()
+
+
+class SearchProgressPublisher:
+    """
+    Публикатор прогресса пересчета. Накапливает строки лога и отправляет их в сокет
+    одним сообщением вместе со счетчиками процесса не чаще, чем раз
+    в SEARCH_PROGRESS_INTERVAL секунд, или при накоплении SEARCH_PROGRESS_BATCH_SIZE строк.
+    При выходе из контекста (успех, ошибка или прерывание) отправляет оставшиеся строки.
+    """
+
+    def __init__(self, prc: SearchProcess, interval: float = None, size: int = None):
+        self.prc = prc
+        self.interval = settings.SEARCH_PROGRESS_INTERVAL if interval is None else interval
+        self.size = size or settings.SEARCH_PROGRESS_BATCH_SIZE
+        self.lines = list()
+        self.flushed = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    def add(self, log: str):
+        self.lines.append(log)
+        if len(self.lines) >= self.size or time.monotonic() - self.flushed >= self.interval:
+            self.flush()
+
+    def flush(self):
+        self.flushed = time.monotonic()
+        if self.lines:
+            SearchService.process_log(self.prc, self.lines, SearchService.remtime_str(self.prc.remtime()))
+            self.lines = list()
+
+
+class SearchProcessResultWriter:
+    """
+    Буфер записей SearchProcessResult. Накапливает результаты по строкам сметы
+    и сохраняет их через bulk_create каждые SEARCH_RESULTS_BATCH_SIZE строк
+    и при выходе из контекста, в том числе при прерывании или ошибке пересчета.
+    """
+
+    def __init__(self, prc: SearchProcess, size: int = None):
+        self.prc = prc
+        self.size = size or settings.SEARCH_RESULTS_BATCH_SIZE
+        self.buffer = list()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    @staticmethod
+    def to_text(value):
+        return '' if value is None or pd.isna(value) else str(value)
+
+    def add(self, row: dict, output_code=None, output_name=None, **flags):
+        """
+        row         <-  Объект словаря с данными из строки сметы
+        output_code <-  Артикул, записанный в строку результата
+        output_name <-  Наименование, записанное в строку результата
+        flags       <-  Флаги результата: is_match, is_unmatch, is_skip, match_in_*
+        """
+        self.buffer.append(SearchProcessResult(
+            process=self.prc,
+            input_code=self.to_text(row.get('comp_code')),
+            input_name=self.to_text(row.get('comp_name')),
+            output_code=self.to_text(output_code),
+            output_name=self.to_text(output_name),
+            **flags
+        ))
+        if len(self.buffer) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            SearchProcessResult.objects.bulk_create(self.buffer)
+            self.buffer = list()
+
+
+class SearchResultService:
+    """
+    Хранение результатов пересчета на сервере, чтобы их можно было получить по id процесса
+    после завершения фонового пересчета. Строки сметы хранятся в виде JSON lines, сжатого gzip:
+    файл занимает в несколько раз меньше места и читается построчно, без загрузки всего результата в память.
+    """
+
+    @staticmethod
+    def get_path(prc: SearchProcess):
+        return os.path.join(settings.MEDIA_ROOT, 'recalculates', f'{prc.id}.jsonl.gz')
+
+    @classmethod
+    def save(cls, prc: SearchProcess, data: list):
+        path = cls.get_path(prc)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # запись во временный файл, чтобы недописанный результат не был выдан по id процесса
+        tmp_path = f'{path}.tmp'
+        with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=6) as f:
+            for row in data:
+                f.write(json.dumps(row, cls=encoders.JSONEncoder, ensure_ascii=False))
+                f.write('\n')
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def remove(cls, prc: SearchProcess):
+        path = cls.get_path(prc)
+        for p in (path, f'{path}.tmp'):
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def sweep():
+        """
+        Удаляет результаты старше SEARCH_RESULTS_TTL, результаты удаленных процессов и недописанные
+        временные файлы старше ARTIFACT_TTL. Возвращает кол-во удаленных файлов.
+        """
+        fld = os.path.join(settings.MEDIA_ROOT, 'recalculates')
+        if not os.path.isdir(fld):
+            return 0
+        now = time.time()
+        removed = 0
+        # id процесса -> пути его результатов
+        results = dict()
+        for name in os.listdir(fld):
+            path = os.path.join(fld, name)
+            try:
+                age = now - os.path.getmtime(path)
+            except FileNotFoundError:
+                continue
+            is_tmp = name.endswith('.tmp')
+            if age > (settings.ARTIFACT_TTL if is_tmp else settings.SEARCH_RESULTS_TTL):
+                try:
+                    os.remove(path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+                continue
+            prc_id = name.split('.')[0]
+            if not is_tmp and prc_id.isdigit():
+                results.setdefault(int(prc_id), []).append(path)
+
+        existing = set(SearchProcess.objects.filter(id__in=results).values_list('id', flat=True))
+        for prc_id, paths in results.items():
+            if prc_id in existing:
+                continue
+            for path in paths:
+                try:
+                    os.remove(path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    @classmethod
+    def iter_rows(cls, prc: SearchProcess):
+        """
+        Возвращает генератор строк результата пересчета. Ошибки отсутствия результата
+        выбрасываются сразу, до начала чтения.
+        """
+        if prc.is_active:
+            raise SearchNotFinished
+        try:
+            f = gzip.open(cls.get_path(prc), 'rt', encoding='utf-8')
+        except FileNotFoundError:
+            raise SearchResultNotFound
+        return cls.read_rows(f)
+
+    @staticmethod
+    def read_rows(f):
+        with f:
+            for line in f:
+                yield json.loads(line)
+
+    @classmethod
+    def iter_file_rows(cls, prc: SearchProcess):
+        """
+        Возвращает генератор строк результата пересчета в виде, который принимает SearchService.get_file
+        """
+        return ({
+            'comp_code': row.get('comp_code'),
+            'comp_name': row.get('comp_name'),
+            'code': row.get('our_code'),
+            'name': row.get('our_name'),
+        } for row in cls.iter_rows(prc))
+
+    @classmethod
+    def load(cls, prc: SearchProcess):
+        return list(cls.iter_rows(prc))
+
+
 class UploadDatafileService:
     nomenclature_iek_require_columns = {
         'Артикул': 'code',
@@ -688,55 +1081,56 @@ class UploadDatafileService:
         invalid = 0  # кол-во пропущенных строк, не прошедших валидацию
         valid = 0  # кол-во строк, прошедших валидацию
         df = pd.read_excel(file, sheet_name='DATA')
-        for row_index, row in df.iterrows():
-            data = cls.get_row_data(row.items(), cls.nomenclature_iek_require_columns)
-            cls.check_required_columns(data, cls.nomenclature_iek_require_columns)
-
-            code = data.get('code')
-            name = data.get('name')
-            category = data.get('category')
-            cost = data.get('cost')
-            comment = data.get('comment')
-            promotion_description = data.get('promotion_description')
-            photo_list = data.get('photo_list')
-            photo_list = photo_list.split(' ') if not pd.isna(photo_list) else list()
-
-            # если в строке не указан артикул или наименование, пропускаем строку как невалидную
-            if pd.isna(code) or pd.isna(name):
-                invalid += 1
-                continue
+        with CatalogVersionService.batch():
+            for row_index, row in df.iterrows():
+                data = cls.get_row_data(row.items(), cls.nomenclature_iek_require_columns)
+                cls.check_required_columns(data, cls.nomenclature_iek_require_columns)
+
+                code = data.get('code')
+                name = data.get('name')
+                category = data.get('category')
+                cost = data.get('cost')
+                comment = data.get('comment')
+                promotion_description = data.get('promotion_description')
+                photo_list = data.get('photo_list')
+                photo_list = photo_list.split(' ') if not pd.isna(photo_list) else list()
+
+                # если в строке не указан артикул или наименование, пропускаем строку как невалидную
+                if pd.isna(code) or pd.isna(name):
+                    invalid += 1
+                    continue
+
+                # если указана категория номенклатуры, которой нет в базе данных, пропускаем строку как невалидную
+                if not pd.isna(category) and not EquipmentCategory.objects.filter(name=category).exists():
+                    invalid += 1
+                    continue
+
+                try:
+                    equipment = OurEquipment.objects.get(code=data.get('code'))
+                except OurEquipment.DoesNotExist:
+                    equipment = OurEquipment(code=code)
+
+                equipment.approved = False
+                equipment.name = name
+                equipment.category = EquipmentCategory.objects.get(name=category)
+                if not pd.isna(cost):
+                    equipment.cost = cost
+                if not pd.isna(comment):
+                    equipment.comment = str(comment)
+                if not pd.isna(promotion_description):
+                    equipment.is_promotion = True
+                    equipment.promotion_description = str(promotion_description)
+                else:
+                    equipment.is_promotion = False
+                    equipment.promotion_description = ''
 
-            # если указана категория номенклатуры, которой нет в базе данных, пропускаем строку как невалидную
-            if not pd.isna(category) and not EquipmentCategory.objects.filter(name=category).exists():
-                invalid += 1
-                continue
+                equipment.save()
 
-            try:
-                equipment = OurEquipment.objects.get(code=data.get('code'))
-            except OurEquipment.DoesNotExist:
-                equipment = OurEquipment(code=code)
-
-            equipment.approved = False
-            equipment.name = name
-            equipment.category = EquipmentCategory.objects.get(name=category)
-            if not pd.isna(cost):
-                equipment.cost = cost
-            if not pd.isna(comment):
-                equipment.comment = str(comment)
-            if not pd.isna(promotion_description):
-                equipment.is_promotion = True
-                equipment.promotion_description = str(promotion_description)
-            else:
-                equipment.is_promotion = False
-                equipment.promotion_description = ''
-
-            equipment.save()
-
-            if len(photo_list):
-                cls.fetch_new_equipment_photo(equipment, photo_list)
-            cls.set_our_equipment_properties(equipment, data.get('properties'), category)
-
-            valid += 1
+                if len(photo_list):
+                    cls.fetch_new_equipment_photo(equipment, photo_list)
+                cls.set_our_equipment_properties(equipment, data.get('properties'), category)
+
+                valid += 1
 
         return invalid, valid
 
@@ -753,40 +1147,41 @@ class UploadDatafileService:
         invalid = 0  # кол-во пропущенных строк, не прошедших валидацию
         valid = 0  # кол-во строк, прошедших валидацию
         df = pd.read_excel(file, sheet_name='DATA')
-        for row_index, row in df.iterrows():
-            data = cls.get_row_data(row.items(), cls.nomenclature_competitor_require_columns)
-            cls.check_required_columns(data, cls.nomenclature_competitor_require_columns)
-
-            competitor = data.get('competitor')
-            code = data.get('code')
-            name = data.get('name')
-            category = data.get('category')
-
-            # если в строке не указан артикул или наименование, пропускаем строку как невалидную
-            if pd.isna(code):
-                invalid += 1
-                continue
-            if pd.isna(name):
-                name = None
+        with CatalogVersionService.batch():
+            for row_index, row in df.iterrows():
+                data = cls.get_row_data(row.items(), cls.nomenclature_competitor_require_columns)
+                cls.check_required_columns(data, cls.nomenclature_competitor_require_columns)
+
+                competitor = data.get('competitor')
+                code = data.get('code')
+                name = data.get('name')
+                category = data.get('category')
+
+                # если в строке не указан артикул или наименование, пропускаем строку как невалидную
+                if pd.isna(code):
+                    invalid += 1
+                    continue
+                if pd.isna(name):
+                    name = None
+
+                # если указана категория номенклатуры, которой нет в базе данных, пропускаем строку как невалидную
+                if not pd.isna(category) and not EquipmentCategory.objects.filter(name=category).exists():
+                    invalid += 1
+                    continue
+
+                try:
+                    nom = CompetitorsEquipment.objects.get(code=data.get('code'))
+                except CompetitorsEquipment.DoesNotExist:
+                    nom = CompetitorsEquipment(code=code)
+
+                nom.name = name
+                nom.competitor, _ = Competitor.objects.get_or_create(name=competitor)
+                nom.category = EquipmentCategory.objects.get(name=category)
+
+                nom.save()
+                cls.set_comp_equipment_properties(nom, data.get('properties'), category)
 
-            # если указана категория номенклатуры, которой нет в базе данных, пропускаем строку как невалидную
-            if not pd.isna(category) and not EquipmentCategory.objects.filter(name=category).exists():
-                invalid += 1
-                continue
-
-            try:
-                nom = CompetitorsEquipment.objects.get(code=data.get('code'))
-            except CompetitorsEquipment.DoesNotExist:
-                nom = CompetitorsEquipment(code=code)
-
-            nom.name = name
-            nom.competitor, _ = Competitor.objects.get_or_create(name=competitor)
-            nom.category = EquipmentCategory.objects.get(name=category)
-
-            nom.save()
-            cls.set_comp_equipment_properties(nom, data.get('properties'), category)
-
-            valid += 1
+                valid += 1
 
         return invalid, valid
 
@@ -803,38 +1198,40 @@ class UploadDatafileService:
         invalid = 0  # кол-во пропущенных строк, не прошедших валидацию
         valid = 0  # кол-во строк, прошедших валидацию
         df = pd.read_excel(file, sheet_name='DATA')
-        for row_index, row in df.iterrows():
-            data = cls.get_row_data(row.items(), cls.nomenclature_keys_require_columns)
-            cls.check_required_columns(data, cls.nomenclature_keys_require_columns)
-
-            code = data.get('code')
-            comp_code = data.get('comp_code')
-            search_key_string = data.get('search_key_string')
-            search_key_type = data.get('search_key_type')
-
-            # если в одном из столбцов нет данных, строка считается невалидной
-            if pd.isna(code) or pd.isna(comp_code) or pd.isna(search_key_string) or pd.isna(search_key_type):
-                invalid += 1
-                continue
-
-            try:
-                our_equipment = OurEquipment.objects.get(code=code)
-                comp_equipment = CompetitorsEquipment.objects.get(code=comp_code)
-            except (OurEquipment.DoesNotExist, CompetitorsEquipment.DoesNotExist,):
-                invalid += 1
-                continue
+        with CatalogVersionService.batch():
+            for row_index, row in df.iterrows():
+                data = cls.get_row_data(row.items(), cls.nomenclature_keys_require_columns)
+                cls.check_required_columns(data, cls.nomenclature_keys_require_columns)
+
+                code = data.get('code')
+                comp_code = data.get('comp_code')
+                search_key_string = data.get('search_key_string')
+                search_key_type = data.get('search_key_type')
+
+                # если в одном из столбцов нет данных, строка считается невалидной
+                if pd.isna(code) or pd.isna(comp_code) or pd.isna(search_key_string) or pd.isna(search_key_type):
+                    invalid += 1
+                    continue
+
+                try:
+                    our_equipment = OurEquipment.objects.get(code=code)
+                    comp_equipment = CompetitorsEquipment.objects.get(code=comp_code)
+                except (OurEquipment.DoesNotExist, CompetitorsEquipment.DoesNotExist,):
+                    invalid += 1
+                    continue
+
+                try:
+                    kw = KeyWord.objects.get(
+                        keyword=search_key_string, our_equipment=our_equipment, comp_equipment=comp_equipment)
+                    kw.approved = False
+                    kw.type = cls.key_type_signs.get(search_key_type)
+                    kw.save()
+                except KeyWord.DoesNotExist:
+                    kw = KeyWord(keyword=search_key_string, our_equipment=our_equipment, comp_equipment=comp_equipment,
+                                 is_approved=False)
+                    kw.save()
+                valid += 1
 
-            try:
-                kw = KeyWord.objects.get(
-                    keyword=search_key_string, our_equipment=our_equipment, comp_equipment=comp_equipment)
-                kw.approved = False
-                kw.type = cls.key_type_signs.get(search_key_type)
-                kw.save()
-            except KeyWord.DoesNotExist:
-                kw = KeyWord(keyword=search_key_string, our_equipment=our_equipment, comp_equipment=comp_equipment,
-                             is_approved=False)
-                kw.save()
-            valid += 1
         return invalid, valid
 
     @classmethod
@@ -850,20 +1247,21 @@ class UploadDatafileService:
         invalid = 0  # кол-во пропущенных строк, не прошедших валидацию
         valid = 0  # кол-во строк, прошедших валидацию
         df = pd.read_excel(file, sheet_name='DATA')
-        for row_index, row in df.iterrows():
-            data = cls.get_row_data(row.items(), cls.category_require_columns)
-            cls.check_required_columns(data, cls.category_require_columns)
-
-            category_name = data.get('category')
-            property_name = data.get('property')
-            value_str = data.get('value')
-            try:
-                category, _ = EquipmentCategory.objects.get_or_create(name=category_name)
-                property, _ = EquipmentCategoryProperty.objects.get_or_create(category=category, name=property_name)
-                value, _ = EquipmentCategoryPropertyValue.objects.get_or_create(property=property, value=value_str)
-                valid += 1
-            except:
-                invalid += 1
+        with CatalogVersionService.batch():
+            for row_index, row in df.iterrows():
+                data = cls.get_row_data(row.items(), cls.category_require_columns)
+                cls.check_required_columns(data, cls.category_require_columns)
+
+                category_name = data.get('category')
+                property_name = data.get('property')
+                value_str = data.get('value')
+                try:
+                    category, _ = EquipmentCategory.objects.get_or_create(name=category_name)
+                    property, _ = EquipmentCategoryProperty.objects.get_or_create(category=category, name=property_name)
+                    value, _ = EquipmentCategoryPropertyValue.objects.get_or_create(property=property, value=value_str)
+                    valid += 1
+                except:
+                    invalid += 1
 
         return invalid, valid
 
@@ -877,10 +1275,7 @@ class DownloadDatafileService:
             'Поисковой ключ': d.get('keyword'),
         }) for d in kwds.order_by('our_equipment').values('our_equipment__code', 'comp_equipment__code', 'keyword')])
         ltime = timezone.localtime(timezone.now()).strftime('%Y-%m-%d_%H-%M')
-        fld = os.path.join(settings.MEDIA_ROOT, 'download', 'kwds')
-        if not os.path.exists(fld):
-            os.makedirs(fld)
-        path = os.path.join(fld, f'asist_kwds_{ltime}.xlsx')
+        path = ArtifactService.create(os.path.join('download', 'kwds'), f'asist_kwds_{ltime}.xlsx')
         df.to_excel(path, index=False, sheet_name='DATA')
         return path
 
@@ -913,10 +1308,7 @@ class DownloadDatafileService:
             'description', 'sale_description', 'is_sale'
         )])
         ltime = timezone.localtime(timezone.now()).strftime('%Y-%m-%d_%H-%M')
-        fld = os.path.join(settings.MEDIA_ROOT, 'download', 'our_equipment')
-        if not os.path.exists(fld):
-            os.makedirs(fld)
-        path = os.path.join(fld, f'asist_our_equipment_{ltime}.xlsx')
+        path = ArtifactService.create(os.path.join('download', 'our_equipment'), f'asist_our_equipment_{ltime}.xlsx')
         df.to_excel(path, index=False, sheet_name='DATA')
         return path
 
@@ -938,10 +1330,7 @@ class DownloadDatafileService:
         }) for d in equipment.values(
             'id', 'category_id', 'competitor__name', 'code', 'name', 'category__name')])
         ltime = timezone.localtime(timezone.now()).strftime('%Y-%m-%d_%H-%M')
-        fld = os.path.join(settings.MEDIA_ROOT, 'download', 'comp_equipment')
-        if not os.path.exists(fld):
-            os.makedirs(fld)
-        path = os.path.join(fld, f'asist_comp_equipment_{ltime}.xlsx')
+        path = ArtifactService.create(os.path.join('download', 'comp_equipment'), f'asist_comp_equipment_{ltime}.xlsx')
         df.to_excel(path, index=False, sheet_name='DATA')
         return path
 
@@ -956,19 +1345,10 @@ class DownloadDatafileService:
                 }))
         df = pd.DataFrame(properties_list).sort_values(['Категория', 'Свойство'])
         ltime = timezone.localtime(timezone.now()).strftime('%Y-%m-%d_%H-%M')
-        fld = os.path.join(settings.MEDIA_ROOT, 'downloads', 'categories')
-        if not os.path.exists(fld):
-            os.makedirs(fld)
-        path = os.path.join(fld, f'asist_categories_{ltime}.xlsx')
+        path = ArtifactService.create(os.path.join('download', 'categories'), f'asist_categories_{ltime}.xlsx')
         df.to_excel(path, index=False, sheet_name='DATA')
         return path
 
     @staticmethod
-    def get_file_response(path: str, filename: str, rm: int = None):
-        response = FileResponse(open(path, 'rb'), as_attachment=True, filename=filename)
-        response['Access-Control-Expose-Headers'] = 'Content-Disposition'
-        response['Content-Disposition'] = "attachment; filename=*=UTF-8''" + escape_uri_path(filename)
-        if rm:
-            # удаление временного файла через 'rm' секунд
-            threading.Timer(rm, lambda p: os.remove(p), args=[path]).start()
-        return response
+    def get_file_response(path: str, filename: str = None):
+        return ArtifactService.get_response(path, filename)
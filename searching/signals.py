@@ -0,0 +1,94 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.db.models.signals import pre_delete
+from django.db.models.signals import pre_save
+from django.dispatch import receiver
+
+from .catalog import CatalogVersionService
+from .catalog import CompetitorAnalogService
+from .models import CompetitorsEquipment
+from .models import CompetitorsEquipmentProperty
+from .models import EquipmentCategory
+from .models import EquipmentCategoryProperty
+from .models import EquipmentCategoryPropertyValue
+from .models import EquipmentModel
+from .models import EquipmentUnit
+from .models import KeyWord
+from .models import OurEquipment
+from .models import OurEquipmentProperty
+from .models import SearchProcess
+from .services import SearchResultService
+
+# модели, изменение которых влияет на результаты подбора аналогов
+catalog_models = (
+    EquipmentCategory,
+    EquipmentCategoryProperty,
+    EquipmentCategoryPropertyValue,
+    OurEquipmentProperty,
+    CompetitorsEquipmentProperty,
+    EquipmentModel,
+    EquipmentUnit,
+    OurEquipment,
+    CompetitorsEquipment,
+    KeyWord,
+)
+
+
+def catalog_changed(sender, instance, **kwargs):
+    """
+    Отмечает изменение каталога при сохранении или удалении любой записи каталога,
+    независимо от того, через какой интерфейс она изменена
+    """
+    if kwargs.get('raw'):
+        return
+    if sender is KeyWord:
+        CompetitorAnalogService.touch(comp_ids=[instance.comp_equipment_id])
+    elif sender is OurEquipment:
+        CompetitorAnalogService.touch(our_ids=[instance.id])
+    CatalogVersionService.bump()
+
+
+# подключение по каждой модели, чтобы не отключать быстрое удаление для остальных моделей
+for model in catalog_models:
+    post_save.connect(catalog_changed, sender=model)
+    post_delete.connect(catalog_changed, sender=model)
+
+
+@receiver(pre_save, sender=KeyWord)
+def keyword_moved(sender, instance, **kwargs):
+    """
+    Ключ мог быть перепривязан к другой номенклатуре конкурента - ее соответствия тоже перестраиваются
+    """
+    if instance.pk and not kwargs.get('raw'):
+        CompetitorAnalogService.touch(comp_ids=KeyWord.objects.filter(pk=instance.pk).values_list(
+            'comp_equipment_id', flat=True))
+
+
+@receiver(pre_delete, sender=OurEquipment)
+def our_equipment_deleted(sender, instance, **kwargs):
+    """
+    После удаления номенклатуры ИЕК ключи отвязываются от нее, поэтому конкуренты отмечаются заранее
+    """
+    CompetitorAnalogService.touch(comp_ids=KeyWord.objects.filter(our_equipment=instance).values_list(
+        'comp_equipment_id', flat=True))
+
+
+@receiver(post_delete, sender=SearchProcess)
+def search_process_deleted(sender, instance, **kwargs):
+    """
+    Результат пересчета хранится в файле и без процесса больше не может быть получен
+    """
+    SearchResultService.remove(instance)
+
+
+@receiver(connection_created)
+def set_trigram_threshold(sender, connection, **kwargs):
+    """
+    Порог оператора % нечеткого поиска задается один раз на подключение, а не перед каждым запросом
+    """
+    if connection.vendor == 'postgresql' and settings.SEARCH_TRIGRAM_ENABLED:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT set_config('pg_trgm.similarity_threshold', %s, false)",
+                           [str(settings.SEARCH_TRIGRAM_THRESHOLD)])
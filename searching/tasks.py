@@ -0,0 +1,77 @@
+from celery import shared_task
+
+from .artifacts import ArtifactService
+from .exceptions import Interrupt
+from .models import SearchProcess
+from .services import SearchResultService
+from .services import SearchService
+
+
+def run_recalculate(prc: SearchProcess, rows: list, exc_mdls: list):
+    try:
+        SearchService.do_recalculate(rows, prc, exc_mdls)
+    except Interrupt:
+        pass
+    except Exception as e:
+        prc.error(str(e))
+        raise
+    finally:
+        finish(prc)
+
+
+def finish(prc: SearchProcess):
+    """
+    Отправляет клиенту итоговое состояние процесса. Флаги перечитываются из базы данных,
+    т.к. остановка пересчета выставляется другим запросом.
+    """
+    prc.refresh_from_db(fields=('is_active', 'is_success', 'is_error', 'is_interrupted', 'error_detail'))
+    SearchService.process_status(prc)
+
+
+@shared_task
+def recalculate(prc_id: int, rows: list, exc_mdls: list):
+    """
+    Фоновый пересчет сметы. Прогресс передается в сокет пользователя,
+    результат сохраняется на сервере и выдается по id процесса.
+
+    prc_id      <-  id процесса пересчета
+    rows        <-  Массив строк сметы в виде списка словарей
+    exc_mdls    <-  Список id линеек, которые требуется исключить из подбора
+    """
+    prc = SearchProcess.objects.select_related('user').get(id=prc_id)
+    run_recalculate(prc, rows, exc_mdls)
+
+
+@shared_task
+def recalculate_file(prc_id: int, path: str, exc_mdls: list):
+    """
+    Фоновый разбор и пересчет файла сметы, сохраненного SearchService.save_upload.
+    Файл удаляется после разбора, результат сохраняется на сервере и выдается по id процесса.
+
+    prc_id      <-  id процесса пересчета
+    path        <-  Путь до файла сметы
+    exc_mdls    <-  Список id линеек, которые требуется исключить из подбора
+    """
+    prc = SearchProcess.objects.select_related('user').get(id=prc_id)
+    try:
+        rows = list(SearchService.get_prepare_data(path))
+    except (ValueError, AttributeError,):
+        prc.error('Загруженный файл не является валидным файлом сметы. Попробуйте скачать новый шаблон')
+        finish(prc)
+        return
+    except Exception as e:
+        prc.error(str(e))
+        finish(prc)
+        raise
+    finally:
+        ArtifactService.remove(path)
+    run_recalculate(prc, rows, exc_mdls)
+
+
+@shared_task
+def sweep_artifacts():
+    """
+    Периодическая очистка временных файлов и устаревших результатов пересчета
+    (расписание задается в CELERY_BEAT_SCHEDULE)
+    """
+    return ArtifactService.sweep() + SearchResultService.sweep()
@@ -1,3 +1,992 @@
+import gzip
+import io
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.db import transaction
+from django.test import SimpleTestCase
 from django.test import TestCase
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http.response import FileResponse
+from django.utils import timezone
+from django.utils.encoding import escape_uri_path
+
+from openpyxl import Workbook
+from openpyxl import load_workbook
+import redis
+
+from rest_framework.test import APIRequestFactory
+from rest_framework.test import force_authenticate
+
+from .artifacts import ArtifactService
+from .catalog import CatalogVersionService
+from .catalog import CompetitorAnalogService
+from .exceptions import Interrupt
+from .indexes import AnalogIndex
+from .indexes import CategoryMatrix
+from .indexes import ExcludedEquipment
+from .models import Competitor
+from .models import CompetitorAnalog
+from .models import CompetitorsEquipment
+from .models import EquipmentCategory
+from .models import EquipmentCategoryProperty
+from .models import EquipmentCategoryPropertyValue
+from .models import EquipmentModel
+from .models import EquipmentUnit
+from .models import KeyWord
+from .models import OurEquipment
+from .models import OurEquipmentProperty
+from .models import SearchProcess
+from .models import TemporaryArtifact
+from .services import InterruptChecker
+from .services import SearchMatchCache
+from .services import SearchProcessCounters
+from .services import SearchProcessResultWriter
+from .services import SearchProgressPublisher
+from .services import SearchResultService
+from .services import SearchService
+from .signals import set_trigram_threshold
+from .tasks import recalculate
+from .tasks import recalculate_file
+from .tasks import sweep_artifacts
+from .utils import normalize_key
+from .views.main_views import Recalculates
+
+
+def create_catalog():
+    """
+    Категория автоматов с двумя характеристиками (ток, полюса), номенклатура ИЕК,
+    номенклатура конкурента и поисковые ключи к ней
+    """
+    cat = EquipmentCategory.objects.create(name='Автоматы')
+    unit = EquipmentUnit.objects.create(name='шт')
+    current = EquipmentCategoryProperty.objects.create(category=cat, name='Ток')
+    poles = EquipmentCategoryProperty.objects.create(category=cat, name='Полюса')
+    values = {
+        value: EquipmentCategoryPropertyValue.objects.create(property=prop, value=value)
+        for prop, value in ((current, '16А'), (current, '25А'), (poles, '1P'), (poles, '2P'))
+    }
+    model = EquipmentModel.objects.create(category=cat, name='ВА47-60')
+    equipment = dict()
+    for key, name, code, count, eq_model, eq_values in (
+            ('a', 'ВА47-29 1P 16А', 'MVA20-1-016-C', 5, None, ('16А', '1P')),
+            ('b', 'ВА47-29 1P 25А', 'MVA20-1-025-C', 0, None, ('25А', '1P')),
+            ('c', 'ВА47-60 1P 16А', 'MVA40-1-016-C', 3, model, ('16А', '1P')),
+            ('d', 'ВА47-29 2P 16А', 'MVA20-2-016-C', 1, None, ('16А', '2P'))):
+        eq = equipment[key] = OurEquipment.objects.create(
+            category=cat, unit=unit, name=name, code=code, cost=100, count=count, model=eq_model)
+        for value in eq_values:
+            OurEquipmentProperty.objects.create(equipment=eq, property=values[value].property, value=values[value])
+    comp = Competitor.objects.create(name='ABB')
+    comp_eq = CompetitorsEquipment.objects.create(competitor=comp, category=cat, code='2CDS251001R0164',
+                                                  name='S201 C16')
+    for keyword, eq in (('S201 C16', equipment['a']), ('S201 C16', equipment['c']), ('SH201', equipment['b']),
+                        ('12345', equipment['a']), ('67890', equipment['b'])):
+        KeyWord.objects.create(keyword=keyword, our_equipment=eq, comp_equipment=comp_eq)
+    # соответствия аналогов строятся при фиксации транзакции, которой в тесте нет
+    CompetitorAnalogService.rebuild()
+    return cat, model, values, equipment
+
+
+def estimate_row(comp_code, comp_name, comp_count=1):
+    return {'comp_code': comp_code, 'comp_name': comp_name, 'comp_unit': 'шт', 'comp_count': comp_count}
+
+
+def estimate_file(rows, sheet='Спецификация'):
+    """
+    Файл сметы .xlsx со строками под заголовком в SearchService.estimate_header_row
+    """
+    wb = Workbook()
+    ws = wb.active
+    ws.title = sheet
+    header = ('Артикул', 'Наименование/описание', 'Ед. изм.', 'Кол-во', 'Артикул ITK/IEK')
+    for i, values in enumerate((header,) + tuple(rows)):
+        for j, value in enumerate(values, 1):
+            ws.cell(row=SearchService.estimate_header_row + i, column=j, value=value)
+    f = io.BytesIO()
+    wb.save(f)
+    f.seek(0)
+    return f
+
+
+@override_settings(
+    SEARCH_CACHE_ENABLED=False,
+    SEARCH_CATALOG_LISTEN=False,
+    SEARCH_TRIGRAM_ENABLED=False,
+    SEARCH_POOL_WORKERS=1,
+    LOG_ASYNC=False,
+)
+class RecalculateTestCase(TestCase):
+    """
+    Пересчет на тестовом каталоге без внешних служб: без Redis, уведомлений PostgreSQL и пула процессов.
+    Сообщения в сокет пользователя перехватываются подменой слоя каналов.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category, cls.model, cls.values, cls.equipment = create_catalog()
+        cls.user = get_user_model().objects.create(username='user', email='user@example.com',
+                                                   rows_to_recalculate_available=1000)
+
+    def setUp(self):
+        # повышение версии каталога, отложенное при создании тестовых данных, в TestCase не выполняется
+        # и без сброса скрывало бы повышения, запланированные в самих тестах
+        connection.run_on_commit = [(sids, func) for sids, func in connection.run_on_commit
+                                    if func != CatalogVersionService.commit]
+        AnalogIndex.clear_shared()
+        ExcludedEquipment.clear_shared()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        media_root = self.settings(MEDIA_ROOT=media.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.layer = mock.Mock(group_send=mock.AsyncMock())
+        patcher = mock.patch('searching.services.get_channel_layer', return_value=self.layer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def recalculate(self, data, exc_mdls=None, batch=True):
+        """
+        Пересчитывает строки сметы и возвращает результат и кол-во вызовов match_row
+        """
+        self.prc = SearchProcess.objects.create(user=self.user, psp=80)
+        with mock.patch.object(SearchService, 'match_row', side_effect=SearchService.match_row) as match_row:
+            result = SearchService.do_recalculate(data, self.prc, exc_mdls or list(), batch=batch)
+        self.prc.refresh_from_db()
+        return result, match_row.call_count
+
+    @contextmanager
+    def catalog_changes(self):
+        """
+        Выполняет действия, отложенные до фиксации изменений каталога, и убирает их из очереди транзакции,
+        как это происходит при фиксации настоящей транзакции
+        """
+        start = len(connection.run_on_commit)
+        with self.captureOnCommitCallbacks(execute=True):
+            yield
+        del connection.run_on_commit[start:]
+
+    def messages(self):
+        """
+        Группы и разобранные сообщения, отправленные в сокет
+        """
+        return [(args[0], json.loads(args[1]['message'])) for args, kwargs in self.layer.group_send.call_args_list]
+
+    def request(self, method, action, data=None, pk=None):
+        request = getattr(APIRequestFactory(), method)('/', data, format='json')
+        force_authenticate(request, self.user)
+        kwargs = {'pk': pk} if pk else dict()
+        return Recalculates.as_view({method: action})(request, **kwargs)
+
+    def status(self):
+        # последнее сообщение в сокет - итоговое состояние процесса
+        group, message = self.messages()[-1]
+        self.assertEqual(group, f'search-progress-{self.user.id}')
+        return message
+
+
+class BatchModeTest(RecalculateTestCase):
+
+    def test_same_as_full_index(self):
+        data = [
+            estimate_row('MVA20-1-016-C', 'x'),
+            # наименование той же номенклатуры, что найдена по артикулу в другой строке
+            estimate_row('nope', 'ВА47-29 1P 16А'),
+            estimate_row('nope', 'ВА47-29 1P 25А'),
+            estimate_row('2CDS251001R0164', 'x'),
+            estimate_row('zzz', 'S201 C16'),
+            estimate_row('SH201', 'q'),
+            estimate_row('nope', 'Автомат 2P 16А'),
+            estimate_row('nope', 'ничего'),
+        ]
+        results = dict()
+        for batch in (True, False):
+            result, calls = self.recalculate([dict(row) for row in data], batch=batch)
+            results[batch] = [(row.get('our_code'), row.get('similar')) for row in result]
+        self.assertEqual(results[True], results[False])
+        self.assertEqual([code for code, similar in results[True]], [
+            'MVA20-1-016-C', 'MVA20-1-016-C', 'MVA20-1-025-C', 'MVA20-1-016-C', 'MVA20-1-016-C', 'MVA20-1-025-C',
+            'MVA20-2-016-C', None])
+
+    def test_queries_do_not_depend_on_rows(self):
+        def count(rows):
+            with CaptureQueriesContext(connection) as queries:
+                AnalogIndex.for_rows(rows)
+            return len(queries)
+
+        rows = [estimate_row(eq.code, eq.name) for eq in self.equipment.values()]
+        rows += [estimate_row(f'nope-{i}', f'ничего {i}') for i in range(10)]
+        self.assertEqual(count(rows[:2] + rows[-1:]), count(rows))
+
+class DeduplicateRowsTest(RecalculateTestCase):
+
+    def test_duplicates_matched_once(self):
+        a, b, c = self.equipment['a'], self.equipment['b'], self.equipment['c']
+        data = [
+            estimate_row('MVA20-1-016-C', 'x', 10),
+            {'comp_code': 'Раздел 1', 'comp_name': None},
+            # тот же артикул с кириллическими буквами и пробелами
+            estimate_row(' mvа20 -1-016-с', 'x', 3),
+            estimate_row('2CDS251001R0164', 'x', 2),
+            estimate_row('nope', 'ничего'),
+            estimate_row('2CDS251001R0164', 'x', 7),
+            estimate_row('nope', 'ничего', 4),
+        ]
+        for batch in (True, False):
+            with self.subTest(batch=batch):
+                result, calls = self.recalculate([dict(row) for row in data], batch=batch)
+                self.assertEqual(calls, 3)
+                self.assertEqual([row.get('our_code') for row in result],
+                                 [a.code, None, a.code, a.code, None, a.code, None])
+                # количество подставляется по каждой строке, а не по первой из одинаковых
+                self.assertEqual([result[i]['our_count'] for i in (0, 2, 3, 5)], [5, 3, 2, 5])
+                self.assertEqual(result[3]['similar'], [[b.id, 100], [c.id, 100]])
+                self.assertEqual(result[5]['similar'], result[3]['similar'])
+                self.assertEqual((self.prc.rows_count, self.prc.match_rows_count, self.prc.unmatch_rows_count,
+                                  self.prc.skip_rows_count, self.prc.is_success), (7, 4, 2, 1, True))
+                self.assertEqual(list(self.prc.results.order_by('id').values_list('is_match', 'is_unmatch', 'is_skip')),
+                                 [(True, False, False), (False, False, True), (True, False, False),
+                                  (True, False, False), (False, True, False), (True, False, False),
+                                  (False, True, False)])
+
+    def test_numeric_names(self):
+        a, b = self.equipment['a'], self.equipment['b']
+        data = [
+            estimate_row('nope', 12345),
+            estimate_row('nope', 67890),
+            # число из ячейки с дробной частью совпадает с целым так же, как в точных ступенях
+            estimate_row('nope', 12345.0),
+            # строковое наименование подбирается отдельно от числового
+            estimate_row('nope', '12345'),
+        ]
+        result, calls = self.recalculate(data)
+        self.assertEqual(calls, 3)
+        self.assertEqual([row.get('our_code') for row in result], [a.code, b.code, a.code, a.code])
+        self.assertEqual(len({SearchService.match_key(row) for row in data}), 3)
+
+
+class ExcludedModelsTest(RecalculateTestCase):
+
+    def test_excluded_models(self):
+        a, b = self.equipment['a'], self.equipment['b']
+        data = [
+            estimate_row('MVA40-1-016-C', 'x'),
+            estimate_row('zzz', 'S201 C16'),
+            estimate_row('nope', 'Автомат 1P 16А'),
+        ]
+        for batch in (True, False):
+            with self.subTest(batch=batch):
+                result, calls = self.recalculate([dict(row) for row in data], exc_mdls=[self.model.id], batch=batch)
+                self.assertEqual([row.get('our_code') for row in result], [None, a.code, a.code])
+                # аналоги номенклатуры конкурента без исключенной линейки
+                self.assertEqual(result[1]['similar'], [[b.id, 100]])
+                # без исключения номенклатура линейки ВА47-60 была бы вторичным аналогом с тем же процентом
+                self.assertFalse(result[2]['exactly_match'])
+                self.assertNotIn('similar', result[2])
+
+    def test_shared(self):
+        excluded = ExcludedEquipment.shared([self.model.id, self.model.id])
+        self.assertEqual(excluded.ids, {self.equipment['c'].id})
+        self.assertIs(ExcludedEquipment.shared([self.model.id]), excluded)
+        # после изменения каталога множество вычисляется заново
+        with mock.patch.object(CatalogVersionService, 'get', return_value=CatalogVersionService.get() + 1):
+            self.assertIsNot(ExcludedEquipment.shared([self.model.id]), excluded)
+        self.assertFalse(ExcludedEquipment.shared(list()))
+
+
+class CompetitorAnalogTest(RecalculateTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.comp_eq = CompetitorsEquipment.objects.get()
+        self.keys = {eq.id: key for key, eq in self.equipment.items()}
+
+    def analogs(self):
+        return [self.keys[our_id] for our_id in CompetitorAnalog.objects.get(comp_equipment=self.comp_eq).analogs]
+
+    def test_keyword_added(self):
+        self.assertEqual(self.analogs(), ['a', 'b', 'c'])
+        with self.catalog_changes():
+            KeyWord.objects.create(keyword='S201', our_equipment=self.equipment['d'], comp_equipment=self.comp_eq)
+        # аналоги упорядочены по наименованию номенклатуры ИЕК
+        self.assertEqual(self.analogs(), ['a', 'b', 'd', 'c'])
+
+    def test_keyword_moved(self):
+        with self.catalog_changes():
+            other = CompetitorsEquipment.objects.create(competitor=self.comp_eq.competitor, category=self.category,
+                                                        code='2CDS251001R0254', name='S201 C25')
+            for kwd in KeyWord.objects.filter(our_equipment=self.equipment['b']):
+                kwd.comp_equipment = other
+                kwd.save()
+        self.assertEqual(self.analogs(), ['a', 'c'])
+        self.assertEqual(CompetitorAnalog.objects.get(comp_equipment=other).analogs, [self.equipment['b'].id])
+
+    def test_our_equipment_changed(self):
+        c = self.equipment['c']
+        with self.catalog_changes():
+            c.name = 'ВА47-00 1P 16А'
+            c.save()
+        self.assertEqual(self.analogs(), ['c', 'a', 'b'])
+        with self.catalog_changes():
+            self.equipment['b'].delete()
+        self.assertEqual(self.analogs(), ['c', 'a'])
+
+    def test_recalculate_uses_new_analogs(self):
+        with self.catalog_changes():
+            KeyWord.objects.filter(our_equipment=self.equipment['a']).delete()
+        result, calls = self.recalculate([estimate_row('2CDS251001R0164', 'x')])
+        self.assertEqual(result[0]['our_code'], self.equipment['b'].code)
+
+
+@override_settings(SEARCH_SIMILAR_LIMIT=1)
+class SimilarLimitTest(RecalculateTestCase):
+
+    def test_similar_limit(self):
+        a, b = self.equipment['a'], self.equipment['b']
+        result, calls = self.recalculate([estimate_row('2CDS251001R0164', 'x')])
+        # первичный аналог и не более SEARCH_SIMILAR_LIMIT вторичных
+        self.assertEqual((result[0]['our_code'], result[0]['similar']), (a.code, [[b.id, 100]]))
+
+    def test_load_analogs(self):
+        a, b, c, d = (self.equipment[key].id for key in 'abcd')
+        index = AnalogIndex(ExcludedEquipment([a]))
+        # из каждого списка догружаются только первые неисключенные аналоги, которые попадут в выдачу
+        with self.assertNumQueries(1):
+            index.load_analogs({1: [a, b, c, d], 2: [d], 3: list()})
+        self.assertEqual(set(index.equipment), {b, c, d})
+        with self.assertNumQueries(0):
+            self.assertEqual(index.analogs([a, b, c, d]), (self.equipment['b'], [[c, 100]]))
+
+
+class FakeRedis:
+    """
+    Клиент Redis в памяти с командами, которые использует SearchMatchCache
+    """
+
+    def __init__(self):
+        self.data = dict()
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def execute(self):
+        pass
+
+
+@override_settings(SEARCH_CACHE_ENABLED=True)
+class MatchCacheTest(RecalculateTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = FakeRedis()
+        patcher = mock.patch.object(SearchMatchCache, 'client', self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.data = [estimate_row('MVA20-1-016-C', 'x'), estimate_row('2CDS251001R0164', 'x'),
+                     estimate_row('nope', 'ничего')]
+
+    def test_hit_and_miss(self):
+        result, calls = self.recalculate([dict(row) for row in self.data])
+        self.assertEqual((calls, len(self.client.data)), (3, 3))
+        # повторный пересчет берет все результаты из кеша
+        cached, calls = self.recalculate([dict(row) for row in self.data])
+        self.assertEqual(calls, 0)
+        self.assertEqual(cached, result)
+        # с другим процентом совпадения характеристик записи кеша не используются
+        self.assertEqual(SearchMatchCache(50, list()).get_many(self.data), [None] * 3)
+
+    def test_catalog_version(self):
+        self.recalculate([dict(row) for row in self.data])
+        with mock.patch.object(CatalogVersionService, 'get', return_value=CatalogVersionService.get() + 1):
+            result, calls = self.recalculate([dict(row) for row in self.data])
+        self.assertEqual(calls, 3)
+        self.assertEqual(len(self.client.data), 6)
+
+    def test_redis_unavailable(self):
+        with mock.patch.object(self.client, 'mget', side_effect=redis.ConnectionError), \
+                mock.patch.object(self.client, 'execute', side_effect=redis.ConnectionError):
+            result, calls = self.recalculate([dict(row) for row in self.data])
+        # подбор выполняется без кеша
+        self.assertEqual(calls, 3)
+        self.assertEqual([row.get('our_code') for row in result], ['MVA20-1-016-C', 'MVA20-1-016-C', None])
+
+
+class ResultWriterTest(RecalculateTestCase):
+
+    def test_batches(self):
+        prc = SearchProcess.objects.create(user=self.user, psp=80)
+        with self.assertRaises(RuntimeError), SearchProcessResultWriter(prc, size=2) as results:
+            for i in range(3):
+                with self.assertNumQueries(i % 2):
+                    results.add(estimate_row(f'code-{i}', float('nan')), f'MVA-{i}', is_match=True)
+            # оставшиеся строки сохраняются и при ошибке пересчета
+            raise RuntimeError
+        self.assertEqual(list(prc.results.order_by('id').values_list('input_code', 'input_name', 'output_code',
+                                                                       'output_name', 'is_match')),
+                         [(f'code-{i}', '', f'MVA-{i}', '', True) for i in range(3)])
+
+
+class ProgressTest(RecalculateTestCase):
+    def test_lines_coalesced(self):
+        prc = SearchProcess.objects.create(user=self.user, psp=80)
+        with SearchProgressPublisher(prc, interval=3600, size=3) as progress:
+            for i in range(5):
+                progress.add(f'Строка {i}')
+            self.assertEqual(len(self.messages()), 1)
+        # оставшиеся строки отправляются при выходе из контекста
+        messages = self.messages()
+        self.assertEqual([message['logs'] for group, message in messages],
+                         [['Строка 0', 'Строка 1', 'Строка 2'], ['Строка 3', 'Строка 4']])
+        self.assertEqual({group for group, message in messages}, {f'search-progress-{self.user.id}'})
+
+    def test_process_id(self):
+        # у пользователя может идти несколько пересчетов, сообщения различаются по id процесса
+        other = SearchProcess.objects.create(user=self.user, psp=80)
+        with SearchProgressPublisher(other, interval=3600, size=1) as progress:
+            progress.add('Строка')
+        self.recalculate([estimate_row('MVA20-1-016-C', 'x'), estimate_row('nope', 'ничего')])
+        ids = [message['id'] for group, message in self.messages()]
+        self.assertGreater(len(ids), 1)
+        self.assertEqual(ids, [other.id] + [self.prc.id] * (len(ids) - 1))
+
+
+class BackgroundRecalculateTest(RecalculateTestCase):
+
+    def test_search(self):
+        rows = [estimate_row('MVA20-1-016-C', 'x'), estimate_row('nope', 'ничего')]
+        with mock.patch.object(recalculate, 'delay') as delay:
+            response = self.request('post', 'search', {'rows': rows, 'psp': 70})
+        # запрос не ждет окончания пересчета
+        self.assertEqual(response.status_code, 202)
+        prc = SearchProcess.objects.get(id=response.data['id'])
+        self.assertEqual((prc.psp, prc.is_active), (70, True))
+        delay.assert_called_once_with(prc.id, rows, list())
+
+        recalculate(*delay.call_args[0])
+        message = self.status()
+        self.assertEqual((message['id'], message['status'], message['rows_count'], message['match_rows_count']),
+                         (prc.id, 'success', 2, 1))
+        self.assertEqual(self.request('get', 'status', pk=prc.id).data['status'], 'success')
+        result = self.request('get', 'results', pk=prc.id).data
+        self.assertEqual([row.get('our_code') for row in result], ['MVA20-1-016-C', None])
+
+    def test_rows_limit(self):
+        self.user.rows_to_recalculate_available = 1
+        self.user.save()
+        with mock.patch.object(recalculate, 'delay') as delay:
+            response = self.request('post', 'search', {'rows': [estimate_row('nope', 'ничего')] * 2})
+        self.assertEqual(response.status_code, 400)
+        delay.assert_not_called()
+        self.assertFalse(SearchProcess.objects.exists())
+
+    def test_error(self):
+        prc = SearchProcess.objects.create(user=self.user, psp=80)
+        with mock.patch.object(SearchService, 'match_rows_cached', side_effect=RuntimeError('Сбой подбора')), \
+                self.assertRaises(RuntimeError):
+            recalculate(prc.id, [estimate_row('nope', 'ничего')], list())
+        message = self.status()
+        self.assertEqual((message['id'], message['status'], message['error_detail']), (prc.id, 'error', 'Сбой подбора'))
+        prc.refresh_from_db()
+        self.assertEqual((prc.is_active, prc.is_error), (False, True))
+        # результат не сохраняется
+        self.assertFalse(os.path.exists(SearchResultService.get_path(prc)))
+
+
+class SearchFileTest(RecalculateTestCase):
+
+    def search_file(self, f):
+        upload = SimpleUploadedFile('смета.xlsx', f.read())
+        request = APIRequestFactory().post('/', {'file': upload, 'psp': 70}, format='multipart')
+        force_authenticate(request, self.user)
+        with mock.patch.object(recalculate_file, 'delay') as delay:
+            # параметры действия, как их передает роутер
+            response = Recalculates.as_view({'post': 'search_file'}, **Recalculates.search_file.kwargs)(request)
+        self.assertEqual(response.status_code, 202)
+        prc_id, path, exc_mdls = delay.call_args[0]
+        self.assertEqual((prc_id, exc_mdls), (response.data['id'], list()))
+        # файл сметы сохранен на сервере до разбора в фоне
+        self.assertTrue(os.path.exists(path))
+        recalculate_file(prc_id, path, exc_mdls)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(TemporaryArtifact.objects.filter(path=path).exists())
+        return SearchProcess.objects.get(id=prc_id)
+
+    def test_search_file(self):
+        prc = self.search_file(estimate_file([('MVA20-1-016-C', 'x', 'шт', 1), ('Раздел 1',),
+                                              ('nope', 'ничего', 'шт', 2)]))
+        self.assertEqual((self.status()['status'], prc.psp, prc.rows_count), ('success', 70, 3))
+        self.assertEqual([row.get('our_code') for row in SearchResultService.load(prc)],
+                         ['MVA20-1-016-C', None, None])
+
+    def test_invalid_file(self):
+        prc = self.search_file(io.BytesIO(b'not an xlsx file'))
+        message = self.status()
+        self.assertEqual((message['id'], message['status']), (prc.id, 'error'))
+        self.assertIn('не является валидным файлом сметы', prc.error_detail)
+
+
+class SearchResultTest(RecalculateTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.prc = SearchProcess.objects.create(user=self.user, psp=80)
+        self.prc.success()
+        self.rows = [{'comp_code': '2CDS251001R0164', 'comp_name': 'S201 C16', 'our_code': 'MVA20-1-016-C',
+                      'our_name': 'ВА47-29 1P 16А', 'our_cost': 100, 'similar': [[2, 100]]},
+                     {'comp_code': 'Раздел 1', 'comp_name': None}]
+
+    def test_save_and_load(self):
+        SearchResultService.save(self.prc, iter(self.rows))
+        path = SearchResultService.get_path(self.prc)
+        self.assertEqual(os.listdir(os.path.dirname(path)), [os.path.basename(path)])
+        # строки хранятся в виде сжатого JSON lines
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            self.assertEqual([json.loads(line) for line in f], self.rows)
+        self.assertEqual(self.request('get', 'results', pk=self.prc.id).data, self.rows)
+        response = self.request('get', 'file', pk=self.prc.id)
+        ws = load_workbook(io.BytesIO(b''.join(response.streaming_content))).active
+        self.assertEqual([[cell.value for cell in row] for row in ws.iter_rows(min_row=8, min_col=2, max_col=7)],
+                         [['2CDS251001R0164', 'S201 C16', None, None, 'MVA20-1-016-C', 'ВА47-29 1P 16А'],
+                          ['Раздел 1', None, None, None, None, None]])
+        response.close()
+
+    def test_not_available(self):
+        self.assertEqual(self.request('get', 'results', pk=self.prc.id).status_code, 404)
+        active = SearchProcess.objects.create(user=self.user, psp=80)
+        SearchResultService.save(active, self.rows)
+        self.assertEqual(self.request('get', 'results', pk=active.id).status_code, 400)
+
+    def test_process_deleted(self):
+        SearchResultService.save(self.prc, self.rows)
+        path = SearchResultService.get_path(self.prc)
+        self.prc.delete()
+        self.assertFalse(os.path.exists(path))
+
+    def test_sweep(self):
+        # результат процесса, удаленного без сигналов (например, очисткой таблицы в базе данных)
+        deleted = SearchProcess(id=SearchProcess.objects.latest('id').id + 100)
+        fresh, old = self.prc, SearchProcess.objects.create(user=self.user)
+        for prc in (fresh, old, deleted):
+            SearchResultService.save(prc, self.rows)
+        tmp_path = SearchResultService.get_path(fresh) + '.tmp'
+        open(tmp_path, 'w').close()
+        expired = time.time() - settings.SEARCH_RESULTS_TTL - 1
+        for path in (SearchResultService.get_path(old), tmp_path):
+            os.utime(path, (expired, expired))
+        self.assertEqual(SearchResultService.sweep(), 3)
+        self.assertEqual(os.listdir(os.path.dirname(tmp_path)), [os.path.basename(SearchResultService.get_path(fresh))])
+
+
+class ArtifactTest(RecalculateTestCase):
+
+    def create(self, name, ttl=None, content=b'data'):
+        path = ArtifactService.create('downloads', name, ttl)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_response_removes_file(self):
+        path = self.create('смета.xlsx')
+        # одинаковые имена файлов разных выгрузок не совпадают на диске
+        self.assertNotEqual(self.create('смета.xlsx'), path)
+        response = ArtifactService.get_response(path)
+        self.assertIn(f"filename=*=UTF-8''{escape_uri_path('смета.xlsx')}", response['Content-Disposition'])
+        self.assertEqual(b''.join(response.streaming_content), b'data')
+        self.assertTrue(os.path.exists(path))
+        response.close()
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(TemporaryArtifact.objects.filter(path=path).exists())
+
+    def test_sweep(self):
+        fresh, expired = self.create('fresh.xlsx'), self.create('expired.xlsx', ttl=60)
+        TemporaryArtifact.objects.filter(path=expired).update(expires=timezone.now())
+        # файлы без записи удаляются только после ARTIFACT_TTL
+        folder = os.path.dirname(fresh)
+        unknown, old_unknown = os.path.join(folder, 'unknown.xlsx'), os.path.join(folder, 'old.xlsx')
+        for path in (unknown, old_unknown):
+            open(path, 'w').close()
+        old = time.time() - settings.ARTIFACT_TTL - 1
+        os.utime(old_unknown, (old, old))
+        self.assertEqual(sweep_artifacts(), 2)
+        self.assertEqual(sorted(os.listdir(folder)), sorted(os.path.basename(p) for p in (fresh, unknown)))
+        self.assertEqual(list(TemporaryArtifact.objects.values_list('path', flat=True)), [fresh])
+
+
+class InterruptTest(RecalculateTestCase):
+
+    def test_poll_interval(self):
+        prc = SearchProcess.objects.create(user=self.user, psp=80)
+        check_interrupt = InterruptChecker(prc, interval=3600)
+        with self.assertNumQueries(1):
+            check_interrupt()
+        SearchProcess.objects.filter(id=prc.id).update(is_interrupted=True)
+        # до истечения интервала флаг не перечитывается
+        with self.assertNumQueries(0):
+            check_interrupt()
+        with self.assertRaises(Interrupt):
+            InterruptChecker(prc, interval=0)()
+        self.assertTrue(prc.is_interrupted)
+
+    @override_settings(SEARCH_INTERRUPT_POLL_INTERVAL=0)
+    def test_interrupt_running(self):
+        prc = SearchProcess.objects.create(user=self.user, psp=80)
+
+        def search_analog(*args):
+            # остановка пересчета другим запросом после первой строки
+            self.request('post', 'interrupt', pk=prc.id)
+            return search_analog.wrapped(*args)
+
+        search_analog.wrapped = SearchService.search_analog
+        rows = [estimate_row('MVA20-1-016-C', 'x'), estimate_row('MVA20-1-025-C', 'x')]
+        with mock.patch.object(SearchService, 'search_analog', side_effect=search_analog):
+            recalculate(prc.id, rows, list())
+        message = self.status()
+        self.assertEqual((message['id'], message['status'], message['match_rows_count']), (prc.id, 'interrupted', 1))
+        prc.refresh_from_db()
+        self.assertEqual((prc.is_active, prc.is_interrupted, prc.is_success, prc.match_rows_count),
+                         (False, True, False, 1))
+        # результат обработанной строки сохранен
+        self.assertEqual(list(prc.results.values_list('output_code', flat=True)), ['MVA20-1-016-C'])
+
+
+class CountersTest(RecalculateTestCase):
+
+    def test_saved_every_rows(self):
+        prc = SearchProcess.objects.create(user=self.user, psp=80)
+        saved = SearchProcess.objects.filter(id=prc.id)
+        with SearchProcessCounters(prc, rows=2, interval=3600) as counters:
+            for i in range(3):
+                prc.match_rows_count += 1
+                with self.assertNumQueries(i % 2):
+                    counters.tick()
+                self.assertEqual(saved.get().match_rows_count, (i + 1) // 2 * 2)
+        # оставшиеся счетчики сохраняются при выходе из контекста
+        self.assertEqual(saved.get().match_rows_count, 3)
+
+    def test_interrupt_flag_not_overwritten(self):
+        prc = SearchProcess.objects.create(user=self.user, psp=80)
+        with SearchProcessCounters(prc, rows=1, interval=3600) as counters:
+            # остановка другим запросом, объект процесса в памяти о ней не знает
+            SearchProcess.objects.filter(id=prc.id).update(is_interrupted=True)
+            prc.skip_rows_count += 1
+            counters.tick()
+        prc.refresh_from_db()
+        self.assertEqual((prc.skip_rows_count, prc.is_interrupted), (1, True))
+
+
+@override_settings(SEARCH_CATALOG_LISTEN=False)
+class CatalogVersionTest(TestCase):
+
+    def change_catalog(self):
+        category = EquipmentCategory.objects.create(name='Автоматы')
+        unit = EquipmentUnit.objects.create(name='шт')
+        for i in range(3):
+            OurEquipment.objects.create(category=category, unit=unit, name=f'ВА47-29 {i}', code=f'MVA-{i}', cost=1)
+        # каскадное удаление номенклатуры вместе с категорией
+        category.delete()
+
+    def test_one_bump_per_transaction(self):
+        version = CatalogVersionService.get()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with transaction.atomic():
+                self.change_catalog()
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(CatalogVersionService.get(), version + 1)
+
+    def test_rollback(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                self.change_catalog()
+                raise RuntimeError
+            self.assertEqual(len(callbacks), 0)
+            with transaction.atomic():
+                EquipmentUnit.objects.create(name='м')
+        # после отката признак ожидания сброшен, следующая транзакция снова повышает версию
+        self.assertEqual(len(callbacks), 1)
+
+    def test_batch(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            with CatalogVersionService.batch():
+                self.change_catalog()
+                self.assertEqual(len(callbacks), 0)
+        self.assertEqual(len(callbacks), 1)
+
+
+class PoolWorkerTest(SimpleTestCase):
+
+    @override_settings(SEARCH_CATALOG_LISTEN=True)
+    @mock.patch.object(CatalogVersionService, 'version', None)
+    @mock.patch.object(CatalogVersionService, 'pinned', None)
+    @mock.patch('searching.catalog.connection', vendor='postgresql')
+    @mock.patch('searching.catalog.CatalogListener')
+    def test_catalog_version_from_parent(self, listener, connection):
+        SearchService.init_pool_worker(7)
+        # версия берется у родителя без запросов к базе данных и без подключения слушателя уведомлений
+        self.assertEqual(CatalogVersionService.get(), 7)
+        self.assertFalse(CatalogVersionService.listen())
+        listener.assert_not_called()
+
+
+class HeaderNamesTest(SimpleTestCase):
+
+    def test_unnamed_and_duplicates(self):
+        self.assertEqual(
+            SearchService.get_header_names(('Артикул', None, 'Артикул', 'Кол-во', 'Артикул', None)),
+            ['Артикул', 'Unnamed: 1', 'Артикул.1', 'Кол-во', 'Артикул.2', 'Unnamed: 5'])
+
+    def test_suffix_collision(self):
+        # как в pandas: имя с суффиксом, совпавшее с существующим столбцом, получает еще один суффикс
+        self.assertEqual(SearchService.get_header_names(('a', 'a.1', 'a')), ['a', 'a.1', 'a.1.1'])
+        self.assertEqual(SearchService.get_header_names((1, 1.5, '1')), ['1', '1.5', '1.1'])
+
+
+class PrepareDataTest(SimpleTestCase):
+
+    def test_rows(self):
+        f = estimate_file([
+            ('Раздел 1',),
+            ('2CDS251001R0164', 'S201 C16', 'шт', 10.0, 'MVA20-1-016-C'),
+            (),
+            (12345, 'Автомат', 'шт', 2.5),
+            (), (),
+        ])
+        rows = list(SearchService.get_prepare_data(f))
+        # пустые строки в конце листа отбрасываются, пустые строки между заполненными сохраняются
+        self.assertEqual([row['index'] for row in rows], [0, 1, 2, 3])
+        self.assertEqual([(row['comp_code'], row['comp_name'], row['comp_unit'], row['comp_count'], row['our_code'])
+                          for row in rows],
+                         [('Раздел 1', None, None, None, None),
+                          ('2CDS251001R0164', 'S201 C16', 'шт', 10, 'MVA20-1-016-C'),
+                          (None, None, None, None, None),
+                          (12345, 'Автомат', 'шт', 2.5, None)])
+        self.assertIsInstance(rows[1]['comp_count'], int)
+        self.assertEqual(rows[0]['analogues'], [])
+
+    def test_invalid_file(self):
+        with self.assertRaises(ValueError):
+            list(SearchService.get_prepare_data(io.BytesIO(b'not an xlsx file')))
+        with self.assertRaises(ValueError):
+            list(SearchService.get_prepare_data(estimate_file([('2CDS251001R0164',)], sheet='Лист1')))
+
+
+class NormalizeKeyTest(SimpleTestCase):
+
+    def test_cyrillic_lookalikes(self):
+        self.assertEqual(normalize_key('АВС-10'), 'abc-10')
+        self.assertEqual(normalize_key('МВА20-1-016-С'), normalize_key('MBA20-1-016-C'))
+        self.assertEqual(normalize_key('Ёлка'), normalize_key('ЕЛКА'))
+
+    def test_dashes(self):
+        for dash in ('‐', '‑', '–', '—'):
+            self.assertEqual(normalize_key(f'ВА47{dash}29'), normalize_key('BA47-29'))
+
+    def test_whitespace(self):
+        self.assertEqual(normalize_key(' mva20 -1\t-016\n-c\xa0'), 'mva20-1-016-c')
+
+    def test_empty_values(self):
+        for value in (None, float('nan'), '', '  \t'):
+            self.assertIsNone(normalize_key(value))
+
+    def test_numbers(self):
+        self.assertEqual(normalize_key(12345.0), '12345')
+        self.assertEqual(normalize_key(12345), '12345')
+        self.assertEqual(normalize_key(1.5), '1.5')
+
+
+class NormalizedKeysTest(RecalculateTestCase):
+
+    def test_model_keys(self):
+        a = self.equipment['a']
+        self.assertEqual((a.code_key, a.name_key), ('mva20-1-016-c', 'ba47-291p16a'))
+        self.assertEqual(KeyWord.objects.filter(keyword_key='s201c16').count(), 2)
+
+    def test_exact_tiers_match_lookalikes(self):
+        a = self.equipment['a']
+        data = [
+            # кириллические М, А, С и неразрывные дефисы
+            estimate_row('мvа20‑1‑016‑с', 'x'),
+            estimate_row('nope', 'ва47–29 1р 16а'),
+            estimate_row('nope', 's 201 с16'),
+        ]
+        result, calls = self.recalculate(data)
+        self.assertEqual([row.get('our_code') for row in result], [a.code] * 3)
+        self.assertEqual(list(self.prc.results.order_by('id').values_list(
+            'match_in_own_codes', 'match_in_own_names', 'match_in_comp_names')),
+            [(True, False, False), (False, True, False), (False, False, True)])
+
+
+@override_settings(SEARCH_CATALOG_LISTEN=False)
+class CategoryMatrixTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category, cls.model, values, cls.equipment = create_catalog()
+        cls.values = {value: v.id for value, v in values.items()}
+
+    def setUp(self):
+        self.matrix = CategoryMatrix(self.category.id, OurEquipment.objects.all())
+
+    def search(self, values, psp, k=None, excluded=None):
+        ids = {eq.id: key for key, eq in self.equipment.items()}
+        return [[ids[eq_id], pct] for eq_id, pct in self.matrix.search(
+            [self.values[v] for v in values], psp, k, excluded)]
+
+    def test_psp_threshold(self):
+        self.assertEqual(self.search(('16А', '1P'), 100), [['a', 100], ['c', 100]])
+        # при равном кол-ве совпадений порядок - по наименованию
+        self.assertEqual(self.search(('16А', '1P'), 50), [['a', 100], ['c', 100], ['b', 50], ['d', 50]])
+        # номенклатура без совпадений не выдается даже при нулевом пороге
+        self.assertEqual(self.search(('25А',), 0), [['b', 50]])
+
+    def test_top_k(self):
+        self.assertEqual(self.search(('16А', '1P'), 50, k=3), [['a', 100], ['c', 100], ['b', 50]])
+        self.assertEqual(self.search(('16А', '1P'), 50, k=1), [['a', 100]])
+
+    def test_excluded_mask(self):
+        excluded = ExcludedEquipment([self.equipment['c'].id])
+        mask = excluded.mask(self.matrix)
+        self.assertEqual(self.search(('16А', '1P'), 50, excluded=mask), [['a', 100], ['b', 50], ['d', 50]])
+        # маска вычисляется один раз на матрицу
+        self.assertIs(excluded.mask(self.matrix), mask)
+        self.assertIsNone(ExcludedEquipment().mask(self.matrix))
+
+    def test_empty_query(self):
+        self.assertEqual(self.search((), 0), [])
+        self.assertEqual(self.matrix.scores([-1]).tolist(), [0] * 4)
+
+    def test_sparse_storage(self):
+        # хранятся только заполненные ячейки, повторные значения в запросе учитываются один раз
+        self.assertEqual(len(self.matrix.indices), 8)
+        self.assertEqual(self.matrix.scores([self.values['16А']] * 2 + [self.values['2P']]).tolist(), [1, 0, 2, 1])
+
+
+class MatchRowTest(SimpleTestCase):
+    """
+    Порядок ступеней подбора: точные ступени, нечеткий поиск, поиск по характеристикам
+    """
+
+    def setUp(self):
+        self.index = mock.Mock()
+        self.index.lookup.return_value = (None, list(), None)
+        self.index.trigram_lookup.return_value = (None, list())
+        self.index.property_search.return_value = (None, list())
+        self.row = {'comp_code': 'nope', 'comp_name': 'Автомат 1P 16А'}
+
+    def steps(self):
+        return [name for name, args, kwargs in self.index.mock_calls]
+
+    def test_not_found(self):
+        self.assertEqual(SearchService.match_row(self.row, self.index, 80), (None, list(), None))
+        self.assertEqual(self.steps(), ['lookup', 'trigram_lookup', 'property_search'])
+        self.index.lookup.assert_called_once_with('nope', 'Автомат 1P 16А')
+        self.index.property_search.assert_called_once_with('Автомат 1P 16А', 80)
+
+    def test_lookup_first(self):
+        self.index.lookup.return_value = ('anlg', [[2, 100]], 'match_in_keys')
+        self.assertEqual(SearchService.match_row(self.row, self.index, 80), ('anlg', [[2, 100]], 'match_in_keys'))
+        self.assertEqual(self.steps(), ['lookup'])
+
+    def test_trigram_before_properties(self):
+        self.index.trigram_lookup.return_value = ('anlg', [[2, 70]])
+        self.index.property_search.return_value = ('other', list())
+        self.assertEqual(SearchService.match_row(self.row, self.index, 80), ('anlg', [[2, 70]], 'match_by_trigram'))
+        self.assertEqual(self.steps(), ['lookup', 'trigram_lookup'])
+
+    def test_properties_last(self):
+        self.index.property_search.return_value = ('anlg', [[3, 50]])
+        self.assertEqual(SearchService.match_row(self.row, self.index, 80),
+                         ('anlg', [[3, 50]], 'match_by_properties'))
+
+
+@override_settings(SEARCH_TRIGRAM_ENABLED=True, SEARCH_TRIGRAM_THRESHOLD=0.4)
+class TrigramTest(RecalculateTestCase):
+    """
+    Запросы нечеткого поиска выполняются только в PostgreSQL, поэтому выполнение запроса подменяется
+    """
+
+    def test_query_parameters(self):
+        sql, params = AnalogIndex.trigram_query(['b', 'a'], 44, ExcludedEquipment([5, 3]))
+        # исключенная номенклатура передается одним массивом, а не списком параметров NOT IN
+        self.assertEqual(params, [['b', 'a'], 0.4, [3, 5], 44])
+        self.assertEqual(sql.count('%s'), 4)
+
+    @mock.patch('searching.indexes.connection')
+    def test_prefetch(self, connection):
+        a, b = self.equipment['a'], self.equipment['b']
+        cursor = connection.cursor.return_value.__enter__.return_value
+        # аналог, найденный в нескольких источниках, остается с наибольшим сходством
+        cursor.fetchall.return_value = [('S201', b.id, 0.9), ('S201', a.id, 0.8), ('S201', b.id, 0.5)]
+        index = AnalogIndex()
+        index.trigram_prefetch(['S201', 'ничего', 'S201', '  ', None])
+        self.assertEqual(cursor.execute.call_count, 1)
+        self.assertEqual(cursor.execute.call_args[0][1][0], ['S201', 'ничего'])
+        self.assertEqual(index.trigrams, {'S201': [[b.id, 90], [a.id, 80]], 'ничего': []})
+        self.assertEqual(index.trigram_lookup('S201'), (b, [[a.id, 80]]))
+        self.assertEqual(index.trigram_lookup('ничего'), (None, []))
+        self.assertEqual(cursor.execute.call_count, 1)
+
+    def test_batch_mode_single_query(self):
+        b = self.equipment['b']
+        names = list()
+
+        def prefetch(index, comp_names):
+            comp_names = [name for name in comp_names if name not in index.trigrams]
+            names.append(sorted(comp_names))
+            for name in comp_names:
+                index.trigrams[name] = [[b.id, 60]] if name == 'автомат ва 25' else list()
+
+        data = [
+            estimate_row('MVA20-1-016-C', 'x'),
+            estimate_row('nope', 'автомат ва 25'),
+            estimate_row('nope', 'Автомат 2P 16А'),
+            estimate_row('nope', 'ничего'),
+        ]
+        with mock.patch.object(AnalogIndex, 'trigram_prefetch', autospec=True, side_effect=prefetch):
+            result, calls = self.recalculate(data)
+        # одна выборка для всех неподобранных точными ступенями наименований
+        self.assertEqual(names, [['Автомат 2P 16А', 'автомат ва 25', 'ничего']])
+        self.assertEqual([row.get('our_code') for row in result], ['MVA20-1-016-C', b.code, 'MVA20-2-016-C', None])
+        self.assertEqual(list(self.prc.results.order_by('id').values_list('match_by_trigram', flat=True)),
+                         [False, True, False, False])
+
+    def test_threshold_per_connection(self):
+        connection = mock.MagicMock(vendor='postgresql')
+        set_trigram_threshold(sender=None, connection=connection)
+        cursor = connection.cursor.return_value.__enter__.return_value
+        cursor.execute.assert_called_once_with(
+            "SELECT set_config('pg_trgm.similarity_threshold', %s, false)", ['0.4'])
+
+
+@override_settings(SEARCH_CATALOG_LISTEN=False)
+class DownloadTest(TestCase):
 
-# Create your tests here.
+    def test_download(self):
+        user = get_user_model().objects.create(username='user', email='user@example.com')
+        rows = [{'comp_code': f'2CDS{i}', 'comp_name': f'S201 C{i}', 'code': f'MVA-{i}', 'name': f'ВА47-29 {i}'}
+                for i in range(3)]
+        request = APIRequestFactory().generic('GET', '/', json.dumps(rows), content_type='application/json')
+        force_authenticate(request, user)
+        response = Recalculates.as_view({'get': 'download'})(request)
+        self.assertIsInstance(response, FileResponse)
+        self.assertIn("filename=*=UTF-8''", response['Content-Disposition'])
+        ws = load_workbook(io.BytesIO(b''.join(response.streaming_content))).active
+        self.assertEqual([[cell.value for cell in row] for row in ws.iter_rows(min_row=8, min_col=2, max_col=7)],
+                         [[row['comp_code'], row['comp_name'], None, None, row['code'], row['name']] for row in rows])
+        # временный файл закрывается вместе с ответом
+        response.close()
+        self.assertTrue(response.file_to_stream.closed)
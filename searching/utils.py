@@ -0,0 +1,38 @@
+import math
+
+# кириллические буквы, совпадающие по начертанию с латинскими (после приведения к нижнему регистру)
+LOOKALIKES = str.maketrans({
+    'а': 'a',
+    'в': 'b',
+    'е': 'e',
+    'ё': 'e',
+    'к': 'k',
+    'м': 'm',
+    'н': 'h',
+    'о': 'o',
+    'р': 'p',
+    'с': 'c',
+    'т': 't',
+    'у': 'y',
+    'х': 'x',
+    '‐': '-',
+    '‑': '-',
+    '–': '-',
+    '—': '-',
+})
+
+
+def normalize_key(value):
+    """
+    Приводит артикул, наименование или поисковой ключ к ключу для точного сравнения:
+    нижний регистр, без пробельных символов, кириллические буквы-двойники заменены латинскими.
+    Для пустых значений возвращает None.
+
+    value   <-  Строка или число из базы данных или из строки сметы
+    """
+    if value is None or isinstance(value, float) and math.isnan(value):
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    key = ''.join(str(value).casefold().translate(LOOKALIKES).split())
+    return key or None
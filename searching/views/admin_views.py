@@ -1,5 +1,3 @@
-import os
-
 from rest_framework import viewsets
 from rest_framework.filters import SearchFilter, OrderingFilter
 from rest_framework.permissions import IsAdminUser
@@ -53,7 +51,7 @@ class EquipmentCategoryAdminViewSet(viewsets.ModelViewSet):
     @action(methods=('get',), detail=False)
     def download(self, request):
         path = DownloadDatafileService.create_category_datafile(self.filter_queryset(self.get_queryset()))
-        response = DownloadDatafileService.get_file_response(path, path.split(os.sep)[-1], 30)
+        response = DownloadDatafileService.get_file_response(path)
         return response
 
     @action(methods=('post',), detail=False)
@@ -138,7 +136,7 @@ class OurEquipmentAdminViewSet(viewsets.ModelViewSet):
     @action(methods=('get',), detail=False)
     def download(self, request):
         path = DownloadDatafileService.create_our_equipment_datafile(self.filter_queryset(self.get_queryset()))
-        response = DownloadDatafileService.get_file_response(path, path.split(os.sep)[-1], 30)
+        response = DownloadDatafileService.get_file_response(path)
         return response
 
     @action(methods=('post',), detail=False)
@@ -181,7 +179,7 @@ class CompetitorsEquipmentAdminViewSet(viewsets.ModelViewSet):
     @action(methods=('get',), detail=False)
     def download(self, request):
         path = DownloadDatafileService.create_comp_equipment_datafile(self.filter_queryset(self.get_queryset()))
-        response = DownloadDatafileService.get_file_response(path, path.split(os.sep)[-1], 30)
+        response = DownloadDatafileService.get_file_response(path)
         return response
 
     @action(methods=('post',), detail=False)
@@ -206,7 +204,7 @@ class KeyWordAdminViewSet(viewsets.ModelViewSet):
     @action(methods=('get',), detail=False)
     def download(self, request):
         path = DownloadDatafileService.create_kwds_datafile(self.filter_queryset(self.get_queryset()))
-        response = DownloadDatafileService.get_file_response(path, path.split(os.sep)[-1], 30)
+        response = DownloadDatafileService.get_file_response(path)
         return response
 
     @action(methods=('post',), detail=False)
@@ -237,11 +235,11 @@ class SearchProcessResultAdminViewSet(viewsets.ModelViewSet):
     filterset_fields = (
         'process', 'input_code', 'input_name', 'output_code', 'output_name', 'is_match', 'is_unmatch', 'is_skip',
         'match_in_own_codes', 'match_in_own_names', 'match_in_comp_codes', 'match_in_comp_names', 'match_in_keys',
-        'match_by_properties'
+        'match_by_trigram', 'match_by_properties'
     )
     search_fields = ('input_code', 'input_name', 'output_code', 'output_name',)
     ordering_fields = (
         'process', 'input_code', 'input_name', 'output_code', 'output_name', 'is_match', 'is_unmatch', 'is_skip',
         'match_in_own_codes', 'match_in_own_names', 'match_in_comp_codes', 'match_in_comp_names', 'match_in_keys',
-        'match_by_properties',
+        'match_by_trigram', 'match_by_properties',
     )
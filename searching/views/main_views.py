@@ -4,8 +4,13 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 
 from searching.services import SearchService
+from searching.services import SearchResultService
 from searching.services import UploadDatafileService
+from searching.tasks import recalculate
+from searching.tasks import recalculate_file
 from searching.serializers.main_serializers import SearchRequestSerializer
+from searching.serializers.main_serializers import SearchFileRequestSerializer
+from searching.serializers.main_serializers import SearchProcessStatusSerializer
 
 from searching.models import SearchProcess
 
@@ -16,10 +21,13 @@ class Recalculates(viewsets.GenericViewSet):
     serializer_class = SearchRequestSerializer
     service = SearchService
 
+    def get_queryset(self):
+        return self.queryset.filter(user=self.request.user)
+
     @action(methods=('post',), detail=False)
     def prepare(self, request):
         try:
-            return Response(self.service.get_prepare_data(request.FILES['file']))
+            return Response(list(self.service.get_prepare_data(request.FILES['file'])))
         except KeyError:
             return Response({'detail': 'Выберите файл сметы'}, 400)
         except (ValueError, AttributeError,):
@@ -28,16 +36,42 @@ class Recalculates(viewsets.GenericViewSet):
 
     @action(methods=('post',), detail=False)
     def search(self, request):
-        serializer = self.get_serializer(request.data)
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        self.service.check_rows_available(request.user, len(data.get('rows')))
+        prc = self.queryset.create(user=request.user, psp=data.get('psp'))
+        recalculate.delay(prc.id, data.get('rows'), data.get('ex_mdls'))
+        return Response({'id': prc.id}, 202)
+
+    @action(methods=('post',), detail=False, serializer_class=SearchFileRequestSerializer)
+    def search_file(self, request):
+        # файл сметы разбирается и пересчитывается в фоне, строки не передаются через клиента
+        serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        data = serializer.data
+        data = serializer.validated_data
         prc = self.queryset.create(user=request.user, psp=data.get('psp'))
-        return Response(self.service.do_recalculate(data.get('rows'), prc, data.get('ex_mdls')))
+        path = self.service.save_upload(prc, data.get('file'))
+        recalculate_file.delay(prc.id, path, data.get('ex_mdls'))
+        return Response({'id': prc.id}, 202)
+
+    @action(methods=('get',), detail=True)
+    def status(self, request, pk=None):
+        return Response(SearchProcessStatusSerializer(self.get_object()).data)
+
+    @action(methods=('get',), detail=True)
+    def results(self, request, pk=None):
+        return Response(SearchResultService.load(self.get_object()))
+
+    @action(methods=('get',), detail=True)
+    def file(self, request, pk=None):
+        # файл пересчета строится из результата, сохраненного на сервере, без передачи строк клиентом
+        rows = SearchResultService.iter_file_rows(self.get_object())
+        return self.service.get_file_response(self.service.get_file(rows), request.user.email)
 
     @action(methods=('get',), detail=False)
     def download(self, request):
-        response = self.service.get_file_response(self.service.get_file(request.data), request.user.email, 30)
-        return Response(response)
+        return self.service.get_file_response(self.service.get_file(request.data), request.user.email)
 
     @action(methods=('post',), detail=True)
     def interrupt(self, request, pk=None):